@@ -0,0 +1,297 @@
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from . import codec
+from .binarylog import BinaryLog
+from .framing import MessageParser
+from .client import copy_compile_commands
+from .documents import DocumentTracker
+from .message import *
+from .querycache import query_key
+from .semantic import DocumentTokens
+
+
+class AsyncSocketInput:
+    # stdin of an AsyncDaemonProcess, closing it only ends the writing side
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    def write(self, data: bytes):
+        self._writer.write(data)
+
+    def close(self):
+        if self._writer.can_write_eof() and not self._writer.is_closing():
+            self._writer.write_eof()
+
+
+class AsyncDaemonProcess:
+    # Takes the place of the server process when attached to a daemon, see daemon.py
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writer = writer
+        self.stdin = AsyncSocketInput(writer)
+        self.stdout = reader
+        self.stderr = asyncio.StreamReader()
+        self.stderr.feed_eof()
+
+    async def wait(self) -> int:
+        self._writer.close()
+        await self._writer.wait_closed()
+        return 0
+
+    def kill(self):
+        self._writer.close()
+
+
+class AsyncLSPClient(DocumentTracker):
+    superseded_methods = default_superseded_methods
+    # When set, large responses resolve futures as codec.LazyResponse, parsed on first access
+    lazy_decoding = False
+    # Notifications kept for notifications() readers, the oldest are dropped when nobody reads them
+    max_notifications = 1024
+
+    def __init__(self, root_folder, compile_commands_path: str = '', enable_logging=False,
+                 server_command: Optional[List[str]] = None, daemon_socket: Optional[str] = None):
+        # With a daemon socket (by default $LSPCLIENT_DAEMON) initialize() attaches to the daemon's server
+        self._root_folder = root_folder
+        self._daemon_socket = daemon_socket if daemon_socket is not None else os.environ.get('LSPCLIENT_DAEMON', '')
+        self._compile_commands_path = compile_commands_path
+        self._server_command = server_command if server_command else ['clangd']
+        self._bin_log: Optional[BinaryLog] = None
+        if enable_logging:
+            self._bin_log = BinaryLog('rpc_session.bin')
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._parser = MessageParser()
+        self._tasks: List[asyncio.Task] = []
+        self._notifications: asyncio.Queue = asyncio.Queue(self.max_notifications)
+        self.dropped_notifications = 0
+        self.transactions: Dict[str, asyncio.Future] = {}
+        self._latest_requests: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.initialized = False
+        self._init_documents()
+
+    async def initialize(self, timeout: float = 2.0):
+        if self._compile_commands_path:
+            await asyncio.to_thread(copy_compile_commands, self._compile_commands_path, self._root_folder)
+        if self._daemon_socket:
+            try:
+                self._process = AsyncDaemonProcess(*await asyncio.open_unix_connection(self._daemon_socket))
+            except OSError:
+                pass
+        if self._process is None:
+            self._process = await asyncio.create_subprocess_exec(*self._server_command, stdin=asyncio.subprocess.PIPE,
+                                                                 stdout=asyncio.subprocess.PIPE,
+                                                                 stderr=asyncio.subprocess.PIPE)
+        self._tasks.append(asyncio.create_task(self.read_loop()))
+        self._tasks.append(asyncio.create_task(self.drain_stderr()))
+        try:
+            msg = await asyncio.wait_for(self.request(InitMessage(self._root_folder)), timeout)
+        except (asyncio.TimeoutError, RuntimeError):
+            await self._abort()
+            raise RuntimeError("Failed to initialize")
+        if not msg.get('result'):
+            await self._abort()
+            raise RuntimeError(f"Failed to initialize: {msg.get('error')}")
+        self.capabilities = msg.get('result').get('capabilities')
+        self.handle_capabilities()
+        self.send_message(InitializedMessage())
+        self.initialized = True
+
+    async def shutdown(self):
+        if self._process is None:
+            return
+        self._process.stdin.close()
+        try:
+            await asyncio.wait_for(self._process.wait(), 3)
+        except asyncio.TimeoutError:
+            self._process.kill()
+        await self._stop()
+
+    async def _abort(self):
+        # A server that failed to initialize is killed, nothing of it keeps running
+        try:
+            self._process.kill()
+        except ProcessLookupError:
+            pass
+        await self._process.wait()
+        await self._stop()
+
+    async def _stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._fail_transactions()
+        self.diagnostics.close()
+        self._release_documents()
+        self._process = None
+        if self._bin_log:
+            self._bin_log.shutdown()
+
+    def send_message(self, msg: Message):
+        if self._process is None:
+            raise RuntimeError("Client not initialized")
+        data = serialize(msg.root)
+        if self._bin_log:
+            self._bin_log.add(data, 1, msg.root.get('id'))
+        self._process.stdin.write(data)
+
+    def request(self, msg: QueryMessage) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.transactions[msg.message_id] = future
+        future.add_done_callback(lambda f: self._request_done(msg.message_id, f))
+        method = msg.root.get('method')
+        if method in self.superseded_methods:
+            key = (method, msg.params.get('textDocument').get('uri'))
+            previous = self._latest_requests.get(key)
+            self._latest_requests[key] = future
+            if previous is not None:
+                previous.cancel()
+        self.send_message(msg)
+        return future
+
+    def _request_done(self, message_id: str, future: asyncio.Future):
+        # Cancelling the future (directly, through wait_for or by supersession) cancels the request
+        if self.transactions.pop(message_id, None) is not None and self._process is not None:
+            self.send_message(CancelMessage(message_id))
+        self._latest_requests = {k: v for k, v in self._latest_requests.items() if not v.done()}
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self._process.stdout.read(65536)
+                if not data:
+                    break
+                self._parser.feed(data)
+                for frame, body in self._parser.messages():
+                    msg = codec.decode_message(body, self.lazy_decoding)
+                    if self._bin_log:
+                        self._bin_log.add(frame, 0, msg.get('id'))
+                    self.process_incoming(msg)
+        finally:
+            self._fail_transactions()
+            self._queue_notification(None)
+
+    async def drain_stderr(self):
+        while await self._process.stderr.read(65536):
+            pass
+
+    def _fail_transactions(self):
+        transactions = self.transactions
+        self.transactions = {}
+        for future in transactions.values():
+            if not future.done():
+                future.set_exception(RuntimeError("Server terminated"))
+
+    def process_incoming(self, msg):
+        if 'id' in msg:
+            future = self.transactions.pop(msg.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(msg)
+        else:
+            if msg.get('method') == 'textDocument/publishDiagnostics':
+                self.diagnostics.publish(msg.get('params'))
+            self._queue_notification(msg)
+
+    def _queue_notification(self, msg: Optional[dict]):
+        if self._notifications.full():
+            self._notifications.get_nowait()
+            self.dropped_notifications += 1
+        self._notifications.put_nowait(msg)
+
+    async def notifications(self) -> AsyncIterator[dict]:
+        while True:
+            msg = await self._notifications.get()
+            if msg is None:
+                self._notifications.put_nowait(None)
+                return
+            yield msg
+
+    async def diagnostics(self) -> AsyncIterator[dict]:
+        async for msg in self.notifications():
+            if msg.get('method') == 'textDocument/publishDiagnostics':
+                yield msg.get('params')
+
+    def request_completion(self, path: str, row: int, col: int) -> asyncio.Future:
+        cache = self.completion_cache
+        if cache is None:
+            return self.request(CompletionMessage(path, row, col))
+        file = get_file(path)
+        response = cache.lookup(file, row, col)
+        if response is not None:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(response)
+            return future
+        session = cache.begin(file, row, col)
+        request = self.request(CompletionMessage(path, row, col))
+        future = asyncio.get_running_loop().create_future()
+
+        def done(f: asyncio.Future):
+            if future.done():
+                return
+            if f.cancelled():
+                future.cancel()
+            elif f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                cache.store(session, f.result())
+                future.set_result(f.result())
+
+        request.add_done_callback(done)
+        # Cancelling the returned future cancels the request
+        future.add_done_callback(lambda f: request.cancel() if f.cancelled() else None)
+        return future
+
+    def request_completion_resolve(self, item: dict) -> asyncio.Future:
+        return self.request(CompletionResolveMessage(item))
+
+    def request_coloring(self, path: str, prev_id: str) -> asyncio.Future:
+        return self.request(ColoringMessage(path, prev_id))
+
+    async def request_semantic_tokens(self, path: str) -> Optional[DocumentTokens]:
+        uri = get_file(path).uri
+        prev_id = self.semantic_tokens.previous_result_id(uri)
+        document = self.semantic_tokens.apply_response(uri, await self.request(ColoringMessage(path, prev_id)))
+        if document is None and prev_id:
+            self.semantic_tokens.remove(uri)
+            return await self.request_semantic_tokens(path)
+        return document
+
+    def request_position(self, method: str, path: str, row: int, col: int) -> asyncio.Future:
+        # With a query cache, requests of its methods on open documents are answered from the cache or
+        # join an identical request in flight. Cancelling the returned future leaves the request running.
+        msg = PositionalMessage(method, path, row, col)
+        cache = self.query_cache
+        version = self._document_version(msg.params.get('textDocument').get('uri'))
+        if cache is None or version is None or method not in cache.methods:
+            return self.request(msg)
+        key = query_key(msg, version)
+        future = asyncio.get_running_loop().create_future()
+        response = cache.lookup(key)
+        if response is not None:
+            future.set_result(response)
+            return future
+        if cache.join_or_begin(key, msg.message_id, future) is not None:
+            return future
+
+        def done(f: asyncio.Future):
+            if f.cancelled() or f.exception() is not None:
+                waiters = cache.abandon(msg.message_id)
+            else:
+                waiters = cache.complete(key, f.result())
+            for waiter in waiters:
+                if waiter.done():
+                    continue
+                if f.cancelled():
+                    waiter.cancel()
+                elif f.exception() is not None:
+                    waiter.set_exception(f.exception())
+                else:
+                    waiter.set_result(f.result())
+
+        self.request(msg).add_done_callback(done)
+        return future
+
+    def request_definition(self, path: str, row: int, col: int) -> asyncio.Future:
+        return self.request_position('textDocument/definition', path, row, col)
+
+    def request_workspace_symbols(self, query: str) -> asyncio.Future:
+        return self.request(WorkspaceSymbolMessage(query))
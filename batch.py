@@ -0,0 +1,183 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from .message import request_cancelled
+
+# Short names of the positional requests a batch can make, full method names are accepted as well
+batch_methods = {'definition': 'textDocument/definition', 'declaration': 'textDocument/declaration',
+                 'type_definition': 'textDocument/typeDefinition',
+                 'implementation': 'textDocument/implementation', 'hover': 'textDocument/hover',
+                 'highlight': 'textDocument/documentHighlight', 'signature_help': 'textDocument/signatureHelp',
+                 'completion': 'textDocument/completion'}
+
+# (path, row, col, kind)
+BatchQuery = Tuple[str, int, int, str]
+
+
+class BatchResult:
+    __slots__ = ('index', 'path', 'row', 'col', 'kind', 'response', 'error')
+
+    def __init__(self, index: int, path: str, row: int, col: int, kind: str):
+        self.index = index
+        self.path = path
+        self.row = row
+        self.col = col
+        self.kind = kind
+        self.response = None
+        # Why there is no result: the server's error message, a file that could not be read, a timeout
+        self.error: Optional[str] = None
+
+    @property
+    def result(self):
+        return self.response.get('result') if self.response is not None else None
+
+    def __repr__(self):
+        return f'BatchResult({self.index}, {self.path}:{self.row}:{self.col} {self.kind}, error={self.error!r})'
+
+
+class QueryBatch:
+    # Runs queries through the client with at most window of them outstanding, yielding a
+    # BatchResult per query. Ordered batches yield in query order, holding completed results
+    # until the ones before them are done, so window also bounds the results held back.
+    # Documents that are not open are opened when a query needs them, and closed once more than
+    # max_open of them are open and no query in flight uses them. The queries are read as the
+    # batch goes, documents still open at the end (or when the iteration is abandoned) are closed.
+    def __init__(self, client: 'LSPClient', queries: Iterable[BatchQuery], window: int = 64, ordered: bool = True,
+                 max_open: int = 16, timeout: Optional[float] = None):
+        self._client = client
+        self._queries = queries
+        self.window = max(window, 1)
+        self.ordered = ordered
+        self.max_open = max(max_open, 1)
+        # Seconds per query, the client's request_timeout by default
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        # Queries sent and not answered: index -> RequestHandle, None while it is being sent
+        self._inflight: Dict[int, Optional['RequestHandle']] = {}
+        # Answered and not yielded yet
+        self._done: Dict[int, BatchResult] = {}
+        # Documents opened by the batch in least recently used order, with their queries in flight
+        self._documents: 'OrderedDict[str, int]' = OrderedDict()
+        self.counters = {'queries': 0, 'answered': 0, 'failed': 0, 'timed_out': 0, 'opened': 0, 'closed': 0,
+                         'max_outstanding': 0}
+        self._started = False
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._condition:
+            return dict(self.counters, inflight=len(self._inflight), held=len(self._done),
+                        documents=len(self._documents))
+
+    def _answered(self, result: BatchResult, response):
+        # On the RPC thread, or on the calling thread for responses from the query cache
+        with self._condition:
+            if result.index not in self._inflight:
+                return
+            del self._inflight[result.index]
+            error = response.get('error')
+            if error is not None:
+                result.error = error.get('message', 'error')
+                if error.get('code') == request_cancelled:
+                    self.counters['timed_out'] += 1
+            result.response = response
+            self._done[result.index] = result
+            self._condition.notify()
+
+    def _use_document(self, path: str):
+        if path in self._documents:
+            self._documents[path] += 1
+            self._documents.move_to_end(path)
+        elif not self._client.is_open_file(path):
+            self._client.open_source_file(path)
+            self._documents[path] = 1
+            self.counters['opened'] += 1
+            self._close_documents()
+
+    def _release_document(self, path: str):
+        if path in self._documents:
+            self._documents[path] -= 1
+
+    def _close_documents(self, limit: Optional[int] = None):
+        if limit is None:
+            limit = self.max_open
+        idle = [path for path, count in self._documents.items() if count == 0]
+        for path in idle[:max(len(self._documents) - limit, 0)]:
+            del self._documents[path]
+            self._client.close_source_file(path)
+            self.counters['closed'] += 1
+
+    def _send(self, index: int, query: BatchQuery):
+        path, row, col, kind = query
+        result = BatchResult(index, path, row, col, kind)
+        self.counters['queries'] += 1
+        try:
+            self._use_document(path)
+        except (OSError, ValueError) as e:
+            result.error = str(e)
+            with self._condition:
+                self._done[index] = result
+            return
+        method = batch_methods.get(kind, kind)
+        handler = lambda response: self._answered(result, response)
+        with self._condition:
+            self._inflight[index] = None
+        # Expired requests are answered with an error as well, every query gets its result
+        handle = self._client.request_position(method, path, row, col, handler, self.timeout, supersede=False)
+        with self._condition:
+            if index in self._inflight:
+                self._inflight[index] = handle
+
+    def _ready(self, next_index: int) -> List[BatchResult]:
+        # Results that can be yielded, removed from _done
+        if not self.ordered:
+            results = list(self._done.values())
+            self._done.clear()
+            return results
+        results = []
+        while next_index in self._done:
+            results.append(self._done.pop(next_index))
+            next_index += 1
+        return results
+
+    def __iter__(self) -> Iterator[BatchResult]:
+        if self._started:
+            raise RuntimeError("A batch runs once")
+        self._started = True
+        queries = enumerate(self._queries)
+        exhausted = False
+        sent = 0
+        yielded = 0
+        try:
+            while True:
+                # Results held back count towards the window, ordered batches can't run ahead of a slow query
+                while not exhausted and sent - yielded < self.window:
+                    query = next(queries, None)
+                    if query is None:
+                        exhausted = True
+                        break
+                    self._send(*query)
+                    sent += 1
+                self.counters['max_outstanding'] = max(self.counters['max_outstanding'], sent - yielded)
+                if exhausted and sent == yielded:
+                    return
+                with self._condition:
+                    results = self._ready(yielded)
+                    while not results:
+                        self._condition.wait()
+                        results = self._ready(yielded)
+                for result in results:
+                    self._release_document(result.path)
+                    self.counters['answered' if result.error is None else 'failed'] += 1
+                self._close_documents()
+                for result in results:
+                    yielded += 1
+                    yield result
+        finally:
+            with self._condition:
+                handles = [handle for handle in self._inflight.values() if handle is not None]
+                self._inflight.clear()
+                self._done.clear()
+            for handle in handles:
+                handle.cancel()
+            for path in self._documents:
+                self._documents[path] = 0
+            self._close_documents(0)
@@ -0,0 +1,914 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .client import LSPClient, RPCClient, msg_log
+from . import fakeserver
+from .completion import CompletionCache
+from .framing import MessageParser
+from . import codec, message, semantic
+from .message import CompletionMessage, FileContent, PositionalMessage, QueryMessage, WorkspaceSymbolMessage, get_file, \
+    serialize
+from .outgoing import priority_background
+from .querycache import QueryCache
+from .standby import StandbyPool
+
+package_folder = os.path.dirname(os.path.abspath(__file__))
+test_folder = os.path.join(package_folder, 'test')
+test_source = os.path.join(test_folder, 'main.cpp')
+
+
+def fake_server_command(*args) -> List[str]:
+    return [sys.executable, os.path.join(package_folder, 'fakeserver.py')] + [str(a) for a in args]
+
+
+def replay_server_command(log_path: str, *args) -> List[str]:
+    return [sys.executable, os.path.join(package_folder, 'replayserver.py'), log_path] + [str(a) for a in args]
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# Metrics of the benchmarks run so far, by benchmark and measurement name
+results: Dict[str, Dict[str, Dict[str, float]]] = {}
+current_benchmark = ''
+
+
+def report(name: str, **metrics: float):
+    results.setdefault(current_benchmark, {}).setdefault(name, {}).update(metrics)
+
+
+def summarize(name: str, samples: List[float]):
+    ms = [s * 1000.0 for s in samples]
+    report(name, n=len(ms), mean_ms=statistics.mean(ms), p50_ms=percentile(ms, 0.5), p99_ms=percentile(ms, 0.99))
+    print(f'{name:<24} n={len(ms):<5} mean={statistics.mean(ms):8.3f}ms '
+          f'p50={percentile(ms, 0.5):8.3f}ms p99={percentile(ms, 0.99):8.3f}ms')
+
+
+class PollingLSPClient(LSPClient):
+    # The sleep-poll loop RPCClient used before the selector loop, kept for comparison.
+    # Writes happen on the writer thread in both loops.
+    def rpc_thread(self):
+        stdout_fd = self._process.stdout.fileno()
+        try:
+            while not self._terminating:
+                data = self._parser.read_from(stdout_fd)
+                if data:
+                    self.process_buffer()
+                else:
+                    time.sleep(0.01)
+                self.drain_wakeup()
+        except (ValueError, BrokenPipeError):
+            pass
+
+
+def completion_round_trips(client_class, count: int) -> List[float]:
+    lsp = client_class(test_folder, server_command=fake_server_command('--items', 20))
+    samples = []
+    try:
+        lsp.open_source_file(test_source)
+        done = threading.Event()
+        for _ in range(count):
+            done.clear()
+            start = time.perf_counter()
+            lsp.request_completion(test_source, 32, 3, lambda msg: done.set())
+            if not done.wait(5):
+                raise RuntimeError("Completion timed out")
+            samples.append(time.perf_counter() - start)
+        lsp.close_source_file(test_source)
+    finally:
+        lsp.shutdown()
+    return samples
+
+
+def bench_latency(count: int):
+    summarize('sleep-poll loop', completion_round_trips(PollingLSPClient, count))
+    summarize('selector loop', completion_round_trips(LSPClient, count))
+
+
+def synthetic_stream(count: int) -> bytes:
+    # Mix of small notifications and large completion-sized responses
+    small = serialize({'jsonrpc': '2.0', 'method': 'textDocument/publishDiagnostics',
+                       'params': {'uri': 'file:///main.cpp', 'diagnostics': []}})
+    items = [{'label': f'item_{i}', 'filterText': f'item_{i}', 'kind': 3} for i in range(5000)]
+    large = serialize({'jsonrpc': '2.0', 'id': '1', 'result': {'isIncomplete': False, 'items': items}})
+    return b''.join(large if i % 10 == 0 else small for i in range(count))
+
+
+class PreParserReader:
+    # RPCClient.read_available and process_buffer as of c8ea9b1, the last commit before MessageParser,
+    # copied unchanged. msg_log and the bin log are off, as they are by default.
+    def __init__(self):
+        self._buffer = bytearray()
+        self._bin_log = None
+        self.count = 0
+
+    @staticmethod
+    def read_available(fd: int) -> Optional[bytes]:
+        try:
+            return os.read(fd, 65536)
+        except BlockingIOError:
+            return None
+
+    def process_buffer(self):
+        while True:
+            pos = self._buffer.find(b'Content-Length: ')
+            if pos < 0:
+                break
+            end_pos = self._buffer.find(b'\r\n\r\n', pos + 16)
+            if end_pos < 0:
+                break
+            length = int(self._buffer[pos + 16:end_pos].decode('ascii'))
+            if len(self._buffer) < (end_pos + 4 + length):
+                break
+            msg = self._buffer[end_pos + 4:end_pos + 4 + length]
+            if msg_log:
+                msg_log.write(f'Writing to bin log {end_pos + 4 + length - pos} incoming bytes\n')
+            if self._bin_log:
+                self._bin_log.add(self._buffer[pos:end_pos + 4 + length], 0)
+            del self._buffer[:end_pos + 4 + length]
+            text = msg.decode('utf-8')
+            json_msg = json.loads(text)
+            # self.add_log(False, pretty(json_msg))
+            self.process_incoming(json_msg)
+
+    def process_incoming(self, msg):
+        self.count += 1
+
+
+class ParserReader(RPCClient):
+    # The client's own read path, MessageParser.read_from and RPCClient.process_buffer, without a server
+    def __init__(self):
+        self._parser = MessageParser()
+        self._bin_log = None
+        self.metrics = None
+        self.count = 0
+
+    def process_incoming(self, msg):
+        self.count += 1
+
+
+def pre_parser_read(fd: int) -> int:
+    # The stdout branch of the RPC loop as of c8ea9b1
+    reader = PreParserReader()
+    while True:
+        data = reader.read_available(fd)
+        if not data:
+            return reader.count
+        reader._buffer.extend(data)
+        reader.process_buffer()
+
+
+def parser_read(fd: int) -> int:
+    reader = ParserReader()
+    while reader._parser.read_from(fd):
+        reader.process_buffer()
+    return reader.count
+
+
+def pipe_stream(read: Callable[[int], int], stream: bytes) -> Tuple[int, float]:
+    # Messages read from a pipe a thread writes the stream into, and the seconds it took
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        view = memoryview(stream)
+        while view:
+            view = view[os.write(write_fd, view[:1 << 20]):]
+        os.close(write_fd)
+
+    writer = threading.Thread(target=write, daemon=True)
+    start = time.perf_counter()
+    writer.start()
+    try:
+        count = read(read_fd)
+    finally:
+        writer.join()
+        os.close(read_fd)
+    return count, time.perf_counter() - start
+
+
+def bench_framing(count: int):
+    # Framing and decoding of every message as the RPC loop does it, before MessageParser and now.
+    # json is the backend the pre-parser code used, the current path runs with each backend.
+    stream = synthetic_stream(count)
+    previous = codec.backend
+    runs = [('pre-parser read (json)', pre_parser_read, 'json')]
+    runs += [(f'MessageParser readv ({name})', parser_read, name) for name in codec.available_backends()]
+    try:
+        for name, read, backend in runs:
+            codec.set_backend(backend)
+            messages, elapsed = min((pipe_stream(read, stream) for _ in range(3)), key=lambda r: r[1])
+            report(name, mb_per_s=len(stream) / elapsed / 1e6, msgs_per_s=messages / elapsed)
+            print(f'{name:<32} {len(stream) / elapsed / 1e6:10.1f} MB/s {messages / elapsed:12.0f} msg/s')
+    finally:
+        codec.set_backend(previous)
+
+
+class DocumentTextMessage(QueryMessage):
+    # fakeserver.py extension returning its copy of a document
+    def __init__(self, path: str):
+        super().__init__('fake/documentText')
+        self.params['textDocument'] = {'uri': get_file(path).uri}
+
+
+class CountingLSPClient(LSPClient):
+    def __init__(self, *args, **kwargs):
+        self.bytes_sent = 0
+        super().__init__(*args, **kwargs)
+
+    def send_message(self, msg, priority=None):
+        self.bytes_sent += len(serialize(msg.root))
+        super().send_message(msg, priority)
+
+
+def call(lsp: LSPClient, msg: QueryMessage) -> dict:
+    done = threading.Event()
+    response = {}
+
+    def handler(result):
+        response.update(result)
+        done.set()
+
+    lsp.transactions[msg.message_id] = handler
+    lsp.send_message(msg)
+    if not done.wait(10):
+        raise RuntimeError("Request timed out")
+    return response
+
+
+def generated_source(rows: int) -> List[str]:
+    return [f'int function_{i}(int value) {{ return value * {i}; }}' for i in range(rows)]
+
+
+def editing_traces(lines: List[str]) -> Dict[str, List[Tuple[List[str], list]]]:
+    # Each step is the new version of the document and the edits an editor knows produced it,
+    # as (start_row, start_col, end_row, end_col, text) applied in order
+    middle = len(lines) // 2
+    typing, inserting, pasting, deleting, scattered = [], [], [], [], []
+    current = list(lines)
+    for i in range(50):
+        current = list(current)
+        column = len(current[middle])
+        current[middle] += 'x'
+        typing.append((current, [(middle, column, middle, column, 'x')]))
+    current = list(lines)
+    for i in range(50):
+        current = current[:middle + i] + [f'// line {i}'] + current[middle + i:]
+        inserting.append((current, [(middle + i, 0, middle + i, 0, f'// line {i}\n')]))
+    block = [f'int pasted_{i} = {i};' for i in range(40)]
+    for i in range(10):
+        pasting.append((lines[:middle] + block * (i + 1) + lines[middle:],
+                        [(middle, 0, middle, 0, ''.join(line + '\n' for line in block))]))
+    for i in range(10):
+        deleting.append((lines[:middle] + lines[middle + 20 * (i + 1):], [(middle, 0, middle + 20, 0, '')]))
+    current = list(lines)
+    for i in range(20):
+        current = list(current)
+        edits = []
+        for row in range(i, len(current), len(current) // 8):
+            # Right to left within the row so the columns of the earlier sites stay valid
+            sites = [column for column in range(len(current[row])) if current[row].startswith('value', column)]
+            edits += [(row, column, row, column + len('value'), 'v') for column in reversed(sites)]
+            current[row] = current[row].replace('value', 'v')
+        scattered.append((current, edits))
+    return {'typing': typing, 'new lines': inserting, 'paste block': pasting, 'delete block': deleting,
+            'rename 8 sites': scattered}
+
+
+def replay_trace(mode: str, lines: List[str], trace: List[Tuple[List[str], list]]):
+    # full sends the whole text, diff lets the client find the changes, ranges sends the known edits
+    with tempfile.NamedTemporaryFile('w', suffix='.cpp', delete=False) as f:
+        f.write('\n'.join(lines))
+        path = f.name
+    lsp = CountingLSPClient(test_folder, server_command=fake_server_command('--items', 1))
+    lsp.incremental_sync = mode != 'full'
+    try:
+        lsp.open_source_file(path)
+        call(lsp, DocumentTextMessage(path))
+        lsp.bytes_sent = 0
+        client, samples = [], []
+        for version, edits in trace:
+            start = time.perf_counter()
+            if mode == 'ranges':
+                lsp.modify_source_ranges(path, edits)
+            else:
+                lsp.modify_source_file(path, '\n'.join(version))
+            client.append(time.perf_counter() - start)
+            call(lsp, CompletionMessage(path, 0, 0))
+            samples.append(time.perf_counter() - start)
+        sent = lsp.bytes_sent
+        if call(lsp, DocumentTextMessage(path)).get('result') != '\n'.join(trace[-1][0]):
+            raise RuntimeError("Server document diverged")
+        return sent, client, samples
+    finally:
+        lsp.shutdown()
+        os.unlink(path)
+
+
+def bench_sync(count: int):
+    lines = generated_source(max(count, 1) * 100)
+    for name, trace in editing_traces(lines).items():
+        for mode in ('full', 'diff', 'ranges'):
+            sent, client, samples = replay_trace(mode, lines, trace)
+            client_ms = [s * 1000.0 for s in client]
+            ms = [s * 1000.0 for s in samples]
+            report(f'{name} {mode}', kb_per_edit=sent / len(trace) / 1024, client_p50_ms=percentile(client_ms, 0.5),
+                   p50_ms=percentile(ms, 0.5), p99_ms=percentile(ms, 0.99))
+            print(f'{name:<16} {mode:<8} {sent / len(trace) / 1024:10.1f} KB/edit '
+                  f'client p50={percentile(client_ms, 0.5):8.3f}ms '
+                  f'round trip p50={percentile(ms, 0.5):8.3f}ms p99={percentile(ms, 0.99):8.3f}ms')
+
+
+def type_identifier(use_cache: bool, identifier: str, rounds: int) -> List[float]:
+    with tempfile.NamedTemporaryFile('w', suffix='.cpp', delete=False) as f:
+        f.write('int main()\n{\n    \n}\n')
+        path = f.name
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--items', 2000))
+    if use_cache:
+        lsp.set_completion_cache(CompletionCache())
+    samples = []
+    try:
+        lsp.open_source_file(path)
+        done = threading.Event()
+        for _ in range(rounds):
+            for n in range(len(identifier) + 1):
+                lsp.modify_source_line(path, 2, '    ' + identifier[:n])
+                done.clear()
+                start = time.perf_counter()
+                lsp.request_completion(path, 2, 4 + n, lambda msg: done.set())
+                if not done.wait(5):
+                    raise RuntimeError("Completion timed out")
+                samples.append(time.perf_counter() - start)
+            lsp.modify_source_line(path, 2, '    ')
+    finally:
+        lsp.shutdown()
+        os.unlink(path)
+    return samples
+
+
+def bench_completion_cache(count: int):
+    rounds = max(1, count // 20)
+    summarize('server per keystroke', type_identifier(False, 'item_1999', rounds))
+    summarize('completion cache', type_identifier(True, 'item_1999', rounds))
+
+
+def synthetic_tokens(count: int) -> List[int]:
+    rng = random.Random(9)
+    data = []
+    for i in range(count):
+        data.extend([1 if i % 8 == 0 else 0, rng.randint(1, 12), rng.randint(1, 20), rng.randint(0, 20),
+                     rng.randint(0, 255)])
+    return data
+
+
+def naive_decode(data: List[int]):
+    # What callers of request_coloring did with the raw result
+    tokens = []
+    line = 0
+    start = 0
+    for i in range(0, len(data), 5):
+        if data[i]:
+            line += data[i]
+            start = 0
+        start += data[i + 1]
+        tokens.append((line, start, data[i + 2], data[i + 3], data[i + 4]))
+    return tokens
+
+
+def timed(function, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000.0
+
+
+def bench_semantic(count: int):
+    tokens = count * 500
+    data = synthetic_tokens(tokens)
+    edits = [{'start': 5 * (tokens // 2), 'deleteCount': 50, 'data': data[:50]}]
+    document = semantic.DocumentTokens('file:///bench.cpp')
+    document.set_data('1', data)
+    rows = document.decoded().lines[-1] + 1
+
+    def decode_and_view():
+        document.set_data('1', data)
+        document.tokens_in_rows(rows // 2, rows // 2 + 60)
+
+    def naive_delta():
+        copy = list(data)
+        copy[edits[0]['start']:edits[0]['start'] + 50] = edits[0]['data']
+        naive_decode(copy)
+
+    def store_delta():
+        document.apply_edits('2', edits)
+        document.tokens_in_rows(rows // 2, rows // 2 + 60)
+
+    backend = 'numpy' if semantic.np is not None else 'array'
+    print(f'{tokens} tokens, {rows} rows, store backend: {backend}')
+    for name, function in (('naive full decode', lambda: naive_decode(data)),
+                           ('store decode + viewport', decode_and_view),
+                           ('store viewport (cached)', lambda: document.tokens_in_rows(rows // 3, rows // 3 + 60)),
+                           ('naive delta + decode', naive_delta),
+                           ('store delta + viewport', store_delta)):
+        ms = timed(function)
+        report(name, best_ms=ms)
+        print(f'{name:<28} {ms:8.3f}ms')
+
+
+def completion_session(lsp: LSPClient, count: int) -> Tuple[List[float], List[dict]]:
+    samples = []
+    responses = []
+    lsp.open_source_file(test_source)
+    for i in range(count):
+        start = time.perf_counter()
+        responses.append(call(lsp, CompletionMessage(test_source, 32, i % 8)))
+        samples.append(time.perf_counter() - start)
+    lsp.close_source_file(test_source)
+    return samples, responses
+
+
+def bench_replay(count: int):
+    # Records a session with logging enabled, then drives the client from the recording
+    folder = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        lsp = LSPClient(test_folder, enable_logging=True, server_command=fake_server_command('--delay', 0.002))
+        try:
+            samples, recorded = completion_session(lsp, count)
+        finally:
+            lsp.shutdown()
+        summarize('recorded (fakeserver)', samples)
+        log_path = os.path.join(folder, 'rpc_session.bin')
+        for name, speed in (('replay original timing', 1), ('replay 10x', 10), ('replay immediate', 0)):
+            lsp = LSPClient(test_folder, server_command=replay_server_command(log_path, '--speed', speed))
+            try:
+                samples, replayed = completion_session(lsp, count)
+            finally:
+                lsp.shutdown()
+            if [r.get('result') for r in replayed] != [r.get('result') for r in recorded]:
+                raise RuntimeError("Replayed responses differ from the recording")
+            summarize(name, samples)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def throughput(name: str, function, count: int, size: int = 0, batch: int = 1):
+    # Runs function count times, each call handles batch messages (or operations) of size bytes in total
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+    elapsed = time.perf_counter() - start
+    report(name, ops_per_s=batch * count / elapsed)
+    line = f'{name:<30} {batch * count / elapsed:12.0f} ops/s'
+    if size:
+        report(name, mb_per_s=size * count / elapsed / 1e6)
+        line += f' {size * count / elapsed / 1e6:10.1f} MB/s'
+    print(line)
+
+
+def legacy_serialize(root: dict) -> bytes:
+    # serialize before the codec layer
+    text = json.dumps(root, separators=(',', ':'))
+    payload = bytes(text, 'ascii')
+    packet = bytearray()
+    packet.extend(bytes(f'Content-Length: {len(payload)}\r\n\r\n', 'ascii'))
+    packet.extend(payload)
+    return bytes(packet)
+
+
+def bench_codec(count: int):
+    items = [{'label': f'item_{i}', 'filterText': f'item_{i}', 'sortText': f'{i:08d}', 'kind': 3,
+              'textEdit': {'newText': f'item_{i}', 'range': {'start': {'line': 1, 'character': 2},
+                                                             'end': {'line': 1, 'character': 4}}}}
+             for i in range(5000)]
+    completion = {'jsonrpc': '2.0', 'id': '1', 'result': {'isIncomplete': False, 'items': items}}
+    tokens = {'jsonrpc': '2.0', 'id': '2', 'result': {'resultId': '1', 'data': synthetic_tokens(50000)}}
+    rounds = count // 10 + 1
+    for name, root in (('completion', completion), ('semantic tokens', tokens)):
+        packet = legacy_serialize(root)
+        body = memoryview(packet)[packet.index(b'\r\n\r\n') + 4:]
+        throughput(f'{name} legacy serialize', lambda: legacy_serialize(root), rounds, len(packet))
+        throughput(f'{name} legacy decode', lambda: json.loads(str(body, 'utf-8')), rounds, len(packet))
+        for backend in codec.available_backends():
+            codec.set_backend(backend)
+            throughput(f'{name} {backend} frame', lambda: codec.frame(root), rounds, len(packet))
+            throughput(f'{name} {backend} decode', lambda: codec.loads(body), rounds, len(packet))
+        codec.set_backend()
+        throughput(f'{name} lazy routing', lambda: codec.decode_message(body, True).get('id'), rounds, len(packet))
+
+
+def bench_throughput(count: int):
+    items = [{'label': f'item_{i}', 'filterText': f'item_{i}', 'sortText': f'{i:08d}', 'kind': 3}
+             for i in range(5000)]
+    large = {'jsonrpc': '2.0', 'id': '1', 'result': {'isIncomplete': False, 'items': items}}
+    packet = serialize(large)
+    throughput('serialize large response', lambda: serialize(large), count // 10 + 1, len(packet))
+
+    def parse(stream: bytes):
+        parser = MessageParser()
+        parser.feed(stream)
+        for _, body in parser.messages():
+            json.loads(str(body, 'utf-8'))
+
+    throughput('frame + parse large response', lambda: parse(packet), count // 10 + 1, len(packet))
+    small = serialize({'jsonrpc': '2.0', 'method': 'textDocument/publishDiagnostics',
+                       'params': {'uri': 'file:///main.cpp', 'diagnostics': []}})
+    throughput('frame + parse notifications', lambda: parse(small * 100), count, len(small) * 100, 100)
+    with tempfile.NamedTemporaryFile('w', suffix='.cpp', delete=False) as f:
+        f.write('\n'.join(generated_source(20000)))
+        path = f.name
+    try:
+        file = FileContent(path)
+        rng = random.Random(3)
+        rows = file.line_count
+        throughput('FileContent line update', lambda: file.update_content_line(rng.randrange(rows), 'int x = 0;'),
+                   count * 10)
+        throughput('FileContent range insert', lambda: file.replace_range(rng.randrange(rows), 0, 0, 0, 'x'),
+                   count * 10)
+        text = file.content
+        throughput('FileContent full update', lambda: file.update_content(text), count // 10 + 1, len(text))
+    finally:
+        os.unlink(path)
+
+
+def bench_load(count: int):
+    # Completion round trips while another thread keeps editing a second document
+    with tempfile.NamedTemporaryFile('w', suffix='.cpp', delete=False) as f:
+        f.write('\n'.join(generated_source(2000)))
+        path = f.name
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--items', 200))
+    stop = threading.Event()
+    edits = [0]
+
+    def edit():
+        rng = random.Random(5)
+        while not stop.is_set():
+            lsp.modify_source_line(path, rng.randrange(2000), f'int edited_{edits[0]} = 0;')
+            edits[0] += 1
+            time.sleep(0.001)
+
+    try:
+        lsp.open_source_file(path)
+        summarize('completion idle', completion_session(lsp, count)[0])
+        lsp.open_source_file(test_source)
+        editor = threading.Thread(target=edit)
+        editor.start()
+        start = time.perf_counter()
+        try:
+            samples = completion_session(lsp, count)[0]
+        finally:
+            stop.set()
+            editor.join()
+        summarize('completion + didChange', samples)
+        report('completion + didChange', edits_per_s=edits[0] / (time.perf_counter() - start))
+    finally:
+        lsp.shutdown()
+        os.unlink(path)
+
+
+def bench_memory(count: int):
+    # Python heap growth per open document, including the client's bookkeeping
+    folder = tempfile.mkdtemp()
+    documents = max(count // 4, 1)
+    paths = []
+    for i in range(documents):
+        path = os.path.join(folder, f'source_{i}.cpp')
+        with open(path, 'w') as f:
+            f.write('\n'.join(generated_source(500)))
+        paths.append(path)
+    size = os.path.getsize(paths[0])
+    lsp = LSPClient(test_folder, server_command=fake_server_command())
+    try:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for path in paths:
+            lsp.open_source_file(path)
+        call(lsp, DocumentTextMessage(paths[-1]))
+        after = tracemalloc.get_traced_memory()[0]
+        per_document = (after - before) / documents
+        report('open document', documents=documents, file_bytes=size, bytes_per_document=per_document)
+        print(f'{documents} documents of {size / 1024:.1f} KB: {per_document / 1024:10.1f} KB per open document')
+        # Closed documents beyond the registry budget are evicted
+        budget = message.max_cached_bytes
+        message.max_cached_bytes = 4 * size
+        for path in paths:
+            lsp.close_source_file(path)
+        call(lsp, DocumentTextMessage(paths[-1]))
+        retained = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        message.max_cached_bytes = budget
+        stats = message.file_stats()
+        report('closed documents', resident_bytes=stats.get('resident_bytes'), evicted=stats.get('evicted'),
+               retained_bytes=retained)
+        print(f'after close: {stats.get("resident_bytes") / 1024:10.1f} KB in the registry, '
+              f'{stats.get("evicted")} evicted, {retained / 1024:10.1f} KB retained')
+    finally:
+        lsp.shutdown()
+        for path in paths:
+            os.unlink(path)
+        os.rmdir(folder)
+
+
+def bench_startup(count: int):
+    samples = []
+    for _ in range(max(count // 20, 1)):
+        start = time.perf_counter()
+        lsp = LSPClient(test_folder, server_command=fake_server_command())
+        samples.append(time.perf_counter() - start)
+        lsp.shutdown()
+    summarize('start to initialized', samples)
+    pool = StandbyPool(max_idle=1, server_command=fake_server_command())
+    samples = []
+    try:
+        pool.prepare(test_folder)
+        for _ in range(max(count // 20, 1)):
+            # Give the replacement standby time to initialize, as between projects being opened
+            time.sleep(0.2)
+            start = time.perf_counter()
+            lsp = pool.acquire(test_folder)
+            samples.append(time.perf_counter() - start)
+            lsp.shutdown()
+    finally:
+        pool.shutdown()
+    summarize('standby acquire', samples)
+
+
+def bench_priority(count: int):
+    # Completion round trips sent behind a burst of background requests, once queued in order
+    # with the burst and once as interactive requests
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--items', 20))
+    burst = 2000
+    try:
+        lsp.open_source_file(test_source)
+        for name, priority in (('completion behind burst', priority_background),
+                               ('prioritized completion', None)):
+            samples = []
+            for _ in range(max(count // 10, 1)):
+                finished = threading.Semaphore(0)
+                for i in range(burst):
+                    lsp.send_request(WorkspaceSymbolMessage(f'symbol_{i}'), lambda msg: finished.release())
+                done = threading.Event()
+                start = time.perf_counter()
+                lsp.send_request(CompletionMessage(test_source, 32, 3), lambda msg: done.set(), priority=priority)
+                if not done.wait(10):
+                    raise RuntimeError("Completion timed out")
+                samples.append(time.perf_counter() - start)
+                for _ in range(burst):
+                    finished.acquire()
+            summarize(name, samples)
+        stats = lsp.get_queue_stats()
+        for name in ('interactive', 'background'):
+            report(f'{name} queue wait', **{k: v for k, v in stats.get(name).items() if k != 'buckets'})
+            print(f'{name + " queue wait":<24} n={stats.get(name).get("count"):<5} '
+                  f'mean={stats.get(name).get("mean_ms"):8.3f}ms p99={stats.get(name).get("p99_ms"):8.3f}ms')
+    finally:
+        lsp.shutdown()
+
+
+def bench_bulk_open(count: int):
+    # Opening a workspace of small files one by one and through open_source_files, until the
+    # server has seen every document
+    folder = tempfile.mkdtemp()
+    documents = max(count * 5, 10)
+    try:
+        for name in ('open_source_file loop', 'open_source_files'):
+            paths = []
+            for i in range(documents):
+                path = os.path.join(folder, f'{name.split()[0]}_{i}.cpp')
+                with open(path, 'w') as f:
+                    f.write('\n'.join(generated_source(200)))
+                paths.append(path)
+            lsp = LSPClient(test_folder, server_command=fake_server_command())
+            try:
+                start = time.perf_counter()
+                if name == 'open_source_files':
+                    lsp.open_source_files(paths)
+                else:
+                    for path in paths:
+                        lsp.open_source_file(path)
+                returned = time.perf_counter() - start
+                call(lsp, DocumentTextMessage(paths[-1]))
+                elapsed = time.perf_counter() - start
+            finally:
+                lsp.shutdown()
+            report(name, documents=documents, seconds=elapsed, documents_per_s=documents / elapsed,
+                   returned_seconds=returned)
+            print(f'{name:<24} {documents} documents in {elapsed * 1000:8.1f}ms {documents / elapsed:10.0f}/s, '
+                  f'returned after {returned * 1000:8.1f}ms')
+    finally:
+        shutil.rmtree(folder)
+
+
+def start_daemon(socket_path: str, *server_args) -> subprocess.Popen:
+    daemon = subprocess.Popen([sys.executable, '-m', f'{__package__}.daemon', '--socket', socket_path, '--'] +
+                              fake_server_command(*server_args), cwd=os.path.dirname(package_folder))
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socket_path):
+        if time.monotonic() > deadline or daemon.poll() is not None:
+            daemon.kill()
+            raise RuntimeError("Daemon did not start")
+        time.sleep(0.01)
+    return daemon
+
+
+def bench_daemon(count: int):
+    # Several clients of one root folder, each with its own server and attached to one daemon
+    clients = 4
+    folder = tempfile.mkdtemp()
+    socket_path = os.path.join(folder, 'daemon.sock')
+    daemon = start_daemon(socket_path, '--items', 20)
+    try:
+        for name, daemon_socket in (('own servers', ''), ('daemon', socket_path)):
+            start = time.perf_counter()
+            lsps = [LSPClient(test_folder, server_command=fake_server_command('--items', 20),
+                              daemon_socket=daemon_socket) for _ in range(clients)]
+            report(f'{name} start', seconds=time.perf_counter() - start, servers=1 if daemon_socket else clients)
+            samples = []
+            try:
+                def session(lsp: LSPClient):
+                    samples.extend(completion_session(lsp, count)[0])
+
+                threads = [threading.Thread(target=session, args=(lsp,)) for lsp in lsps]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                for lsp in lsps:
+                    lsp.shutdown()
+            summarize(f'{name} completion', samples)
+        # A later client finds the server initialized
+        samples = []
+        for _ in range(max(count // 20, 1)):
+            start = time.perf_counter()
+            lsp = LSPClient(test_folder, daemon_socket=socket_path)
+            samples.append(time.perf_counter() - start)
+            lsp.shutdown()
+        summarize('attach to running server', samples)
+    finally:
+        daemon.terminate()
+        daemon.wait(10)
+        shutil.rmtree(folder)
+
+
+def bench_query_cache(count: int):
+    # Definition lookups revisiting 20 positions, with an edit every 50 lookups
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--delay', 0.001))
+    try:
+        lsp.open_source_file(test_source)
+        for name, cache in (('definition', None), ('definition cached', QueryCache())):
+            lsp.set_query_cache(cache)
+            rng = random.Random(11)
+            samples = []
+            for i in range(count):
+                if i % 50 == 49:
+                    lsp.modify_source_line(test_source, 40, f'int edited_{i} = 0;')
+                done = threading.Event()
+                start = time.perf_counter()
+                lsp.request_definition(test_source, rng.randrange(20), 3, lambda msg: done.set())
+                if not done.wait(5):
+                    raise RuntimeError("Definition timed out")
+                samples.append(time.perf_counter() - start)
+            summarize(name, samples)
+            if cache is not None:
+                report(name, hit_rate=cache.get_stats().get('hit_rate'))
+                print(f'{"":<24} hit rate {cache.get_stats().get("hit_rate"):.2f}')
+        # Identical lookups issued together share one server request
+        cache = QueryCache()
+        lsp.set_query_cache(cache)
+        finished = threading.Semaphore(0)
+        for i in range(count):
+            lsp.request_definition(test_source, 30 + i % 4, 1, lambda msg: finished.release())
+        for _ in range(count):
+            finished.acquire()
+        stats = cache.get_stats()
+        report('burst', requests=count, joined=stats.get('joined'), hits=stats.get('hits'))
+        print(f'{count} burst lookups: {stats.get("joined")} joined in flight, {stats.get("hits")} hits, '
+              f'{count - stats.get("joined") - stats.get("hits")} sent')
+        lsp.close_source_file(test_source)
+    finally:
+        lsp.shutdown()
+
+
+def bench_batch(count: int):
+    # Definition and completion queries walking through a folder of files, ten per file, one at a
+    # time and through batch_query with a few windows
+    folder = tempfile.mkdtemp()
+    queries = max(count * 5, 20)
+    try:
+        paths = []
+        for i in range((queries + 9) // 10):
+            path = os.path.join(folder, f'batch_{i}.cpp')
+            with open(path, 'w') as f:
+                f.write('\n'.join(generated_source(200)))
+            paths.append(path)
+        stream = [(paths[i // 10], i % 200, 3, 'completion' if i % 2 else 'definition') for i in range(queries)]
+        lsp = LSPClient(test_folder, server_command=fake_server_command('--delay', 0.0002))
+        try:
+            start = time.perf_counter()
+            for path, row, col, kind in stream:
+                if not lsp.is_open_file(path):
+                    for other in [p for p in paths if lsp.is_open_file(p)]:
+                        lsp.close_source_file(other)
+                    lsp.open_source_file(path)
+                msg = CompletionMessage(path, row, col) if kind == 'completion' else \
+                    PositionalMessage('textDocument/definition', path, row, col)
+                call(lsp, msg)
+            elapsed = time.perf_counter() - start
+            for path in paths:
+                lsp.close_source_file(path)
+            report('sequential', queries=queries, seconds=elapsed, queries_per_s=queries / elapsed)
+            print(f'{"sequential":<24} {queries} queries in {elapsed * 1000:8.1f}ms {queries / elapsed:10.0f}/s')
+            for window, ordered in ((1, True), (16, True), (64, True), (64, False)):
+                name = f'window {window}{"" if ordered else " unordered"}'
+                batch = lsp.batch_query(stream, window=window, ordered=ordered, max_open=4)
+                start = time.perf_counter()
+                results = list(batch)
+                elapsed = time.perf_counter() - start
+                stats = batch.get_stats()
+                if len(results) != queries or stats.get('failed') or stats.get('timed_out'):
+                    raise RuntimeError(f"Batch failed: {stats}")
+                report(name, queries=queries, seconds=elapsed, queries_per_s=queries / elapsed,
+                       max_outstanding=stats.get('max_outstanding'), opened=stats.get('opened'))
+                print(f'{name:<24} {queries} queries in {elapsed * 1000:8.1f}ms {queries / elapsed:10.0f}/s, '
+                      f'{stats.get("opened")} documents opened, max outstanding {stats.get("max_outstanding")}')
+        finally:
+            lsp.shutdown()
+    finally:
+        shutil.rmtree(folder)
+
+
+benchmarks: Dict[str, Callable[[int], None]] = {
+    'latency': bench_latency,
+    'framing': bench_framing,
+    'sync': bench_sync,
+    'completion-cache': bench_completion_cache,
+    'semantic': bench_semantic,
+    'replay': bench_replay,
+    'codec': bench_codec,
+    'throughput': bench_throughput,
+    'load': bench_load,
+    'memory': bench_memory,
+    'startup': bench_startup,
+    'priority': bench_priority,
+    'bulk-open': bench_bulk_open,
+    'daemon': bench_daemon,
+    'query-cache': bench_query_cache,
+    'batch': bench_batch,
+}
+
+
+def environment() -> Dict[str, str]:
+    info = {'python': sys.version.split()[0], 'platform': sys.platform, 'json': codec.backend,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=package_folder, capture_output=True,
+                                        text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description='lspclient benchmarks')
+    parser.add_argument('names', nargs='*', help=f'Benchmarks to run: {", ".join(benchmarks)}')
+    parser.add_argument('-n', '--count', type=int, default=200, help='Iterations per benchmark')
+    parser.add_argument('--json', help='Write the results to this file, - for stdout')
+    args = parser.parse_args()
+    global current_benchmark
+    # Keep stdout clean when the JSON goes there
+    with contextlib.redirect_stdout(sys.stderr if args.json == '-' else sys.stdout):
+        for name in args.names or benchmarks:
+            if name not in benchmarks:
+                raise RuntimeError(f"Unknown benchmark {name}")
+            current_benchmark = name
+            benchmarks.get(name)(args.count)
+    if args.json:
+        output = {'environment': environment(), 'count': args.count, 'results': results}
+        if args.json == '-':
+            json.dump(output, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,28 @@
+import os
 import struct
+import threading
+import time
+import zlib
+from collections import deque
+from typing import BinaryIO, Deque, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# v1 files are a bare sequence of (tag, length, data) records.
+# v2 files start with a header and hold blocks of timestamped records, optionally compressed.
+v2_magic = b'LSPBLOG2'
+file_header = struct.Struct('<8sHH')
+block_header = struct.Struct('<III')
+record_header = struct.Struct('<qBHI')
+v1_record_header = struct.Struct('II')
+
+compression_none = 0
+compression_zlib = 1
+compression_zstd = 2
+compression_names = {'': compression_none, 'zlib': compression_zlib, 'zstd': compression_zstd}
 
 
 def flush_write(stream, data):
@@ -9,19 +33,191 @@ def flush_write(stream, data):
     stream.flush()
 
 
+class LogRecord:
+    __slots__ = ('timestamp', 'direction', 'message_id', 'data')
+
+    def __init__(self, timestamp: Optional[int], direction: int, message_id: Optional[str], data: bytes):
+        # timestamp is time.monotonic_ns() when the record was added, None for v1 records
+        self.timestamp = timestamp
+        self.direction = direction
+        self.message_id = message_id
+        self.data = data
+
+
+def compress_block(data: bytes, compression: int) -> bytes:
+    if compression == compression_zlib:
+        return zlib.compress(data, 1)
+    if compression == compression_zstd:
+        return zstandard.ZstdCompressor(level=1).compress(data)
+    return data
+
+
+def decompress_block(data: bytes, compression: int) -> bytes:
+    if compression == compression_zlib:
+        return zlib.decompress(data)
+    if compression == compression_zstd:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this log")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
 class BinaryLog:
-    def __init__(self, filename: str):
-        self._log_file = open(filename, 'wb')
+    # Records are queued by add() and written in blocks by a background thread.
+    # When max_pending records or max_pending_bytes of record data are waiting, new records are
+    # dropped and counted.
+    def __init__(self, filename: str, compression: str = '', max_bytes: int = 0, backup_count: int = 3,
+                 block_size: int = 1 << 16, max_pending: int = 65536, fsync_interval: float = 5.0,
+                 max_pending_bytes: int = 64 << 20):
+        if compression not in compression_names:
+            raise RuntimeError(f"Unknown compression {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard package")
+        self._filename = filename
+        self._compression = compression_names.get(compression)
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._block_size = block_size
+        self._max_pending = max_pending
+        self._max_pending_bytes = max_pending_bytes
+        self._pending_bytes = 0
+        self._fsync_interval = fsync_interval
+        self._pending: Deque[Tuple[int, int, bytes, bytes]] = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+        self._log_file: Optional[BinaryIO] = None
+        self._file_size = 0
+        self._open()
+        self._thread = threading.Thread(target=self._writer_thread, daemon=True)
+        self._thread.start()
 
-    def add(self, data: bytes, tag: int):
-        if self._log_file is not None:
-            block = bytearray(8 + len(data))
-            struct.pack_into('I', block, 0, tag)
-            struct.pack_into('I', block, 4, len(data))
-            block[8:] = data
-            flush_write(self._log_file, block)
+    def _open(self):
+        self._log_file = open(self._filename, 'wb')
+        header = file_header.pack(v2_magic, 2, self._compression)
+        self._log_file.write(header)
+        self._file_size = len(header)
+
+    def _rotate(self):
+        self._log_file.close()
+        for i in range(self._backup_count - 1, 0, -1):
+            source = f'{self._filename}.{i}'
+            if os.path.exists(source):
+                os.replace(source, f'{self._filename}.{i + 1}')
+        if self._backup_count > 0:
+            os.replace(self._filename, f'{self._filename}.1')
+        self._open()
+
+    def add(self, data: bytes, tag: int, message_id=None):
+        timestamp = time.monotonic_ns()
+        encoded_id = b'' if message_id is None else str(message_id).encode('utf-8')
+        with self._condition:
+            if self._closed:
+                return
+            size = len(encoded_id) + len(data)
+            if len(self._pending) >= self._max_pending or self._pending_bytes + size > self._max_pending_bytes:
+                self.dropped += 1
+                return
+            self._pending.append((timestamp, tag, encoded_id, bytes(data)))
+            self._pending_bytes += size
+            if len(self._pending) == 1:
+                self._condition.notify()
+
+    def _take_block(self) -> List[Tuple[int, int, bytes, bytes]]:
+        records = []
+        size = 0
+        while self._pending and size < self._block_size:
+            record = self._pending.popleft()
+            records.append(record)
+            size += record_header.size + len(record[2]) + len(record[3])
+            self._pending_bytes -= len(record[2]) + len(record[3])
+        return records
+
+    def _write_block(self, records: List[Tuple[int, int, bytes, bytes]]):
+        parts = []
+        for timestamp, tag, encoded_id, data in records:
+            parts.append(record_header.pack(timestamp, tag, len(encoded_id), len(data)))
+            parts.append(encoded_id)
+            parts.append(data)
+        raw = b''.join(parts)
+        payload = compress_block(raw, self._compression)
+        block = block_header.pack(len(payload), len(raw), len(records)) + payload
+        flush_write(self._log_file, block)
+        self._file_size += len(block)
+        if self._max_bytes and self._file_size >= self._max_bytes:
+            self._rotate()
+
+    def _writer_thread(self):
+        last_sync = time.monotonic()
+        unsynced = False
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    timeout = None
+                    if unsynced:
+                        timeout = last_sync + self._fsync_interval - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    self._condition.wait(timeout)
+                records = self._take_block()
+                closed = self._closed and not self._pending
+            if records:
+                self._write_block(records)
+                unsynced = True
+            now = time.monotonic()
+            if unsynced and (closed or now - last_sync >= self._fsync_interval):
+                os.fsync(self._log_file.fileno())
+                last_sync = now
+                unsynced = False
+            if closed:
+                return
+            if records:
+                # Let small bursts accumulate into a larger block
+                with self._condition:
+                    if len(self._pending) < 64 and not self._closed:
+                        self._condition.wait(0.01)
 
     def shutdown(self):
         if self._log_file is not None:
+            with self._condition:
+                self._closed = True
+                self._condition.notify()
+            self._thread.join()
             self._log_file.close()
             self._log_file = None
+
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise RuntimeError("Truncated log")
+    return data
+
+
+def read_log(path: str) -> Iterator[LogRecord]:
+    # Yields the records of a v1 or v2 log
+    with open(path, 'rb') as f:
+        start = f.read(file_header.size)
+        if len(start) == file_header.size and start[:len(v2_magic)] == v2_magic:
+            _, version, compression = file_header.unpack(start)
+            while True:
+                header = f.read(block_header.size)
+                if len(header) < block_header.size:
+                    return
+                size, raw_size, count = block_header.unpack(header)
+                raw = decompress_block(_read_exact(f, size), compression)
+                pos = 0
+                for _ in range(count):
+                    timestamp, direction, id_size, data_size = record_header.unpack_from(raw, pos)
+                    pos += record_header.size
+                    message_id = raw[pos:pos + id_size].decode('utf-8') if id_size else None
+                    pos += id_size
+                    yield LogRecord(timestamp, direction, message_id, raw[pos:pos + data_size])
+                    pos += data_size
+        f.seek(0)
+        while True:
+            header = f.read(v1_record_header.size)
+            if len(header) < v1_record_header.size:
+                return
+            direction, size = v1_record_header.unpack(header)
+            yield LogRecord(None, direction, None, _read_exact(f, size))
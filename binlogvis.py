@@ -1,29 +1,27 @@
-import re
-import struct
 import sys
 import json
-from typing import List
 
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTextEdit, QDockWidget, QListWidget, QMessageBox
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
+from PyQt5.QtWidgets import QApplication, QMainWindow, QTextEdit, QDockWidget, QListView, QMessageBox
 
-header_pattern = r'Content-Length: (\d+)\W\W\W\W'
+from logreader import LogReader
 
 
-def split_data(data: bytes) -> List[bytes]:
-    res = []
-    while len(data) > 0:
-        s = data.decode('utf-8')
-        m = re.match(header_pattern, s)
-        if not m:
-            raise RuntimeError("Invalid data")
-        header_size = m.regs[0][1]
-        data_size = int(m.groups()[0])
-        if len(data) < (data_size + header_size):
-            raise RuntimeError('Item size does not match header')
-        res.append(data[0:(header_size + data_size)])
-        data = data[(header_size + data_size):]
-    return res
+class LogModel(QAbstractListModel):
+    # Rows are read from the log only when the view shows them
+    def __init__(self, reader: LogReader):
+        super().__init__()
+        self.reader = reader
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.reader)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        entry = self.reader[index.row()]
+        dir_str = '>' if entry.direction > 0 else '<'
+        return f'{dir_str} {entry.index} {entry.method or ""}'
 
 
 class MainWindow(QMainWindow):
@@ -32,62 +30,39 @@ class MainWindow(QMainWindow):
         self.text = QTextEdit()
         self.setCentralWidget(self.text)
         dock = QDockWidget()
-        self.item_list = QListWidget()
+        self.item_list = QListView()
+        # Rows all have the same height, the view doesn't ask for every row to lay them out
+        self.item_list.setUniformItemSizes(True)
         dock.setWidget(self.item_list)
         dock.setAllowedAreas(Qt.LeftDockWidgetArea)
         self.addDockWidget(Qt.LeftDockWidgetArea, dock)
-        self.items = []
-        self.item_list.currentItemChanged.connect(self.on_select)
+        self.reader = None
+        self.model = None
 
     def load_items(self, path):
-        with open(path, 'rb') as f:
-            f.seek(0, 2)
-            size = f.tell()
-            f.seek(0, 0)
-            pos = 0
-            while pos < size:
-                header = f.read(8)
-                if len(header)!=8:
-                    QMessageBox(self,'Error',"Failed to read header")
-                direction, item_size = struct.unpack('II', header)
-                print(f'{pos}: {item_size}')
-                data = bytearray()
-                left = item_size
-                while left > 0:
-                    cur = f.read(left)
-                    data.extend(cur)
-                    left -= len(cur)
-                for item in split_data(data):
-                    self.items.append((direction, item))
-                pos += 8 + item_size
+        previous = self.reader
+        self.reader = LogReader(path)
         self.update_list()
+        if previous is not None:
+            previous.close()
 
     def update_list(self):
-        self.item_list.clear()
-        index = 0
-        for direction, item in self.items:
-            dir_str = '>' if direction > 0 else '<'
-            self.item_list.addItem(f'{dir_str} {index}')
-            index += 1
+        self.model = LogModel(self.reader)
+        self.item_list.setModel(self.model)
+        self.item_list.selectionModel().currentChanged.connect(self.on_select)
 
     def on_select(self):
-        index = self.item_list.currentRow()
-        direction, data = self.items[index]
-        s = data.decode('utf-8')
-        m = re.match(header_pattern, s)
-        if not m:
-            QMessageBox.critical(self, 'Error', 'Invalid item header')
+        index = self.item_list.currentIndex().row()
+        if self.reader is None or index < 0:
+            return
+        body = self.reader[index].body()
+        try:
+            json_data = json.loads(str(body, 'utf-8'))
+        except ValueError as e:
+            self.text.setText(str(body, 'utf-8', 'replace'))
+            QMessageBox.critical(self, 'Error', f'Invalid item: {e}')
         else:
-            header_size = m.regs[0][1]
-            data_size = int(m.groups()[0])
-            if len(data) != (data_size + header_size):
-                self.text.setText(s)
-                QMessageBox.critical(self, 'Error',
-                                     f'Item size ({len(data)}) does not match header {data_size + header_size}')
-            else:
-                json_data = json.loads(s[header_size:])
-                text = json.dumps(json_data, indent=4, sort_keys=True)
-                self.text.setText(text)
+            self.text.setText(json.dumps(json_data, indent=4, sort_keys=True))
 
 
 def main():
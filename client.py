@@ -1,77 +1,133 @@
 import subprocess as sp
 import fcntl
+import selectors
 import time
+import heapq
 import shutil
 import signal
-import re
+import socket
+import traceback
 from io import TextIOWrapper, BufferedWriter
-from queue import Queue
-from typing import Dict, Tuple, Optional, IO, BinaryIO
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Tuple, Optional, IO, BinaryIO
+from . import codec
+from .batch import BatchQuery, QueryBatch
 from .binarylog import BinaryLog
+from .framing import MessageParser
+from .outgoing import OutgoingScheduler, SendCounters, coalesce, priority_interactive, write_all
+from .documents import DocumentTracker
+from .metrics import ClientMetrics
 from .message import *
+from .querycache import query_key
+from .semantic import DocumentTokens
 
 
 def pretty(msg):
     return json.dumps(msg, indent=4, sort_keys=True)
 
 
+def copy_compile_commands(source: str, root_folder: str):
+    # Skips the copy when the root folder already has an up to date copy
+    target = os.path.join(root_folder, 'compile_commands.json')
+    if os.path.exists(target):
+        if os.path.samefile(source, target):
+            return
+        source_stat = os.stat(source)
+        target_stat = os.stat(target)
+        if source_stat.st_size == target_stat.st_size and source_stat.st_mtime <= target_stat.st_mtime:
+            return
+    shutil.copy(source, root_folder)
+
+
 def default_sigpipe():
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 
-header_pattern = r'Content-Length: (\d+)\W'
 msg_log: Optional[IO] = None  # open('msg.log', 'w')
 
 
-def read_message(stream):
-    header_data = stream.read(28)
-    if header_data is None or len(header_data) == 0:
-        return None
-    m = re.match(header_pattern, header_data.decode('utf-8'))
-    if not m:
-        raise RuntimeError("Invalid packet")
-    header_size = m.regs[0][1] + 3
-    if msg_log:
-        msg_log.write(f'header_size={header_size} ')
-    data_size = int(m.groups()[0])
-    orig_data_size = data_size
-    if msg_log:
-        msg_log.write(f'data_size={data_size}\n')
-    accumulator = bytearray(header_data)
-    if len(header_data) > header_size:
-        data_size -= len(header_data) - header_size
-    while data_size > 0:
-        cur = stream.read(data_size)
-        if msg_log:
-            msg_log.write(f'read {len(cur)} bytes\n')
-        accumulator.extend(cur)
-        data_size -= len(cur)
-    res = bytes(accumulator)
-    if msg_log:
-        notes = ''
-        if len(res) != (header_size + orig_data_size):
-            notes = '+++++++++++++++++++++++++++++'
-        msg_log.write(
-            f'Total message {len(res)} vs {header_size}+{orig_data_size} = {header_size + orig_data_size} {notes}\n')
-        msg_log.flush()
-    return res
+class SocketStream:
+    # The part of a pipe file RPCClient uses, close() is the given function
+    def __init__(self, sock: socket.socket, close: callable):
+        self._socket = sock
+        self.close = close
+
+    def fileno(self) -> int:
+        return self._socket.fileno()
+
+
+class DaemonProcess:
+    # Takes the place of the server process when attached to a daemon, see daemon.py.
+    # The socket is both stdin and stdout, stderr is a pipe that is closed right away.
+    def __init__(self, socket_path: str):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(socket_path)
+        except OSError:
+            self._socket.close()
+            raise
+        # Closing stdin detaches from the daemon, stdout is closed last
+        self.stdin = SocketStream(self._socket, lambda: self._shutdown(socket.SHUT_WR))
+        self.stdout = SocketStream(self._socket, self._socket.close)
+        stderr_read, stderr_write = os.pipe()
+        os.close(stderr_write)
+        self.stderr = os.fdopen(stderr_read, 'rb')
+
+    def _shutdown(self, how: int):
+        try:
+            self._socket.shutdown(how)
+        except OSError:
+            pass
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        return 0
+
+    def kill(self):
+        self._shutdown(socket.SHUT_RDWR)
 
 
 class RPCClient:
-    def __init__(self, enable_logging=False):
-        self._process = sp.Popen(['clangd'], stdout=sp.PIPE, stdin=sp.PIPE,
-                                 stderr=sp.PIPE)  # , preexec_fn=default_sigpipe)
+    # Set by enable_metrics(), every hook is skipped while this is None
+    metrics: Optional[ClientMetrics] = None
+    # When set, large responses are handed to handlers as codec.LazyResponse, parsed on first access.
+    # Off by default, a LazyResponse is a Mapping but not a dict and json.dumps can't serialize it.
+    lazy_decoding = False
+    # Producers block in send_message while this many messages wait for the writer
+    max_outgoing = 4096
+
+    def __init__(self, enable_logging=False, server_command: Optional[List[str]] = None,
+                 daemon_socket: str = ''):
+        # With a daemon socket the client attaches to the daemon's server, server_command only
+        # applies when no daemon is listening there
+        self._process = None
+        if daemon_socket:
+            try:
+                self._process = DaemonProcess(daemon_socket)
+            except OSError:
+                pass
+        if self._process is None:
+            if not server_command:
+                server_command = ['clangd']
+            self._process = sp.Popen(server_command, stdout=sp.PIPE, stdin=sp.PIPE,
+                                     stderr=sp.PIPE)  # , preexec_fn=default_sigpipe)
         # self.process = sp.Popen(['ccls'], stdout=sp.PIPE, stdin=sp.PIPE, stderr=sp.PIPE)
         fcntl.fcntl(self._process.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
         fcntl.fcntl(self._process.stderr.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
         self._rpc_log: Optional[TextIOWrapper] = None
         self._bin_log:Optional[BinaryLog] = None
         if enable_logging:
             self._rpc_log = open('rpc.log', 'w')
             self._bin_log = BinaryLog('rpc_session.bin')
-        self._buffer = bytearray()
-        self._outgoing = Queue()
+        self._parser = MessageParser()
+        self._outgoing = OutgoingScheduler(self.max_outgoing)
+        self._send_counters = SendCounters()
         self._terminating = False
+        # Writes to the server's stdin may block, they never run on the RPC thread
+        self._writer = threading.Thread(target=self.writer_thread, daemon=True)
+        self._writer.start()
         self._thread = threading.Thread(target=self.rpc_thread)
         self._thread.start()
 
@@ -84,74 +140,163 @@ class RPCClient:
             self._rpc_log.write('\n')
             self._rpc_log.flush()
 
-    def send_message(self, msg: Message):
+    def send_message(self, msg: Message, priority: Optional[int] = None):
+        # priority is one of the outgoing.priority_* classes, by default derived from the method.
+        # Handlers run on the RPC thread, which must keep reading, so it never blocks on a full queue
         # self.add_log(True, pretty(msg.root))
-        self._outgoing.put(msg)
+        self._outgoing.put(msg, priority, threading.current_thread() is not self._thread)
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except (BlockingIOError, OSError):
+            # A full pipe already guarantees a pending wakeup, a closed one means we're done
+            pass
 
     def shutdown(self):
         if not self._terminating:
+            # The writer sends what is still queued (didClose, shutdown, exit), then closes stdin
+            self._outgoing.close(drain=True)
+            self._writer.join(3)
             try:
-                self._process.stdin.close()
                 self._process.wait(3)
             except sp.TimeoutExpired:
                 pass
             self._terminating = True
+            self.wakeup()
             self._thread.join()
+            self._process.stdout.close()
+            self._process.stderr.close()
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+            if self._bin_log:
+                self._bin_log.shutdown()
+
+    def abort(self):
+        # Shutdown for a server that stopped responding, it is killed instead of waited for
+        if not self._terminating:
+            self._process.kill()
+        self.shutdown()
 
     def rpc_thread(self):
         # fb = open('rpc_out.log', 'wb')
         fi : Optional[BinaryIO] = None
         if self._rpc_log:
             fi = open('rpc_in.log', 'wb')
+        stdout_fd = self._process.stdout.fileno()
+        stderr_fd = self._process.stderr.fileno()
+        selector = selectors.DefaultSelector()
+        selector.register(stdout_fd, selectors.EVENT_READ)
+        selector.register(stderr_fd, selectors.EVENT_READ)
+        selector.register(self._wakeup_read, selectors.EVENT_READ)
         try:
             while not self._terminating:
-                wait = True
-                data = self._process.stderr.read(65536)
-                if data:
-                    self.add_log(False, data.decode('utf-8'))
-                data = read_message(self._process.stdout)
-                if data:
-                    if fi:
-                        fi.write(data)
-                        fi.flush()
-                    wait = False
-                    if msg_log:
-                        msg_log.write(f'Writing to bin log {len(data)} incoming bytes\n')
-                    if self._bin_log:
-                        self._bin_log.add(data, 0)
-                    self._buffer.extend(data)
-                    self.process_buffer()
-                while not self._outgoing.empty():
-                    wait = False
-                    msg = self._outgoing.get()
-                    if not self._terminating:
-                        data = serialize(msg.root)
-                        if msg_log:
-                            msg_log.write(f'Writing to bin log {len(data)} outgoing bytes\n')
-                        if self._bin_log:
-                            self._bin_log.add(data, 1)
-                        self._process.stdin.write(data)
-                        self._process.stdin.flush()
-                if wait:
-                    time.sleep(0.01)
-        except ValueError:
+                for key, _ in selector.select(self.poll_timeout()):
+                    fd = key.fd
+                    if fd == self._wakeup_read:
+                        self.drain_wakeup()
+                    elif fd == stderr_fd:
+                        data = self.read_available(stderr_fd)
+                        if data:
+                            self.add_log(False, data.decode('utf-8', errors='replace'))
+                        elif data is not None:
+                            selector.unregister(stderr_fd)
+                    else:
+                        data = self._parser.read_from(stdout_fd)
+                        if data:
+                            if fi:
+                                fi.write(data)
+                                fi.flush()
+                            self.process_buffer()
+                        elif data is not None:
+                            # Server closed its output, nothing more will arrive
+                            selector.unregister(stdout_fd)
+                self.handle_timeouts()
+        except (ValueError, OSError):
+            pass
+        finally:
+            selector.close()
+            if fi:
+                fi.close()
+
+    def poll_timeout(self) -> Optional[float]:
+        return None
+
+    def handle_timeouts(self):
+        pass
+
+    @staticmethod
+    def read_available(fd: int) -> Optional[bytes]:
+        try:
+            return os.read(fd, 65536)
+        except BlockingIOError:
+            return None
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except BlockingIOError:
             pass
 
+    def writer_thread(self):
+        try:
+            while True:
+                messages = self._outgoing.take()
+                if not messages:
+                    break
+                self.write_messages(messages)
+        except (ValueError, OSError):
+            # The server is gone, producers must not wait for a writer that stopped
+            self._outgoing.close()
+        finally:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+
+    def write_messages(self, messages: List[Message]):
+        self._send_counters.queued += len(messages)
+        buffers = []
+        sent = coalesce(messages, self._send_counters)
+        for msg in sent:
+            # Header and payload go out as separate buffers, the packet is never joined
+            header, payload = codec.frame(msg.root)
+            if msg_log:
+                msg_log.write(f'Writing to bin log {len(header) + len(payload)} outgoing bytes\n')
+            if self._bin_log:
+                self._bin_log.add(header + payload, 1, msg.root.get('id'))
+            buffers.append(header)
+            buffers.append(payload)
+        size = write_all(self._process.stdin.fileno(), buffers)
+        self._send_counters.bytes += size
+        self._send_counters.written += len(sent)
+        self._send_counters.writes += 1
+        if self.metrics is not None:
+            self.metrics.messages_written([msg.root.get('id') for msg in sent if 'id' in msg.root],
+                                          len(sent), size)
+
+    def queue_depth(self) -> int:
+        return len(self._outgoing)
+
+    def get_send_counters(self) -> Dict[str, int]:
+        return self._send_counters.as_dict()
+
+    def get_queue_stats(self) -> Dict[str, dict]:
+        # Time messages waited for the writer, per priority class
+        return self._outgoing.get_stats()
+
     def process_buffer(self):
-        while True:
-            pos = self._buffer.find(b'Content-Length: ')
-            if pos < 0:
-                break
-            end_pos = self._buffer.find(b'\r\n\r\n', pos + 16)
-            if end_pos < 0:
-                break
-            length = int(self._buffer[pos + 16:end_pos].decode('ascii'))
-            if len(self._buffer) < (end_pos + 4 + length):
-                break
-            msg = self._buffer[end_pos + 4:end_pos + 4 + length]
-            del self._buffer[:end_pos + 4 + length]
-            text = msg.decode('utf-8')
-            json_msg = json.loads(text)
+        # Bodies are views into the parser's buffer and decoded from there with orjson. Lazy responses
+        # outlive the buffer and copy their body, the json and ujson backends copy it to parse it.
+        for frame, body in self._parser.messages():
+            json_msg = codec.decode_message(body, self.lazy_decoding)
+            if self.metrics is not None:
+                self.metrics.message_received(len(frame))
+            if msg_log:
+                msg_log.write(f'Writing to bin log {len(frame)} incoming bytes\n')
+            if self._bin_log:
+                self._bin_log.add(frame, 0, json_msg.get('id'))
             # self.add_log(False, pretty(json_msg))
             self.process_incoming(json_msg)
 
@@ -159,100 +304,404 @@ class RPCClient:
         raise RuntimeError("Not implemented")
 
 
-class LSPClient(RPCClient):
-    def __init__(self, root_folder, compile_commands_path: str = '', enable_logging=False):
-        super().__init__(enable_logging)
-        if compile_commands_path:
-            shutil.copy(compile_commands_path, root_folder)
-        self.capabilities = {}
+class RequestHandle:
+    def __init__(self, client: 'LSPClient', message_id: str):
+        self._client = client
+        self.message_id = message_id
+
+    @property
+    def pending(self):
+        return self.message_id in self._client.transactions
+
+    def cancel(self) -> bool:
+        return self._client.cancel_request(self.message_id)
+
+
+class LSPClient(RPCClient, DocumentTracker):
+    superseded_methods = default_superseded_methods
+
+    def __init__(self, root_folder, compile_commands_path: str = '', enable_logging=False,
+                 server_command: Optional[List[str]] = None, wait: bool = True, init_timeout: Optional[float] = 10.0,
+                 daemon_socket: Optional[str] = None):
+        # With wait=False the constructor returns right away, startup resolves to the client once the
+        # server is initialized and messages sent before that are held back until then
+        # Used by the RPC thread, which starts in RPCClient.__init__
+        self.transactions: Dict[str, callable] = {}
+        self._transactions_lock = threading.Lock()
+        self._deadlines: List[Tuple[float, str]] = []
+        self._latest_requests: Dict[Tuple[str, str], str] = {}
+        # Seconds before a request is cancelled and answered with an error, None waits for the server
+        self.request_timeout: Optional[float] = None
+        self.request_counters = {'cancelled': 0, 'superseded': 0, 'expired': 0, 'handler_errors': 0}
+        self._init_documents()
+        self.root_folder = root_folder
         self.initialized = False
-        msg = InitMessage(root_folder)
-        self.transactions: Dict[str, callable] = {msg.message_id: self.init_response}
-        self.send_message(msg)
+        self.startup: Future = Future()
+        self._startup_lock = threading.Lock()
+        self._startup_queue: List[Tuple[Message, Optional[int]]] = []
+        self._startup_failed = False
+        self._init_deadline = time.monotonic() + init_timeout if init_timeout is not None else None
+        # $LSPCLIENT_DAEMON is only read here, the daemon's own servers are RPCClients
+        if daemon_socket is None:
+            daemon_socket = os.environ.get('LSPCLIENT_DAEMON', '')
+        super().__init__(enable_logging, server_command, daemon_socket)
         self.diagnostic_callback = None
-        self._open_files = set()
-        self._semantic_tokens: List[str] = []
-        self._semantic_modifiers: List[str] = []
-        wait_count = 0
-        while not self.initialized:
-            wait_count += 1
-            time.sleep(0.1)
-            if wait_count > 20:
-                raise RuntimeError("Failed to initialize")
+        if compile_commands_path:
+            # The server must see the compile database, initialize goes out once it is copied
+            threading.Thread(target=self._start, args=(compile_commands_path,), daemon=True).start()
+        else:
+            self._start('')
+        if wait:
+            try:
+                self.wait_ready()
+            except RuntimeError:
+                self.abort()
+                raise
+
+    def _start(self, compile_commands_path: str):
+        if compile_commands_path:
+            try:
+                copy_compile_commands(compile_commands_path, self.root_folder)
+            except OSError as e:
+                self._fail_startup(RuntimeError(f"Failed to copy {compile_commands_path}: {e}"))
+                return
+        msg = InitMessage(self.root_folder)
+        self.transactions[msg.message_id] = self.init_response
+        RPCClient.send_message(self, msg)
+
+    def _fail_startup(self, error: Exception):
+        self._init_deadline = None
+        with self._startup_lock:
+            if self._startup_failed or self.initialized:
+                return
+            self._startup_failed = True
+            queued = self._startup_queue
+            self._startup_queue = []
+        self.startup.set_exception(error)
+        # Requests held back for initialization will never be sent
+        for msg, _ in queued:
+            self._fail_unsent(msg)
+
+    def _fail_unsent(self, msg: Message):
+        message_id = getattr(msg, 'message_id', None)
+        handler = self.transactions.pop(message_id, None) if message_id is not None else None
+        if handler is None:
+            return
+        if self.metrics is not None:
+            self.metrics.request_dropped(message_id)
+        self._call_handler(handler, cancelled_response(message_id, 'Failed to initialize'))
+        if self.query_cache is not None:
+            self.query_cache.abandon(message_id)
+
+    def wait_ready(self, timeout: Optional[float] = None) -> 'LSPClient':
+        # Raises RuntimeError when initialization failed
+        return self.startup.result(timeout)
+
+    def send_message(self, msg: Message, priority: Optional[int] = None):
+        if not self.initialized:
+            with self._startup_lock:
+                failed = self._startup_failed
+                if not self.initialized and not failed:
+                    self._startup_queue.append((msg, priority))
+                    return
+            if failed:
+                self._fail_unsent(msg)
+                return
+        super().send_message(msg, priority)
 
     def set_diagnostic_callback(self, callback: callable):
+        # The callback runs on the diagnostics delivery thread, at most once per
+        # diagnostics.min_interval with the latest diagnostics of each document
+        if self.diagnostic_callback is not None:
+            self.diagnostics.remove_listener(self.diagnostic_callback)
         self.diagnostic_callback = callback
+        if callback is not None:
+            self.diagnostics.add_listener(callback)
+
+    def shutdown(self):
+        super().shutdown()
+        # Nothing will answer the requests still pending
+        with self._transactions_lock:
+            pending = list(self.transactions.items())
+            self.transactions.clear()
+        for message_id, handler in pending:
+            self._call_handler(handler, cancelled_response(message_id, 'Client shut down'))
+        self.diagnostics.close()
+        self._release_documents()
+
+    def enable_metrics(self, metrics: Optional[ClientMetrics] = None) -> ClientMetrics:
+        # Starts timing requests and counting traffic, only requests sent afterwards are timed
+        if metrics is None:
+            metrics = ClientMetrics()
+        self.metrics = metrics
+        return metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+
+    def get_stats(self) -> dict:
+        stats = {'queue_depth': self.queue_depth(),
+                 'pending_requests': len(self.transactions),
+                 'open_files': self.open_file_count(),
+                 'documents': file_stats(),
+                 'send': self.get_send_counters(),
+                 'outgoing': self.get_queue_stats(),
+                 'requests': self.get_request_counters()}
+        if self.metrics is not None:
+            stats['metrics'] = self.metrics.snapshot()
+        if self.query_cache is not None:
+            stats['query_cache'] = self.query_cache.get_stats()
+        return stats
+
+    def _call_handler(self, handler: callable, msg: dict):
+        # A handler that raises is reported, it must not stop the RPC thread or the caller's cancel
+        try:
+            handler(msg)
+        except Exception:
+            traceback.print_exc()
+            self.request_counters['handler_errors'] += 1
 
     def process_incoming(self, msg):
+        metrics = self.metrics
         if 'id' in msg:
-            message_id = msg.get('id')
-            if message_id in self.transactions:
-                handler = self.transactions.get(message_id)
-                del self.transactions[message_id]
-                handler(msg)
+            handler = self.transactions.pop(msg.get('id'), None)
+            if handler is not None:
+                if metrics is None:
+                    self._call_handler(handler, msg)
+                    return
+                timing = metrics.response_received(msg.get('id'))
+                self._call_handler(handler, msg)
+                if timing is not None:
+                    metrics.handler_done(timing)
+        elif metrics is None:
+            self.generic_handler(msg)
         else:
+            start = time.monotonic()
             self.generic_handler(msg)
+            metrics.notification_handled(time.monotonic() - start)
 
     def generic_handler(self, msg):
         if 'method' in msg:
             method = msg.get('method')
-            if method == 'textDocument/publishDiagnostics' and self.diagnostic_callback is not None:
-                self.diagnostic_callback(msg.get('params'))
-
-    def handle_capabilities(self):
-        if 'semanticTokensProvider' in self.capabilities:
-            semantic = self.capabilities.get('semanticTokensProvider')
-            if 'legend' in semantic:
-                legend = semantic.get('legend')
-                self._semantic_modifiers = legend.get("tokenModifiers")
-                self._semantic_tokens = legend.get("tokenTypes")
+            if method == 'textDocument/publishDiagnostics':
+                self.diagnostics.publish(msg.get('params'))
 
     def init_response(self, msg):
+        if self.startup.done():
+            # Initialization already timed out
+            return
+        if not msg.get('result'):
+            self._fail_startup(RuntimeError(f"Failed to initialize: {msg.get('error')}"))
+            return
         self.capabilities = msg.get('result').get('capabilities')
         self.handle_capabilities()
-        self.send_message(InitializedMessage())
-        self.initialized = True
-
-    def is_open_file(self, path):
-        return path in self._open_files
-
-    def open_source_file(self, path):
-        if path not in self._open_files:
-            self._open_files.add(path)
-            file = get_file(path)
-            self.send_message(DidOpenMessage(path))
-            return file
-        return None
-
-    def close_source_file(self, path):
-        if path in self._open_files:
-            self._open_files.remove(path)
-            self.send_message(DidCloseMessage(path))
-
-    def modify_source_line(self, path: str, row: int, text: str):
-        file = get_file(path)
-        if file.update_content_line(row, text):
-            self.send_message(DidChangeMessage(path, [row]))
-
-    def modify_source_file(self, path: str, content: str):
+        with self._startup_lock:
+            # Nothing may reach the server between initialize and initialized
+            RPCClient.send_message(self, InitializedMessage(), priority_interactive)
+            for queued, priority in self._startup_queue:
+                RPCClient.send_message(self, queued, priority)
+            self._startup_queue = []
+            self.initialized = True
+            self._init_deadline = None
+        self.startup.set_result(self)
+
+    def open_source_files(self, paths: List[str], progress: Optional[callable] = None, window: int = 64,
+                          workers: int = 8) -> List[FileContent]:
+        # Reads the files on a thread pool and opens them in the order they finish reading. At most
+        # window didOpen messages are sent ahead of the server, which acknowledges them by answering
+        # $/ping requests queued behind them. progress(path, done, total, error) runs on the calling
+        # thread for every path, error is the exception of a file that could not be read.
+        pending = [path for path in dict.fromkeys(paths) if path not in self._open_files]
+        opened: List[FileContent] = []
+        condition = threading.Condition()
+        acknowledged = [0]
+        chunk = max(window // 4, 1)
+
+        def acknowledge(count: int):
+            with condition:
+                acknowledged[0] = max(acknowledged[0], count)
+                condition.notify()
+
+        with ThreadPoolExecutor(workers) as pool:
+            # Read documents stay pinned until they are open, a small registry budget can't evict them
+            futures = {pool.submit(pin_file, path): path for path in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                path = futures.get(future)
+                try:
+                    future.result()
+                except (OSError, ValueError) as e:
+                    if progress is not None:
+                        progress(path, done, len(pending), e)
+                    continue
+                with condition:
+                    # A server that stopped answering only slows the loop down to a window per timeout
+                    condition.wait_for(lambda: len(opened) - acknowledged[0] < window, self.request_timeout or 30.0)
+                file = self.open_source_file(path)
+                unpin_file(path)
+                if file is not None:
+                    opened.append(file)
+                    if len(opened) % chunk == 0:
+                        self.send_request(PingMessage(), lambda msg, n=len(opened): acknowledge(n))
+                if progress is not None:
+                    progress(path, done, len(pending), None)
+        return opened
+
+    def send_request(self, msg: QueryMessage, handler: callable, timeout: Optional[float] = None,
+                     priority: Optional[int] = None, supersede: bool = True) -> RequestHandle:
+        # With supersede unset, the request doesn't cancel the previous one of its superseded method
+        method = msg.root.get('method')
+        if timeout is None:
+            timeout = self.request_timeout
+        earliest = False
+        with self._transactions_lock:
+            self.transactions[msg.message_id] = handler
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (time.monotonic() + timeout, msg.message_id))
+                earliest = self._deadlines[0][1] == msg.message_id
+            previous = None
+            if supersede and method in self.superseded_methods:
+                key = (method, msg.params.get('textDocument').get('uri'))
+                previous = self._latest_requests.get(key)
+                self._latest_requests[key] = msg.message_id
+        if previous is not None and self._cancel(previous, 'Request superseded'):
+            self.request_counters['superseded'] += 1
+        if self.metrics is not None:
+            self.metrics.request_enqueued(msg.message_id, method)
+        self.send_message(msg, priority)
+        if earliest:
+            # The RPC thread sleeps until the previous earliest deadline
+            self.wakeup()
+        return RequestHandle(self, msg.message_id)
+
+    def _cancel(self, message_id: str, reason: str = 'Request cancelled') -> bool:
+        # The handler receives a cancelled_response (code request_cancelled) with reason as its message,
+        # on the thread that cancels: the caller's, or the RPC thread for expired and superseded requests
+        handler = self.transactions.pop(message_id, None)
+        if handler is None:
+            return False
+        if self.metrics is not None:
+            self.metrics.request_dropped(message_id)
+        # A request still waiting for the writer is dropped, the server never sees it
+        if not self._outgoing.discard(message_id):
+            self.send_message(CancelMessage(message_id))
+        # Waiters of a shared query are answered through the handler, anything left is dropped
+        self._call_handler(handler, cancelled_response(message_id, reason))
+        if self.query_cache is not None:
+            self.query_cache.abandon(message_id)
+        return True
+
+    def cancel_request(self, message_id: str) -> bool:
+        if self._cancel(message_id):
+            self.request_counters['cancelled'] += 1
+            return True
+        return False
+
+    def poll_timeout(self) -> Optional[float]:
+        deadline = self._init_deadline
+        if self._deadlines and (deadline is None or self._deadlines[0][0] < deadline):
+            deadline = self._deadlines[0][0]
+        if deadline is None:
+            return None
+        return max(0.0, deadline - time.monotonic())
+
+    def handle_timeouts(self):
+        now = time.monotonic()
+        if self._init_deadline is not None and now >= self._init_deadline:
+            self._fail_startup(RuntimeError("Failed to initialize"))
+        while self._deadlines and self._deadlines[0][0] <= now:
+            with self._transactions_lock:
+                if not self._deadlines or self._deadlines[0][0] > now:
+                    break
+                _, message_id = heapq.heappop(self._deadlines)
+            if self._cancel(message_id, 'Request timed out'):
+                self.request_counters['expired'] += 1
+        with self._transactions_lock:
+            # Forget supersession entries whose requests already completed
+            if len(self._latest_requests) > len(self.transactions):
+                self._latest_requests = {k: v for k, v in self._latest_requests.items() if v in self.transactions}
+
+    def get_request_counters(self) -> Dict[str, int]:
+        return dict(self.request_counters)
+
+    def request_completion(self, path: str, row: int, col: int, handler: callable,
+                           timeout: Optional[float] = None) -> RequestHandle:
+        cache = self.completion_cache
+        if cache is None:
+            return self.send_request(CompletionMessage(path, row, col), handler, timeout)
         file = get_file(path)
-        if file.update_content(content):
-            self.send_message(DidChangeMessage(path, []))
-
-    def request_completion(self, path: str, row: int, col: int, handler: callable):
-        msg = CompletionMessage(path, row, col)
-        self.transactions[msg.message_id] = handler
-        self.send_message(msg)
-
-    def request_coloring(self, path: str, prev_id: str, handler: callable):
-        msg = ColoringMessage(path, prev_id)
-        self.transactions[msg.message_id] = handler
-        self.send_message(msg)
-
-    def get_coloring_legend(self) -> Tuple[List[str], List[str]]:
-        return self._semantic_tokens, self._semantic_modifiers
-
-    def request_definition(self, path: str, row: int, col: int, handler: callable):
-        msg = DefinitionMessage(path, row, col)
-        self.transactions[msg.message_id] = handler
-        self.send_message(msg)
+        response = cache.lookup(file, row, col)
+        if response is not None:
+            # Served from the cache, the handler runs on the calling thread
+            handler(response)
+            return RequestHandle(self, '')
+        session = cache.begin(file, row, col)
+
+        def store_response(msg):
+            cache.store(session, msg)
+            handler(msg)
+
+        return self.send_request(CompletionMessage(path, row, col), store_response, timeout)
+
+    def request_completion_resolve(self, item: dict, handler: callable, timeout: Optional[float] = None) -> RequestHandle:
+        # The response holds the fully resolved item
+        return self.send_request(CompletionResolveMessage(item), handler, timeout)
+
+    def request_coloring(self, path: str, prev_id: str, handler: callable,
+                         timeout: Optional[float] = None) -> RequestHandle:
+        return self.send_request(ColoringMessage(path, prev_id), handler, timeout)
+
+    def request_semantic_tokens(self, path: str, handler: callable, timeout: Optional[float] = None) -> RequestHandle:
+        # Like request_coloring, but tracks the result id and applies deltas to the document's token
+        # store; handler receives the DocumentTokens, or None when the server returned no tokens
+        uri = get_file(path).uri
+        prev_id = self.semantic_tokens.previous_result_id(uri)
+
+        def apply_tokens(msg):
+            document = self.semantic_tokens.apply_response(uri, msg)
+            if document is None and prev_id and msg.get('error') is None:
+                # The delta could not be applied, start over with a full request
+                self.semantic_tokens.remove(uri)
+                self.request_semantic_tokens(path, handler, timeout)
+            else:
+                handler(document)
+
+        return self.send_request(ColoringMessage(path, prev_id), apply_tokens, timeout)
+
+    def request_position(self, method: str, path: str, row: int, col: int, handler: callable,
+                         timeout: Optional[float] = None, supersede: bool = True) -> RequestHandle:
+        # With a query cache, requests of its methods on open documents are answered from the cache
+        # (on the calling thread) or join an identical request in flight. Cancelling a joined
+        # request cancels it for every caller.
+        msg = PositionalMessage(method, path, row, col)
+        cache = self.query_cache
+        version = self._document_version(msg.params.get('textDocument').get('uri'))
+        if cache is None or version is None or method not in cache.methods:
+            return self.send_request(msg, handler, timeout, supersede=supersede)
+        key = query_key(msg, version)
+        response = cache.lookup(key)
+        if response is not None:
+            handler(response)
+            return RequestHandle(self, '')
+        message_id = cache.join_or_begin(key, msg.message_id, handler)
+        if message_id is not None:
+            return RequestHandle(self, message_id)
+
+        def complete(response):
+            for waiter in cache.complete(key, response):
+                waiter(response)
+
+        return self.send_request(msg, complete, timeout, supersede=supersede)
+
+    def request_definition(self, path: str, row: int, col: int, handler: callable,
+                           timeout: Optional[float] = None) -> RequestHandle:
+        return self.request_position('textDocument/definition', path, row, col, handler, timeout)
+
+    def batch_query(self, queries: Iterable[BatchQuery], window: int = 64, ordered: bool = True,
+                    max_open: int = 16, timeout: Optional[float] = None) -> QueryBatch:
+        # Iterating the batch sends (path, row, col, kind) queries with up to window of them in flight
+        # and yields a BatchResult for each, see batch.QueryBatch
+        return QueryBatch(self, queries, window, ordered, max_open, timeout)
+
+    def request_workspace_symbols(self, query: str, handler: callable,
+                                  timeout: Optional[float] = None) -> RequestHandle:
+        return self.send_request(WorkspaceSymbolMessage(query), handler, timeout)
@@ -0,0 +1,171 @@
+import json
+import re
+from collections.abc import Mapping
+from typing import Callable, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _json_loads(data):
+    # Decoded as UTF-8 straight from the buffer, json.loads on bytes detects the encoding and
+    # decodes with surrogatepass, which is slower
+    return json.loads(data if isinstance(data, str) else str(data, 'utf-8'))
+
+
+def _ujson_dumps(obj) -> bytes:
+    return ujson.dumps(obj, escape_forward_slashes=False).encode('utf-8')
+
+
+def _ujson_loads(data):
+    return ujson.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+
+def available_backends():
+    backends = {'json': (_json_dumps, _json_loads)}
+    if ujson is not None:
+        backends['ujson'] = (_ujson_dumps, _ujson_loads)
+    if orjson is not None:
+        # orjson reads memoryviews without copying
+        backends['orjson'] = (orjson.dumps, orjson.loads)
+    return backends
+
+
+backend = ''
+dumps: Callable[[object], bytes] = _json_dumps
+loads: Callable[[object], object] = _json_loads
+
+
+def set_backend(name: str = ''):
+    # The fastest installed backend when no name is given
+    global backend, dumps, loads
+    backends = available_backends()
+    if not name:
+        name = next(n for n in ('orjson', 'ujson', 'json') if n in backends)
+    if name not in backends:
+        raise RuntimeError(f"JSON backend {name} is not available")
+    backend = name
+    dumps, loads = backends.get(name)
+
+
+set_backend()
+
+
+def frame(root) -> Tuple[bytes, bytes]:
+    # Header and payload of a packet, for writev without joining them
+    payload = dumps(root)
+    return b'Content-Length: %d\r\n\r\n' % len(payload), payload
+
+
+# Responses at least this large are parsed only when their payload is read
+lazy_threshold = 4096
+envelope_size = 512
+_string = rb'"(?:[^"\\]|\\.)*"'
+_string_pattern = re.compile(_string)
+_key_pattern = re.compile(rb'"(id|method|result|error)"\s*:\s*')
+_id_pattern = re.compile(rb'-?\d+|null|' + _string)
+_tail_id_pattern = re.compile(rb'"id"\s*:\s*(-?\d+|null|' + _string + rb')\s*}\s*$')
+
+
+def _depth(prefix: bytes) -> int:
+    stripped = _string_pattern.sub(b'""', prefix)
+    return stripped.count(b'{') + stripped.count(b'[') - stripped.count(b'}') - stripped.count(b']')
+
+
+def response_id(body) -> Tuple[bool, object]:
+    # (True, id) when body is a response whose id can be read without parsing it. Top level keys
+    # are looked up in the head of the message, the id may also be the last key of the object.
+    head = bytes(body[:envelope_size])
+    message_id = None
+    found_id = False
+    for match in _key_pattern.finditer(head):
+        if _depth(head[:match.start()]) != 1:
+            continue
+        key = match.group(1)
+        if key == b'method':
+            return False, None
+        if key == b'id':
+            value = _id_pattern.match(head, match.end())
+            if value is None or value.end() == len(head):
+                return False, None
+            message_id = json.loads(value.group(0))
+            found_id = True
+            continue
+        # result or error, the payload follows
+        if not found_id:
+            tail = _tail_id_pattern.search(bytes(body[-64:]))
+            if tail is None:
+                return False, None
+            message_id = json.loads(tail.group(1))
+        return True, message_id
+    return False, None
+
+
+class LazyResponse(Mapping):
+    # A response that behaves like its dict, but is only parsed when something other than its id is read
+    __slots__ = ('_body', '_id', '_root')
+
+    def __init__(self, body: bytes, message_id):
+        self._body = body
+        self._id = message_id
+        self._root: Optional[dict] = None
+
+    @property
+    def decoded(self) -> bool:
+        return self._root is not None
+
+    def decode(self) -> dict:
+        if self._root is None:
+            self._root = loads(self._body)
+            self._body = None
+        return self._root
+
+    def __getitem__(self, key):
+        if key == 'id':
+            return self._id
+        return self.decode()[key]
+
+    def get(self, key, default=None):
+        if key == 'id':
+            return self._id
+        if key == 'method':
+            return default
+        return self.decode().get(key, default)
+
+    def __contains__(self, key):
+        if key == 'id':
+            return True
+        if key == 'method':
+            return False
+        return key in self.decode()
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __len__(self):
+        return len(self.decode())
+
+    def __repr__(self):
+        if self._root is None:
+            return f'LazyResponse(id={self._id!r}, {len(self._body)} bytes)'
+        return repr(self._root)
+
+
+def decode_message(body, lazy: bool = True):
+    # Large responses become LazyResponse objects, everything else is parsed right away
+    if lazy and len(body) >= lazy_threshold:
+        is_response, message_id = response_id(body)
+        if is_response:
+            return LazyResponse(bytes(body), message_id)
+    return loads(body)
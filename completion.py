@@ -0,0 +1,242 @@
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+from .message import FileContent
+from .rope import utf16_length, utf16_to_index
+
+
+def is_word_char(c: str) -> bool:
+    return c.isalnum() or c == '_'
+
+
+def word_start(line: str, index: int) -> int:
+    while index > 0 and is_word_char(line[index - 1]):
+        index -= 1
+    return index
+
+
+def fuzzy_score(pattern: str, text: str, lower: Optional[str] = None) -> int:
+    # Subsequence match of pattern in text, negative when it does not match.
+    # Rewards prefix, consecutive, word boundary and exact case matches.
+    if not pattern:
+        return 0
+    if lower is None:
+        lower = text.lower()
+    pattern_lower = pattern.lower()
+    if lower.startswith(pattern_lower):
+        return 100 + 2 * len(pattern) + (1 if text.startswith(pattern) else 0) - len(text)
+    score = 0
+    pos = 0
+    previous = -2
+    for c, c_lower in zip(pattern, pattern_lower):
+        found = lower.find(c_lower, pos)
+        if found < 0:
+            return -1
+        score += 1
+        if found == previous + 1:
+            score += 3
+        if found == 0 or text[found - 1] == '_' or (text[found].isupper() and text[found - 1].islower()):
+            score += 2
+        if text[found] == c:
+            score += 1
+        previous = found
+        pos = found + 1
+    return score - len(text) // 8
+
+
+def extend_edit(item: dict, end: dict) -> dict:
+    # Server edits replace the prefix typed at request time, stretch them over what was typed since
+    edit = item.get('textEdit')
+    if not edit or 'range' not in edit or edit.get('range').get('end').get('line') != end.get('line'):
+        return item
+    item = dict(item)
+    item['textEdit'] = dict(edit, range={'start': edit.get('range').get('start'), 'end': end})
+    return item
+
+
+class CompletionItems:
+    # Completion result kept by the cache: the server's item dicts, with label, filterText and
+    # sortText in flat lists for filtering
+    __slots__ = ('is_incomplete', 'labels', 'filter_texts', 'sort_texts', 'has_edits', '_items')
+
+    def __init__(self, items: List[dict] = (), is_incomplete: bool = False):
+        self.is_incomplete = is_incomplete
+        self._items = list(items)
+        self.labels: List[str] = [item.get('label', '') for item in self._items]
+        self.filter_texts: List[Optional[str]] = [item.get('filterText') for item in self._items]
+        self.sort_texts: List[Optional[str]] = [item.get('sortText') for item in self._items]
+        self.has_edits = any('textEdit' in item for item in self._items)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def filter_text(self, index: int) -> str:
+        return self.filter_texts[index] or self.labels[index]
+
+    def sort_text(self, index: int) -> str:
+        return self.sort_texts[index] or self.labels[index]
+
+    def dicts(self, indices: List[int], edit_end: Optional[dict] = None) -> List[dict]:
+        # Item dicts at indices, with edit_end replacing the end of their textEdit ranges
+        items = [self._items[i] for i in indices]
+        if edit_end is not None:
+            items = [extend_edit(item, edit_end) for item in items]
+        return items
+
+
+def completion_items(response: dict) -> Optional[CompletionItems]:
+    result = response.get('result')
+    if isinstance(result, list):
+        return CompletionItems(result, False)
+    if isinstance(result, dict):
+        return CompletionItems(result.get('items', []), result.get('isIncomplete', False))
+    return None
+
+
+class CompletionSession:
+    __slots__ = ('uri', 'row', 'word_start', 'line_prefix', 'prefix', 'items', 'stale', '_entries',
+                 '_last_prefix', '_last_matches')
+
+    def __init__(self, uri: str, row: int, start: int, line_prefix: str, prefix: str):
+        self.uri = uri
+        self.row = row
+        self.word_start = start
+        self.line_prefix = line_prefix
+        self.prefix = prefix
+        self.items = CompletionItems()
+        # Set when the document changed in a way the session can't follow before its items arrived
+        self.stale = False
+        self._entries: List[Tuple[str, str, int]] = []
+        self._last_prefix = ''
+        self._last_matches: List[Tuple[str, str, int]] = []
+
+    @property
+    def has_edits(self) -> bool:
+        return self.items.has_edits
+
+    def set_items(self, items: CompletionItems):
+        entries = []
+        for index in range(len(items)):
+            text = items.filter_text(index)
+            entries.append((text, text.lower(), index))
+        entries.sort(key=lambda e: items.sort_text(e[2]))
+        self.items = items
+        self._entries = entries
+        self._last_prefix = ''
+        self._last_matches = entries
+
+    def filter(self, prefix: str) -> List[int]:
+        # Indices of the matching items. Items matching a longer prefix are a subset of those matching
+        # a shorter one, so narrowing continues from the previous matches (kept in sortText order)
+        candidates = self._last_matches if prefix.startswith(self._last_prefix) else self._entries
+        self._last_prefix = prefix
+        if not prefix:
+            self._last_matches = candidates
+            return [e[2] for e in candidates]
+        prefix_lower = prefix.lower()
+        search = re.compile('.*?'.join(map(re.escape, prefix_lower))).search
+        prefixed = []
+        fuzzy = []
+        for e in candidates:
+            if e[1].startswith(prefix_lower):
+                prefixed.append(e)
+            elif search(e[1]):
+                fuzzy.append(e)
+        # A fuzzy match never becomes a prefix match as the prefix grows, so this keeps both tiers ordered
+        self._last_matches = prefixed + fuzzy
+        # Exact prefix matches first, then case-insensitive ones, both in server order, then fuzzy by score
+        exact = [e[2] for e in prefixed if e[0].startswith(prefix)]
+        if len(exact) < len(prefixed):
+            exact.extend(e[2] for e in prefixed if not e[0].startswith(prefix))
+        if fuzzy:
+            scored = [(-fuzzy_score(prefix, e[0], e[1]), i) for i, e in enumerate(fuzzy)]
+            scored.sort()
+            exact.extend(fuzzy[i][2] for _, i in scored)
+        return exact
+
+
+class CompletionCache:
+    def __init__(self, max_sessions: int = 64):
+        self._max_sessions = max_sessions
+        self._sessions: Dict[str, CompletionSession] = {}
+        # Sessions waiting for their response, edits of their document are checked against them as well
+        self._begun: Dict[str, CompletionSession] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self, file: FileContent, row: int, col: int) -> CompletionSession:
+        # Captures the word being completed at request time
+        line = file.rope.line(row)
+        index = utf16_to_index(line, col)
+        start = word_start(line, index)
+        session = CompletionSession(file.uri, row, start, line[:start], line[start:index])
+        with self._lock:
+            self._begun[file.uri] = session
+        return session
+
+    def store(self, session: CompletionSession, response: dict):
+        # The item dicts of the response are kept.
+        # Items of a session the document moved away from meanwhile are not kept. A failed response
+        # (cancelled, superseded) only discards its own session, never a newer one of the document.
+        with self._lock:
+            if self._begun.get(session.uri) is session:
+                del self._begun[session.uri]
+        items = completion_items(response)
+        if items is None or items.is_incomplete or session.stale:
+            with self._lock:
+                session.stale = True
+                if self._sessions.get(session.uri) is session:
+                    del self._sessions[session.uri]
+            return
+        session.set_items(items)
+        with self._lock:
+            if session.stale:
+                return
+            self._sessions.pop(session.uri, None)
+            if len(self._sessions) >= self._max_sessions:
+                self._sessions.pop(next(iter(self._sessions)))
+            self._sessions[session.uri] = session
+
+    def lookup(self, file: FileContent, row: int, col: int) -> Optional[dict]:
+        # A response built from the cached items
+        with self._lock:
+            session = self._sessions.get(file.uri)
+            if session is None or session.row != row:
+                self.misses += 1
+                return None
+        line = file.rope.line(row)
+        index = utf16_to_index(line, col)
+        start = word_start(line, index)
+        prefix = line[start:index]
+        if start != session.word_start or line[:start] != session.line_prefix or \
+                not prefix.startswith(session.prefix):
+            self.invalidate(file.uri)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        end = {'line': row, 'character': utf16_length(line[:index])} if session.has_edits else None
+        result = {'isIncomplete': False, 'items': session.items.dicts(session.filter(prefix), end)}
+        return {'jsonrpc': '2.0', 'id': None, 'result': result}
+
+    def document_changed(self, uri: str, first_row: int, last_row: int, line_delta: int = 0):
+        # Only edits within the session's row keep it, line_delta is the number of lines the edit added
+        with self._lock:
+            for sessions in (self._sessions, self._begun):
+                session = sessions.get(uri)
+                if session is not None and (first_row != session.row or last_row != session.row or line_delta):
+                    session.stale = True
+                    del sessions[uri]
+
+    def invalidate(self, uri: str):
+        with self._lock:
+            for sessions in (self._sessions, self._begun):
+                session = sessions.pop(uri, None)
+                if session is not None:
+                    session.stale = True
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'sessions': len(self._sessions)}
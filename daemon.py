@@ -0,0 +1,517 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+from queue import Queue
+from typing import Dict, List, Optional, Set, Tuple
+from . import codec
+from .client import RPCClient
+from .framing import MessageParser
+from .message import Message, generate_id
+from .outgoing import priority_interactive
+from .rope import Rope
+
+# Neutral answers to requests from the server, which can't be routed to one connection.
+# Other requests are answered with MethodNotFound.
+server_request_results = {'client/registerCapability': None, 'client/unregisterCapability': None,
+                          'window/workDoneProgress/create': None, 'window/showMessageRequest': None,
+                          'window/showDocument': {'success': False}, 'workspace/workspaceFolders': None,
+                          'workspace/applyEdit': {'applied': False,
+                                                  'failureReason': 'The server is shared by several clients'},
+                          'workspace/semanticTokens/refresh': None, 'workspace/inlayHint/refresh': None,
+                          'workspace/codeLens/refresh': None, 'workspace/diagnostic/refresh': None}
+
+
+class ForwardedMessage(Message):
+    # A message received from a connection or built by the daemon, sent to the server as it is
+    def __init__(self, root: dict):
+        self.root = root
+        self.params = root.get('params') or {}
+
+
+class SharedDocument:
+    # A document open in the server for one or more connections. version counts the changes the
+    # server saw from all connections, text is the server's text. diagnostics holds the latest
+    # publishDiagnostics params, for connections opening it later.
+    __slots__ = ('openers', 'version', 'text', 'diagnostics')
+
+    def __init__(self, text: str):
+        self.openers = 1
+        self.version = 1
+        self.text = Rope(text)
+        self.diagnostics: Optional[dict] = None
+
+    def apply(self, changes: List[dict]):
+        for change in changes:
+            if 'range' not in change:
+                self.text = Rope(change.get('text'))
+                continue
+            start = change.get('range').get('start')
+            end = change.get('range').get('end')
+            self.text = self.text.replace(self.text.offset_at(start.get('line'), start.get('character')),
+                                          self.text.offset_at(end.get('line'), end.get('character')),
+                                          change.get('text'))
+
+
+def warning_message(text: str) -> dict:
+    return {'jsonrpc': '2.0', 'method': 'window/showMessage', 'params': {'type': 2, 'message': text}}
+
+
+class Connection:
+    # A client attached over the daemon socket, speaking the same framed JSON-RPC as a server's stdio.
+    # A client that doesn't read what is sent to it is disconnected once max_pending_bytes wait for it.
+    max_pending_bytes = 64 << 20
+
+    def __init__(self, daemon: 'Daemon', sock: socket.socket):
+        self._daemon = daemon
+        self._socket = sock
+        self.backend: Optional['SharedServer'] = None
+        # Documents this connection opened with the connection's own latest version
+        self.documents: Dict[str, int] = {}
+        # Open documents whose text in this connection differs from the server's
+        self.diverged: Set[str] = set()
+        # Ids of the connection's requests to the ids they were sent to the server with
+        self.requests: Dict[object, str] = {}
+        self._outgoing = Queue()
+        self._pending_bytes = 0
+        self._pending_lock = threading.Lock()
+        self.overflowed = False
+        self._writer = threading.Thread(target=self.writer_thread, daemon=True)
+        self._writer.start()
+        self._reader = threading.Thread(target=self.reader_thread, daemon=True)
+        self._reader.start()
+
+    def send(self, root: dict):
+        header, payload = codec.frame(root)
+        data = header + payload
+        with self._pending_lock:
+            if self.overflowed:
+                return
+            self._pending_bytes += len(data)
+            if self._pending_bytes > self.max_pending_bytes:
+                self.overflowed = True
+        if self.overflowed:
+            # The reader sees the end of the connection and detaches it
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return
+        self._outgoing.put(data)
+
+    def reply(self, message_id, result=None, error: Optional[str] = None):
+        if error is None:
+            self.send({'jsonrpc': '2.0', 'id': message_id, 'result': result})
+        else:
+            self.send({'jsonrpc': '2.0', 'id': message_id, 'error': {'code': -32603, 'message': error}})
+
+    def writer_thread(self):
+        try:
+            while True:
+                data = self._outgoing.get()
+                if data is None:
+                    break
+                self._socket.sendall(data)
+                with self._pending_lock:
+                    self._pending_bytes -= len(data)
+        except OSError:
+            pass
+        finally:
+            self._socket.close()
+
+    def reader_thread(self):
+        parser = MessageParser()
+        fd = self._socket.fileno()
+        try:
+            while True:
+                data = parser.read_from(fd)
+                if not data:
+                    break
+                for _, body in parser.messages():
+                    if not self.handle(codec.loads(body)):
+                        return
+        except (ValueError, OSError):
+            pass
+        finally:
+            if self.backend is not None:
+                self.backend.detach(self)
+            self._outgoing.put(None)
+
+    def handle(self, msg: dict) -> bool:
+        method = msg.get('method')
+        if method == 'exit':
+            return False
+        if method == 'initialize':
+            try:
+                self.backend = self._daemon.backend(root_folder(msg.get('params')))
+            except (OSError, RuntimeError) as e:
+                self.reply(msg.get('id'), error=f'Failed to start the server: {e}')
+                return True
+            self.backend.initialize(self, msg)
+        elif self.backend is not None:
+            self.backend.forward(self, msg)
+        elif 'id' in msg and method is not None:
+            self.reply(msg.get('id'), error='Not initialized')
+        return True
+
+
+def root_folder(params: dict) -> str:
+    root_uri = params.get('rootUri')
+    if root_uri:
+        return os.path.abspath(root_uri[len('file://'):] if root_uri.startswith('file://') else root_uri)
+    if params.get('rootPath'):
+        return os.path.abspath(params.get('rootPath'))
+    raise RuntimeError("initialize without a root folder")
+
+
+def diagnostics_message(params: dict, version: Optional[int]) -> dict:
+    # Versions are translated back to the ones each connection counts
+    if version is not None and params.get('version') is not None:
+        params = dict(params, version=version)
+    return {'jsonrpc': '2.0', 'method': 'textDocument/publishDiagnostics', 'params': params}
+
+
+class SharedServer(RPCClient):
+    # One server process for a root folder, shared by every connection that initializes with it.
+    # Request ids are rewritten to daemon ids, documents are opened in the server once and closed
+    # when their last opener closes them, diagnostics go to the connections that have the document open.
+    # The server has one text per document: a connection whose text differs from it (it opened other
+    # text, or another connection changed the document) is warned with window/showMessage, and its
+    # incremental changes are dropped until a full text change or a reopen brings it back in sync.
+    # Responses are re-encoded with the connection's id, so they are always parsed
+    lazy_decoding = False
+
+    def __init__(self, daemon: 'Daemon', root: str, server_command: Optional[List[str]] = None,
+                 enable_logging=False):
+        # Used by the RPC thread, which starts in RPCClient.__init__
+        self.root_folder = root
+        self._daemon = daemon
+        self._lock = threading.Lock()
+        self.connections: Set[Connection] = set()
+        self.documents: Dict[str, SharedDocument] = {}
+        self._pending: Dict[str, Tuple[Connection, object]] = {}
+        self._init_id: Optional[str] = None
+        self._init_response: Optional[dict] = None
+        self._waiting: List[Tuple[Connection, object]] = []
+        self.counters = {'connections': 0, 'requests': 0, 'shared_opens': 0, 'resyncs': 0, 'diverged': 0,
+                         'refused_changes': 0, 'diagnostics': 0}
+        # Never the daemon socket, the daemon usually runs with $LSPCLIENT_DAEMON set to it
+        super().__init__(enable_logging, server_command, daemon_socket='')
+
+    def send_message(self, msg: Message, priority: Optional[int] = None):
+        # Called with _lock held to keep the server's order, producers wait in forward() instead
+        self._outgoing.put(msg, priority, False)
+
+    def initialize(self, connection: Connection, msg: dict):
+        # The first connection's initialize goes to the server, later ones get the same response
+        with self._lock:
+            self.connections.add(connection)
+            self.counters['connections'] += 1
+            response = self._init_response
+            if response is None:
+                self._waiting.append((connection, msg.get('id')))
+                if self._init_id is None:
+                    self._init_id = generate_id()
+                    msg['id'] = self._init_id
+                    self.send_message(ForwardedMessage(msg))
+        if response is not None:
+            connection.send(dict(response, id=msg.get('id')))
+
+    def _initialized(self, msg: dict):
+        with self._lock:
+            self._init_response = {key: value for key, value in msg.items() if key != 'id'}
+            waiting = self._waiting
+            self._waiting = []
+            if 'result' in msg:
+                # Ahead of anything the connections send once they have their response
+                self.send_message(ForwardedMessage({'jsonrpc': '2.0', 'method': 'initialized', 'params': {}}),
+                                  priority_interactive)
+        for connection, message_id in waiting:
+            connection.send(dict(self._init_response, id=message_id))
+        if 'result' not in msg:
+            self._daemon.discard(self)
+
+    def forward(self, connection: Connection, msg: dict):
+        method = msg.get('method')
+        message_id = msg.get('id')
+        if method is None or method == 'initialized':
+            # The daemon answers server requests itself and already sent initialized
+            return
+        if method == 'shutdown':
+            connection.reply(message_id)
+            return
+        self._outgoing.wait_writable()
+        params = msg.get('params') or {}
+        with self._lock:
+            if method == 'textDocument/didOpen':
+                self._open(connection, msg)
+            elif method == 'textDocument/didChange':
+                self._change(connection, msg)
+            elif method == 'textDocument/didClose':
+                uri = params.get('textDocument').get('uri')
+                if connection.documents.pop(uri, None) is not None:
+                    connection.diverged.discard(uri)
+                    self._release(uri)
+            elif method == '$/cancelRequest':
+                server_id = connection.requests.get(params.get('id'))
+                if server_id is not None:
+                    params['id'] = server_id
+                    self.send_message(ForwardedMessage(msg))
+            elif message_id is not None:
+                server_id = generate_id()
+                self._pending[server_id] = (connection, message_id)
+                connection.requests[message_id] = server_id
+                msg['id'] = server_id
+                self.counters['requests'] += 1
+                self.send_message(ForwardedMessage(msg))
+            else:
+                self.send_message(ForwardedMessage(msg))
+
+    def _diverge(self, connection: Connection, uri: str, reason: str):
+        if uri in connection.diverged:
+            return
+        connection.diverged.add(uri)
+        self.counters['diverged'] += 1
+        connection.send(warning_message(f'{uri} {reason}. The shared server keeps the other text, changes '
+                                        f'from this client are ignored until it sends the full text or '
+                                        f'reopens the document.'))
+
+    def _open(self, connection: Connection, msg: dict):
+        doc = msg.get('params').get('textDocument')
+        uri = doc.get('uri')
+        if uri in connection.documents:
+            connection.diverged.discard(uri)
+            self._release(uri)
+        connection.documents[uri] = doc.get('version')
+        shared = self.documents.get(uri)
+        if shared is None:
+            self.documents[uri] = SharedDocument(doc.get('text'))
+            doc['version'] = 1
+            self.send_message(ForwardedMessage(msg))
+            return
+        shared.openers += 1
+        self.counters['shared_opens'] += 1
+        if shared.text.text() != doc.get('text'):
+            # The other openers' text (and their edits) stays
+            self._diverge(connection, uri, 'is open in another client with different text')
+        elif shared.diagnostics is not None:
+            connection.send(diagnostics_message(shared.diagnostics, doc.get('version')))
+
+    def _change(self, connection: Connection, msg: dict):
+        doc = msg.get('params').get('textDocument')
+        uri = doc.get('uri')
+        shared = self.documents.get(uri)
+        if shared is None:
+            self.send_message(ForwardedMessage(msg))
+            return
+        changes = msg.get('params').get('contentChanges')
+        connection.documents[uri] = doc.get('version')
+        if uri in connection.diverged:
+            full = [index for index, change in enumerate(changes) if 'range' not in change]
+            if not full:
+                # Its ranges refer to a text the server doesn't have
+                self.counters['refused_changes'] += 1
+                return
+            # Its full text replaces the server's
+            changes = changes[full[-1]:]
+            msg.get('params')['contentChanges'] = changes
+            connection.diverged.discard(uri)
+            self.counters['resyncs'] += 1
+        shared.apply(changes)
+        shared.version += 1
+        doc['version'] = shared.version
+        for other in self.connections:
+            if other is not connection and uri in other.documents:
+                self._diverge(other, uri, 'was changed by another client')
+        self.send_message(ForwardedMessage(msg))
+
+    def _release(self, uri: str):
+        shared = self.documents.get(uri)
+        shared.openers -= 1
+        if shared.openers == 0:
+            del self.documents[uri]
+            self.send_message(ForwardedMessage({'jsonrpc': '2.0', 'method': 'textDocument/didClose',
+                                                'params': {'textDocument': {'uri': uri}}}))
+
+    def detach(self, connection: Connection):
+        with self._lock:
+            if connection not in self.connections:
+                return
+            self.connections.remove(connection)
+            for uri in connection.documents:
+                self._release(uri)
+            connection.documents = {}
+            connection.diverged.clear()
+            for server_id in connection.requests.values():
+                if self._pending.pop(server_id, None) is not None:
+                    self.send_message(ForwardedMessage({'jsonrpc': '2.0', 'method': '$/cancelRequest',
+                                                        'params': {'id': server_id}}))
+            connection.requests = {}
+            self._waiting = [w for w in self._waiting if w[0] is not connection]
+            idle = not self.connections
+        if idle:
+            self._daemon.backend_idle(self)
+
+    def process_incoming(self, msg):
+        method = msg.get('method')
+        message_id = msg.get('id')
+        if method is None:
+            if message_id == self._init_id:
+                self._initialized(msg)
+                return
+            with self._lock:
+                target = self._pending.pop(message_id, None)
+                if target is not None:
+                    target[0].requests.pop(target[1], None)
+            if target is not None:
+                msg['id'] = target[1]
+                target[0].send(msg)
+        elif message_id is not None:
+            # Requests from the server can't be routed to one connection, they get neutral answers
+            response = {'jsonrpc': '2.0', 'id': message_id}
+            if method == 'workspace/configuration':
+                response['result'] = [None] * len(msg.get('params').get('items', []))
+            elif method in server_request_results:
+                response['result'] = server_request_results.get(method)
+            else:
+                response['error'] = {'code': -32601, 'message': f'{method} is not supported by the daemon'}
+            with self._lock:
+                self.send_message(ForwardedMessage(response))
+        elif method == 'textDocument/publishDiagnostics':
+            self._publish(msg)
+        else:
+            with self._lock:
+                connections = list(self.connections)
+            for connection in connections:
+                connection.send(msg)
+
+    def _publish(self, msg: dict):
+        params = msg.get('params')
+        uri = params.get('uri')
+        version = params.get('version')
+        with self._lock:
+            shared = self.documents.get(uri)
+            if shared is None:
+                targets = [(connection, None) for connection in self.connections]
+            elif version is not None and version != shared.version:
+                # Diagnostics of a text some connection already changed, newer ones will follow
+                return
+            else:
+                shared.diagnostics = params
+                # Diagnostics of the server's text, connections with other text don't get them
+                targets = [(connection, connection.documents.get(uri)) for connection in self.connections
+                           if uri in connection.documents and uri not in connection.diverged]
+            self.counters['diagnostics'] += 1
+        for connection, connection_version in targets:
+            if version is None or connection_version is None:
+                connection.send(msg)
+            else:
+                connection.send(diagnostics_message(params, connection_version))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self.counters, attached=len(self.connections), documents=len(self.documents),
+                        pending_requests=len(self._pending), queue_depth=self.queue_depth())
+
+
+class Daemon:
+    # Serves connections on a Unix socket, with one server per root folder. A server whose last
+    # connection detached keeps running for linger seconds, ready for the next connection.
+    def __init__(self, socket_path: str, server_command: Optional[List[str]] = None, linger: float = 30.0,
+                 enable_logging=False):
+        self.socket_path = socket_path
+        self.linger = linger
+        self._server_command = server_command
+        self._enable_logging = enable_logging
+        self._backends: Dict[str, SharedServer] = {}
+        self._lock = threading.Lock()
+        self._listener: Optional[socket.socket] = None
+        self._closed = False
+
+    def backend(self, root: str) -> SharedServer:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Daemon is shutting down")
+            backend = self._backends.get(root)
+            if backend is None:
+                backend = self._backends[root] = SharedServer(self, root, self._server_command, self._enable_logging)
+            return backend
+
+    def backend_idle(self, backend: SharedServer):
+        timer = threading.Timer(self.linger, self._stop_idle, args=(backend,))
+        timer.daemon = True
+        timer.start()
+
+    def _stop_idle(self, backend: SharedServer):
+        with self._lock:
+            if backend.connections or self._backends.get(backend.root_folder) is not backend:
+                return
+            del self._backends[backend.root_folder]
+        backend.shutdown()
+
+    def discard(self, backend: SharedServer):
+        # A server that failed to initialize, the next connection starts a new one
+        with self._lock:
+            if self._backends.get(backend.root_folder) is backend:
+                del self._backends[backend.root_folder]
+        threading.Thread(target=backend.abort, daemon=True).start()
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.socket_path)
+        self._listener.listen(64)
+        try:
+            while not self._closed:
+                sock, _ = self._listener.accept()
+                Connection(self, sock)
+        except OSError:
+            if not self._closed:
+                raise
+
+    def get_stats(self) -> Dict[str, dict]:
+        with self._lock:
+            backends = list(self._backends.values())
+        return {backend.root_folder: backend.get_stats() for backend in backends}
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            backends = list(self._backends.values())
+            self._backends.clear()
+        if self._listener is not None:
+            self._listener.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        for backend in backends:
+            backend.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shares one language server per root folder between clients')
+    parser.add_argument('--socket', default=os.environ.get('LSPCLIENT_DAEMON', ''),
+                        help='Unix socket to listen on, defaults to $LSPCLIENT_DAEMON')
+    parser.add_argument('--linger', type=float, default=30.0,
+                        help='Seconds an unused server keeps running')
+    parser.add_argument('--log', action='store_true', help='Write rpc.log and rpc_session.bin per server')
+    parser.add_argument('command', nargs=argparse.REMAINDER, help='Server command, clangd by default')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error('--socket or LSPCLIENT_DAEMON is required')
+    command = args.command[1:] if args.command[:1] == ['--'] else args.command
+    daemon = Daemon(args.socket, command or None, args.linger, args.log)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f'daemon: {daemon.get_stats()}', file=sys.stderr)
+        daemon.shutdown()
+
+
+if __name__ == '__main__':
+    main()
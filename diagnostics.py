@@ -0,0 +1,135 @@
+import threading
+import time
+import traceback
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Callable, Dict, List, Optional
+
+
+class DiagnosticsEntry:
+    # Diagnostics of one document version, with an interval index built on first query
+    __slots__ = ('uri', 'version', 'diagnostics', '_order', '_starts', '_max_ends')
+
+    def __init__(self, uri: str, version: Optional[int], diagnostics: List[dict]):
+        self.uri = uri
+        self.version = version
+        self.diagnostics = diagnostics
+        self._order: Optional[List[dict]] = None
+        self._starts: List[int] = []
+        self._max_ends: List[int] = []
+
+    def _build_index(self):
+        order = sorted(self.diagnostics, key=lambda d: d.get('range').get('start').get('line'))
+        self._starts = [d.get('range').get('start').get('line') for d in order]
+        # Running maximum of end rows, so everything before the first index reaching a row ends above it
+        self._max_ends = list(accumulate((d.get('range').get('end').get('line') for d in order), max))
+        self._order = order
+
+    def overlapping(self, first_row: int, last_row: int) -> List[dict]:
+        if self._order is None:
+            self._build_index()
+        begin = bisect_left(self._max_ends, first_row)
+        end = bisect_right(self._starts, last_row)
+        return [d for d in self._order[begin:end] if d.get('range').get('end').get('line') >= first_row]
+
+
+class DiagnosticsStore:
+    def __init__(self, min_interval: float = 0.05, version_lookup: Optional[Callable[[str], Optional[int]]] = None):
+        self.min_interval = min_interval
+        self._version_lookup = version_lookup
+        self._entries: Dict[str, DiagnosticsEntry] = {}
+        self._pending: Dict[str, dict] = {}
+        self._listeners: List[Callable[[dict], None]] = []
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.counters = {'published': 0, 'stale': 0, 'coalesced': 0, 'delivered': 0, 'listener_errors': 0}
+
+    def publish(self, params: dict) -> bool:
+        # Called on the I/O thread, only records the diagnostics and wakes the delivery thread
+        uri = params.get('uri')
+        version = params.get('version')
+        with self._condition:
+            self.counters['published'] += 1
+            if version is not None:
+                current = self._version_lookup(uri) if self._version_lookup else None
+                previous = self._entries.get(uri)
+                if (current is not None and version < current) or \
+                        (previous is not None and previous.version is not None and version < previous.version):
+                    self.counters['stale'] += 1
+                    return False
+            self._entries[uri] = DiagnosticsEntry(uri, version, params.get('diagnostics', []))
+            if self._listeners:
+                if uri in self._pending:
+                    self.counters['coalesced'] += 1
+                    del self._pending[uri]
+                self._pending[uri] = params
+                self._condition.notify()
+        return True
+
+    def get(self, uri: str) -> List[dict]:
+        with self._condition:
+            entry = self._entries.get(uri)
+        return entry.diagnostics if entry is not None else []
+
+    def get_version(self, uri: str) -> Optional[int]:
+        with self._condition:
+            entry = self._entries.get(uri)
+        return entry.version if entry is not None else None
+
+    def overlapping(self, uri: str, first_row: int, last_row: int) -> List[dict]:
+        with self._condition:
+            entry = self._entries.get(uri)
+        return entry.overlapping(first_row, last_row) if entry is not None else []
+
+    def uris(self) -> List[str]:
+        with self._condition:
+            return list(self._entries.keys())
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        with self._condition:
+            self._listeners.append(listener)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._delivery_thread, daemon=True)
+                self._thread.start()
+
+    def remove_listener(self, listener: Callable[[dict], None]):
+        with self._condition:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _delivery_thread(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                pending = self._pending
+                self._pending = {}
+                listeners = list(self._listeners)
+            for params in pending.values():
+                for listener in listeners:
+                    try:
+                        listener(params)
+                    except Exception:
+                        # A failing listener must not stop deliveries to the others
+                        self.counters['listener_errors'] += 1
+                        traceback.print_exc()
+                self.counters['delivered'] += 1
+            # Rate limit, publishes arriving meanwhile are coalesced per document
+            deadline = time.monotonic() + self.min_interval
+            with self._condition:
+                while not self._closed and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._condition:
+            return dict(self.counters, documents=len(self._entries), pending=len(self._pending))
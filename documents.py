@@ -0,0 +1,133 @@
+from typing import Dict, List, Optional, Set, Tuple
+from .completion import CompletionCache
+from .diagnostics import DiagnosticsStore
+from .message import DidChangeMessage, DidCloseMessage, DidOpenMessage, FileContent, Message, get_file, pin_file, \
+    unpin_file
+from .querycache import QueryCache
+from .semantic import SemanticTokenStore
+from .textdiff import content_changes
+
+
+class DocumentTracker:
+    # Open documents, their synchronization with the server and the caches that follow their edits,
+    # shared by LSPClient and AsyncLSPClient. Clients call _init_documents() before anything can reach
+    # handle_capabilities() and provide send_message(msg).
+    def _init_documents(self):
+        self.capabilities = {}
+        self._open_files: Set[str] = set()
+        self._open_uris: Dict[str, FileContent] = {}
+        self.incremental_sync = True
+        self.completion_cache: Optional[CompletionCache] = None
+        self.query_cache: Optional[QueryCache] = None
+        self.semantic_tokens = SemanticTokenStore()
+        self.diagnostics = DiagnosticsStore(version_lookup=self._document_version)
+        self._semantic_tokens: List[str] = []
+        self._semantic_modifiers: List[str] = []
+
+    def send_message(self, msg: Message):
+        raise RuntimeError("Not implemented")
+
+    def handle_capabilities(self):
+        if 'semanticTokensProvider' in self.capabilities:
+            semantic = self.capabilities.get('semanticTokensProvider')
+            if 'legend' in semantic:
+                legend = semantic.get('legend')
+                self._semantic_modifiers = legend.get("tokenModifiers")
+                self._semantic_tokens = legend.get("tokenTypes")
+                self.semantic_tokens.set_legend(self._semantic_tokens, self._semantic_modifiers)
+
+    def get_coloring_legend(self) -> Tuple[List[str], List[str]]:
+        return self._semantic_tokens, self._semantic_modifiers
+
+    def _document_version(self, uri: str) -> Optional[int]:
+        file = self._open_uris.get(uri)
+        return file.version if file is not None else None
+
+    def is_open_file(self, path):
+        return path in self._open_files
+
+    def open_file_count(self) -> int:
+        return len(self._open_files)
+
+    def open_source_file(self, path):
+        if path not in self._open_files:
+            # A file that can't be read raises before the document counts as open
+            file = pin_file(path)
+            self._open_files.add(path)
+            self._open_uris[file.uri] = file
+            self.send_message(DidOpenMessage(path))
+            return file
+        return None
+
+    def close_source_file(self, path):
+        if path in self._open_files:
+            self._open_files.remove(path)
+            uri = get_file(path).uri
+            self._open_uris.pop(uri, None)
+            if self.completion_cache is not None:
+                self.completion_cache.invalidate(uri)
+            if self.query_cache is not None:
+                self.query_cache.invalidate(uri)
+            self.semantic_tokens.remove(uri)
+            self.send_message(DidCloseMessage(path))
+            unpin_file(path)
+
+    def _release_documents(self):
+        # The server is gone, its documents no longer need to stay resident
+        for path in self._open_files:
+            unpin_file(path)
+        self._open_files.clear()
+        self._open_uris.clear()
+
+    def set_completion_cache(self, cache: Optional[CompletionCache]):
+        self.completion_cache = cache
+
+    def set_query_cache(self, cache: Optional[QueryCache]):
+        self.query_cache = cache
+
+    def _rows_changed(self, file: FileContent, changes: Optional[List[dict]]):
+        if self.completion_cache is None:
+            return
+        if changes is None:
+            self.completion_cache.invalidate(file.uri)
+            return
+        for change in changes:
+            change_range = change.get('range')
+            first_row = change_range.get('start').get('line')
+            last_row = change_range.get('end').get('line')
+            self.completion_cache.document_changed(file.uri, first_row, last_row,
+                                                   change.get('text').count('\n') - (last_row - first_row))
+
+    def modify_source_line(self, path: str, row: int, text: str):
+        file = get_file(path)
+        if file.update_content_line(row, text):
+            if self.completion_cache is not None:
+                self.completion_cache.document_changed(file.uri, row, row, text.count('\n'))
+            if self.query_cache is not None:
+                self.query_cache.document_changed(file.uri)
+            self.send_message(DidChangeMessage(path, [row]))
+
+    def modify_source_ranges(self, path: str, edits: List[Tuple[int, int, int, int, str]]):
+        # Edits (start_row, start_col, end_row, end_col, text) whose ranges the editor already knows,
+        # applied in order. They are sent as they are, without diffing the document.
+        if not edits:
+            return
+        file = get_file(path)
+        file.replace_ranges(edits)
+        changes = [{'range': {'start': {'line': start_row, 'character': start_col},
+                              'end': {'line': end_row, 'character': end_col}},
+                    'text': text} for start_row, start_col, end_row, end_col, text in edits]
+        self._rows_changed(file, changes)
+        if self.query_cache is not None:
+            self.query_cache.document_changed(file.uri)
+        self.send_message(DidChangeMessage(path, [], changes if self.incremental_sync else None))
+
+    def modify_source_file(self, path: str, content: str):
+        file = get_file(path)
+        previous = file.snapshot()
+        if file.update_content(content):
+            changes = content_changes(previous.content, content) if self.incremental_sync else None
+            self._rows_changed(file, changes)
+            if self.query_cache is not None:
+                self.query_cache.document_changed(file.uri)
+            self.send_message(DidChangeMessage(path, [], changes))
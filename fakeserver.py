@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import time
+
+
+def write_message(out, root: dict):
+    payload = json.dumps(root, separators=(',', ':')).encode('utf-8')
+    out.write(f'Content-Length: {len(payload)}\r\n\r\n'.encode('ascii'))
+    out.write(payload)
+    out.flush()
+
+
+def read_message(stream):
+    length = -1
+    while True:
+        line = stream.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        if line.startswith(b'Content-Length: '):
+            length = int(line[16:])
+    if length < 0:
+        raise RuntimeError("Invalid packet")
+    return json.loads(stream.read(length))
+
+
+def line_offset(text: str, line: int, known_line: int = 0, known_offset: int = 0) -> int:
+    # Start of line, counted on from known_line starting at known_offset. The lines are split
+    # off in one call, a find per line made the server's own bookkeeping dominate the benchmarks.
+    rows = line - known_line
+    if rows < 0:
+        rows, known_offset = line, 0
+    if rows == 0:
+        return known_offset
+    rest = (text[known_offset:] if known_offset else text).split('\n', rows)
+    return len(text) - len(rest[-1]) if len(rest) > rows else len(text)
+
+
+def column_offset(text: str, offset: int, units: int) -> int:
+    index = offset
+    while units > 0 and index < len(text) and text[index] != '\n':
+        units -= 2 if ord(text[index]) > 0xFFFF else 1
+        index += 1
+    return index
+
+
+def apply_changes(text: str, changes) -> str:
+    # Lines are counted on from the previous change, edits sent top down don't rescan the document
+    known_line, known_offset = 0, 0
+    for change in changes:
+        if 'range' not in change:
+            text = change.get('text')
+            known_line, known_offset = 0, 0
+            continue
+        start, end = change.get('range').get('start'), change.get('range').get('end')
+        start_line = line_offset(text, start.get('line'), known_line, known_offset)
+        end_line = line_offset(text, end.get('line'), start.get('line'), start_line)
+        start_offset = column_offset(text, start_line, start.get('character'))
+        end_offset = column_offset(text, end_line, end.get('character'))
+        inserted = change.get('text')
+        # A start past the end of the document gives no line to count on from
+        counted = start_line < len(text)
+        text = text[:start_offset] + inserted + text[max(start_offset, end_offset):]
+        if counted:
+            known_line = start.get('line') + inserted.count('\n')
+            known_offset = start_offset + inserted.rfind('\n') + 1 if '\n' in inserted else start_line
+        else:
+            known_line, known_offset = 0, 0
+    return text
+
+
+class FakeServer:
+    def __init__(self, item_count: int, delay: float):
+        self.item_count = item_count
+        self.delay = delay
+        self.documents = {}
+
+    def capabilities(self):
+        return {
+            'textDocumentSync': 2,
+            'completionProvider': {'triggerCharacters': ['.', '>', ':']},
+            'definitionProvider': True,
+            'semanticTokensProvider': {
+                'legend': {'tokenTypes': ['variable', 'function', 'class'],
+                           'tokenModifiers': ['declaration', 'readonly']},
+                'full': {'delta': True}
+            }
+        }
+
+    def completion(self, params):
+        items = []
+        for i in range(self.item_count):
+            label = f'item_{i}'
+            items.append({'label': label, 'filterText': label, 'sortText': f'{i:08d}', 'kind': 3,
+                          'insertText': label})
+        return {'isIncomplete': False, 'items': items}
+
+    def definition(self, params):
+        position = params.get('position')
+        return [{'uri': params.get('textDocument').get('uri'),
+                 'range': {'start': position, 'end': position}}]
+
+    def semantic_tokens(self, params):
+        text = self.documents.get(params.get('textDocument').get('uri'), '')
+        data = []
+        for _ in text.split('\n'):
+            data.extend([1, 0, 1, 0, 0])
+        return {'resultId': '1', 'data': data}
+
+    def handle(self, msg, out):
+        method = msg.get('method')
+        params = msg.get('params', {})
+        if method == 'textDocument/didOpen':
+            doc = params.get('textDocument')
+            self.documents[doc.get('uri')] = doc.get('text')
+            write_message(out, {'jsonrpc': '2.0', 'method': 'textDocument/publishDiagnostics',
+                                'params': {'uri': doc.get('uri'), 'version': doc.get('version'),
+                                           'diagnostics': []}})
+        elif method == 'textDocument/didChange':
+            uri = params.get('textDocument').get('uri')
+            self.documents[uri] = apply_changes(self.documents.get(uri, ''), params.get('contentChanges'))
+        elif method == 'textDocument/didClose':
+            self.documents.pop(params.get('textDocument').get('uri'), None)
+        if 'id' not in msg:
+            return method != 'exit'
+        result = None
+        if method == 'initialize':
+            result = {'capabilities': self.capabilities()}
+        elif method == 'textDocument/completion':
+            result = self.completion(params)
+        elif method == 'textDocument/definition':
+            result = self.definition(params)
+        elif method == 'workspace/symbol':
+            result = [{'name': params.get('query'), 'kind': 12,
+                       'location': {'uri': uri, 'range': {'start': {'line': 0, 'character': 0},
+                                                          'end': {'line': 0, 'character': 0}}}}
+                      for uri in self.documents]
+        elif method == 'fake/documentText':
+            result = self.documents.get(params.get('textDocument').get('uri'))
+        elif method.startswith('textDocument/semanticTokens'):
+            result = self.semantic_tokens(params)
+        if self.delay > 0:
+            time.sleep(self.delay)
+        if method.startswith('$/'):
+            write_message(out, {'jsonrpc': '2.0', 'id': msg.get('id'),
+                                'error': {'code': -32601, 'message': f'Unknown method {method}'}})
+            return True
+        write_message(out, {'jsonrpc': '2.0', 'id': msg.get('id'), 'result': result})
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Minimal LSP server for benchmarks')
+    parser.add_argument('--items', type=int, default=50, help='Completion items per response')
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to wait before responding')
+    args = parser.parse_args()
+    server = FakeServer(args.items, args.delay)
+    stream = os.fdopen(sys.stdin.fileno(), 'rb', buffering=65536)
+    out = sys.stdout.buffer
+    while True:
+        msg = read_message(stream)
+        if msg is None or not server.handle(msg, out):
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import os
+from typing import Iterator, Optional, Tuple
+
+header_terminator = b'\r\n\r\n'
+content_length_header = b'content-length:'
+
+
+def parse_header(header: bytes) -> int:
+    for line in header.split(b'\r\n'):
+        if line[:len(content_length_header)].lower() == content_length_header:
+            return int(line[len(content_length_header):])
+    raise RuntimeError("Invalid packet")
+
+
+class MessageParser:
+    # Incremental Content-Length framing over one reusable buffer.
+    # Views handed out by messages() stay valid until the next read_from/feed call.
+    def __init__(self, capacity: int = 1 << 20, chunk_size: int = 65536):
+        self._data = bytearray(capacity)
+        self._view = memoryview(self._data)
+        self._chunk_size = chunk_size
+        self._start = 0
+        self._end = 0
+        self._body_start = -1
+        self._length = -1
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    @property
+    def pending(self):
+        return self._end - self._start
+
+    def _reserve(self, size: int):
+        if len(self._data) - self._end >= size:
+            return
+        used = self._end - self._start
+        if used + size > len(self._data):
+            # Replace instead of resizing, views into the old buffer may still be exported
+            data = bytearray(max(2 * len(self._data), used + size))
+            data[0:used] = self._view[self._start:self._end]
+            self._data = data
+            self._view = memoryview(data)
+        elif used > 0:
+            self._view[0:used] = self._view[self._start:self._end]
+        if self._body_start >= 0:
+            self._body_start -= self._start
+        self._start = 0
+        self._end = used
+
+    def _read_size(self) -> int:
+        if self._length >= 0:
+            return max(self._chunk_size, self._body_start + self._length - self._end)
+        return self._chunk_size
+
+    def read_from(self, fd: int) -> Optional[memoryview]:
+        # Returns the bytes just read, an empty view on EOF and None if the read would block
+        self._reserve(self._read_size())
+        try:
+            n = os.readv(fd, [self._view[self._end:]])
+        except BlockingIOError:
+            return None
+        self._end += n
+        return self._view[self._end - n:self._end]
+
+    def feed(self, data):
+        n = len(data)
+        self._reserve(n)
+        self._view[self._end:self._end + n] = data
+        self._end += n
+
+    def messages(self) -> Iterator[Tuple[memoryview, memoryview]]:
+        # Yields (frame, body) for every complete message in the buffer
+        while True:
+            if self._length < 0:
+                pos = self._data.find(header_terminator, self._start, self._end)
+                if pos < 0:
+                    return
+                self._length = parse_header(bytes(self._view[self._start:pos]))
+                self._body_start = pos + len(header_terminator)
+            body_end = self._body_start + self._length
+            if body_end > self._end:
+                return
+            frame = self._view[self._start:body_end]
+            body = self._view[self._body_start:body_end]
+            self._start = body_end
+            self._body_start = -1
+            self._length = -1
+            if self._start == self._end:
+                self._start = self._end = 0
+            yield frame, body
@@ -0,0 +1,405 @@
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    from .binarylog import (block_header, compression_none, decompress_block, file_header, record_header,
+                            v1_record_header, v2_magic)
+    from .framing import header_terminator, parse_header
+except ImportError:
+    # binlogvis runs as a script next to this module
+    from binarylog import (block_header, compression_none, decompress_block, file_header, record_header,
+                           v1_record_header, v2_magic)
+    from framing import header_terminator, parse_header
+
+# The sidecar index (<log>.idx) holds a header, one fixed size entry per framed message and
+# a table of method names. It is valid as long as the log size and mtime match the header.
+index_magic = b'LSPIDX01'
+index_header = struct.Struct('<8sQQI')
+# block offset, body offset in the block, body length, timestamp, id, direction, method index
+index_entry = struct.Struct('<QIIqqBH')
+method_pattern = re.compile(rb'"method"\s*:\s*"([^"]*)"')
+method_scan_size = 1024
+no_id = -1
+no_method = 0xFFFF
+
+
+def encode_id(message_id) -> int:
+    # Numeric ids are stored as is, other ids as a negative hash
+    if message_id is None:
+        return no_id
+    text = str(message_id)
+    if text.isdigit():
+        return int(text)
+    return -2 - zlib.crc32(text.encode('utf-8'))
+
+
+class LogEntry:
+    __slots__ = ('index', 'timestamp', 'direction', 'message_id', 'method', 'size', '_reader', '_location')
+
+    def __init__(self, reader: 'LogReader', index: int, location: Tuple[int, int, int], timestamp: Optional[int],
+                 direction: int, message_id: int, method: Optional[str]):
+        self._reader = reader
+        self._location = location
+        self.index = index
+        # time.monotonic_ns() when the message was logged, None for v1 logs
+        self.timestamp = timestamp
+        self.direction = direction
+        self.message_id = message_id
+        self.method = method
+        self.size = location[2]
+
+    @property
+    def is_request(self) -> bool:
+        return self.method is not None and self.message_id != no_id
+
+    @property
+    def is_response(self) -> bool:
+        return self.method is None and self.message_id != no_id
+
+    def body(self) -> memoryview:
+        return self._reader.body(self._location)
+
+    def json(self) -> dict:
+        return json.loads(str(self.body(), 'utf-8'))
+
+
+class LogReader:
+    # Random access to the framed messages of a v1 or v2 log. The log is memory mapped and
+    # bodies are only sliced, decompressed or parsed when asked for.
+    def __init__(self, path: str, use_sidecar=True):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.fstat(self._file.fileno()).st_size > 0 else b''
+        self.version = 1
+        self.compression = compression_none
+        self._data_start = 0
+        if self._map[:len(v2_magic)] == v2_magic:
+            _, self.version, self.compression = file_header.unpack_from(self._map, 0)
+            self._data_start = file_header.size
+        self._block_cache: Tuple[int, bytes] = (-1, b'')
+        self._index_file = None
+        self._index = b''
+        self._count = 0
+        self._methods: List[str] = []
+        index_path = path + '.idx'
+        if not use_sidecar or not self._load_index(index_path):
+            self._build_index(index_path if use_sidecar else '')
+
+    def close(self):
+        if self._index_file is not None:
+            self._index.close()
+            self._index_file.close()
+            self._index_file = None
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _blocks(self) -> Iterator[Tuple[int, int, bytes, int, int]]:
+        # Yields (block offset, direction, buffer, start, end), direction is -1 for v2 blocks.
+        # A log that is still being written may end in a partial record or block, reading stops before it.
+        pos = self._data_start
+        end = len(self._map)
+        if self.version == 1:
+            while pos + v1_record_header.size <= end:
+                direction, size = v1_record_header.unpack_from(self._map, pos)
+                start = pos + v1_record_header.size
+                if start + size > end:
+                    return
+                yield pos, direction, self._map, start, start + size
+                pos = start + size
+            return
+        while pos + block_header.size <= end:
+            size, raw_size, count = block_header.unpack_from(self._map, pos)
+            start = pos + block_header.size
+            if start + size > end:
+                return
+            if self.compression == compression_none:
+                yield pos, -1, self._map, start, start + size
+            else:
+                try:
+                    data = decompress_block(self._map[start:start + size], self.compression)
+                except Exception:
+                    # zlib.error or zstandard.ZstdError, a block whose bytes are not all written yet
+                    return
+                yield pos, -1, data, 0, raw_size
+            pos = start + size
+
+    @staticmethod
+    def _frames(buffer, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        # Yields (body start, body length) of the messages framed in buffer[start:end]
+        while start < end:
+            pos = buffer.find(header_terminator, start, end)
+            if pos < 0:
+                return
+            length = parse_header(buffer[start:pos])
+            start = pos + len(header_terminator)
+            yield start, length
+            start += length
+
+    @staticmethod
+    def _identify(body: bytes, record_id: Optional[str]) -> Tuple[int, Optional[str]]:
+        # Only the head of a message is searched for its method, requests and notifications carry it
+        # before their params. v1 records have no id, these messages are parsed once while indexing.
+        match = method_pattern.search(body, 0, method_scan_size)
+        method = match.group(1).decode('utf-8') if match else None
+        if record_id is not None:
+            return encode_id(record_id), method
+        try:
+            msg = json.loads(body)
+        except ValueError:
+            return no_id, method
+        return encode_id(msg.get('id')), msg.get('method', method)
+
+    def _scan(self) -> Iterator[Tuple[int, int, int, int, int, int, Optional[str]]]:
+        for block, direction, buffer, start, end in self._blocks():
+            if direction >= 0:
+                for body, length in self._frames(buffer, start, end):
+                    message_id, method = self._identify(buffer[body:body + length], None)
+                    yield block, body - start, length, -1, direction, message_id, method
+                continue
+            pos = start
+            while pos < end:
+                timestamp, direction, id_size, data_size = record_header.unpack_from(buffer, pos)
+                pos += record_header.size
+                record_id = buffer[pos:pos + id_size].decode('utf-8') if id_size else None
+                pos += id_size
+                for body, length in self._frames(buffer, pos, pos + data_size):
+                    message_id, method = self._identify(buffer[body:body + length], record_id)
+                    yield block, body - start, length, timestamp, direction, message_id, method
+                pos += data_size
+
+    def _build_index(self, index_path: str):
+        # Entries are streamed to a temporary file, only the method table is kept in memory
+        stat = os.fstat(self._file.fileno())
+        methods: Dict[str, int] = {}
+        count = 0
+        target = index_path + '.tmp' if index_path else ''
+        out = open(target, 'w+b') if target else _BytesSink()
+        try:
+            out.write(index_header.pack(index_magic, stat.st_size, stat.st_mtime_ns, 0))
+            for block, offset, length, timestamp, direction, message_id, method in self._scan():
+                method_index = no_method if method is None else methods.setdefault(method, len(methods))
+                out.write(index_entry.pack(block, offset, length, timestamp, message_id, direction, method_index))
+                count += 1
+            table = [struct.pack('<I', len(methods))]
+            for name in methods:
+                encoded = name.encode('utf-8')
+                table.append(struct.pack('<H', len(encoded)))
+                table.append(encoded)
+            out.write(b''.join(table))
+            out.seek(0)
+            out.write(index_header.pack(index_magic, stat.st_size, stat.st_mtime_ns, count))
+        finally:
+            out.close()
+        if target:
+            os.replace(target, index_path)
+            self._load_index(index_path)
+        else:
+            self._use_index(out.getvalue(), count)
+
+    def _load_index(self, index_path: str) -> bool:
+        try:
+            index_file = open(index_path, 'rb')
+        except OSError:
+            return False
+        stat = os.fstat(self._file.fileno())
+        header = index_file.read(index_header.size)
+        if len(header) == index_header.size:
+            magic, size, mtime, count = index_header.unpack(header)
+            if magic == index_magic and size == stat.st_size and mtime == stat.st_mtime_ns:
+                self._index_file = index_file
+                self._use_index(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ), count)
+                return True
+        index_file.close()
+        return False
+
+    def _use_index(self, data, count: int):
+        self._index = data
+        self._count = count
+        pos = index_header.size + count * index_entry.size
+        n, = struct.unpack_from('<I', data, pos)
+        pos += 4
+        self._methods = []
+        for _ in range(n):
+            size, = struct.unpack_from('<H', data, pos)
+            self._methods.append(data[pos + 2:pos + 2 + size].decode('utf-8'))
+            pos += 2 + size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index: int) -> LogEntry:
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        block, offset, length, timestamp, message_id, direction, method_index = \
+            index_entry.unpack_from(self._index, index_header.size + index * index_entry.size)
+        method = self._methods[method_index] if method_index != no_method else None
+        return LogEntry(self, index, (block, offset, length), timestamp if timestamp >= 0 else None,
+                        direction, message_id, method)
+
+    def __iter__(self) -> Iterator[LogEntry]:
+        for i in range(self._count):
+            yield self[i]
+
+    @property
+    def methods(self) -> List[str]:
+        return list(self._methods)
+
+    def body(self, location: Tuple[int, int, int]) -> memoryview:
+        block, offset, length = location
+        if self.version == 1:
+            start = block + v1_record_header.size + offset
+            return memoryview(self._map)[start:start + length]
+        if self.compression == compression_none:
+            start = block + block_header.size + offset
+            return memoryview(self._map)[start:start + length]
+        # Consecutive entries usually share a block, keep the last one decompressed
+        if self._block_cache[0] != block:
+            size, _, _ = block_header.unpack_from(self._map, block)
+            start = block + block_header.size
+            self._block_cache = (block, decompress_block(self._map[start:start + size], self.compression))
+        return memoryview(self._block_cache[1])[offset:offset + length]
+
+    def select(self, method: Optional[str] = None, message_id=None, direction: Optional[int] = None) \
+            -> Iterator[LogEntry]:
+        # Filters on indexed fields only, responses match the method of their request
+        wanted_id = encode_id(message_id) if message_id is not None else None
+        pending: Dict[Tuple[int, int], str] = {}
+        for entry in self:
+            if entry.is_request:
+                pending[(entry.direction, entry.message_id)] = entry.method
+            entry_method = entry.method
+            if entry.is_response:
+                entry_method = pending.pop((1 - entry.direction, entry.message_id), None)
+            if method is not None and entry_method != method:
+                continue
+            if wanted_id is not None and entry.message_id != wanted_id:
+                continue
+            if direction is not None and entry.direction != direction:
+                continue
+            yield entry
+
+    def pairs(self) -> Iterator[Tuple[LogEntry, Optional[LogEntry]]]:
+        # Yields (request, response) in response order, then requests that never got one.
+        # Only outstanding requests are held in memory.
+        pending: Dict[Tuple[int, int], LogEntry] = {}
+        for entry in self:
+            if entry.is_request:
+                pending[(entry.direction, entry.message_id)] = entry
+            elif entry.is_response:
+                request = pending.pop((1 - entry.direction, entry.message_id), None)
+                if request is not None:
+                    yield request, entry
+        for request in pending.values():
+            yield request, None
+
+
+class _BytesSink:
+    # Seekable in-memory output, used when no sidecar file is written
+    def __init__(self):
+        self._data = bytearray()
+        self._pos = 0
+
+    def write(self, data: bytes):
+        self._data[self._pos:self._pos + len(data)] = data
+        self._pos += len(data)
+
+    def seek(self, pos: int):
+        self._pos = pos
+
+    def close(self):
+        pass
+
+    def getvalue(self) -> bytes:
+        return bytes(self._data)
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_stats(reader: LogReader, method: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    # Request to response time in milliseconds per method, needs a v2 log
+    latencies: Dict[str, List[float]] = {}
+    unanswered: Dict[str, int] = {}
+    for request, response in reader.pairs():
+        if method is not None and request.method != method:
+            continue
+        if response is None:
+            unanswered[request.method] = unanswered.get(request.method, 0) + 1
+        elif request.timestamp is not None:
+            latencies.setdefault(request.method, []).append((response.timestamp - request.timestamp) / 1e6)
+    stats = {}
+    for name in sorted(set(latencies) | set(unanswered)):
+        values = latencies.get(name, [])
+        stats[name] = {'count': len(values), 'unanswered': unanswered.get(name, 0)}
+        if values:
+            stats[name].update(p50=percentile(values, 0.5), p90=percentile(values, 0.9),
+                               p99=percentile(values, 0.99), max=max(values))
+    return stats
+
+
+def format_entry(entry: LogEntry, origin: Optional[int]) -> str:
+    when = f'{(entry.timestamp - origin) / 1e6:12.3f}' if entry.timestamp is not None else ''
+    arrow = '>' if entry.direction > 0 else '<'
+    message_id = entry.message_id if entry.message_id >= 0 else '-'
+    return f'{entry.index:8} {when} {arrow} {message_id:>8} {entry.method or ""} ({entry.size} bytes)'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect rpc_session.bin logs')
+    parser.add_argument('path', nargs='?', default='rpc_session.bin')
+    parser.add_argument('--method', help='Only messages of this method, including responses to it')
+    parser.add_argument('--id', help='Only messages with this id')
+    parser.add_argument('--direction', choices=['in', 'out'])
+    parser.add_argument('--body', action='store_true', help='Print the JSON of each message')
+    parser.add_argument('--pairs', action='store_true', help='List requests with their response latency')
+    parser.add_argument('--stats', action='store_true', help='Print latency percentiles per method')
+    parser.add_argument('--no-index', action='store_true', help="Don't read or write the sidecar index")
+    args = parser.parse_args()
+    with LogReader(args.path, not args.no_index) as reader:
+        origin = reader[0].timestamp if len(reader) > 0 else None
+        if args.stats:
+            print(f'{"method":40} {"count":>7} {"lost":>5} {"p50":>9} {"p90":>9} {"p99":>9} {"max":>9}')
+            for name, s in latency_stats(reader, args.method).items():
+                times = ' '.join(f'{s.get(k):9.3f}' if k in s else f'{"-":>9}' for k in ('p50', 'p90', 'p99', 'max'))
+                print(f'{name:40} {s.get("count"):7} {s.get("unanswered"):5} {times}')
+        elif args.pairs:
+            for request, response in reader.pairs():
+                if args.method is not None and request.method != args.method:
+                    continue
+                if args.id is not None and request.message_id != encode_id(args.id):
+                    continue
+                latency = 'no response'
+                if response is not None and request.timestamp is not None:
+                    latency = f'{(response.timestamp - request.timestamp) / 1e6:.3f} ms'
+                print(f'{format_entry(request, origin)} -> {latency}')
+        else:
+            direction = {'in': 0, 'out': 1}.get(args.direction)
+            for entry in reader.select(args.method, args.id, direction):
+                print(format_entry(entry, origin))
+                if args.body:
+                    print(json.dumps(entry.json(), indent=4, sort_keys=True))
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except BrokenPipeError:
+        sys.exit(0)
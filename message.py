@@ -1,17 +1,15 @@
 import json
 import os
 import threading
-from typing import List
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from . import codec
+from .rope import Rope
 
 
-def serialize(root: dict):
-    text = json.dumps(root, separators=(',', ':'))
-    payload = bytes(text, 'ascii')
-    packet = bytearray()
-    n = len(payload)
-    packet.extend(bytes(f'Content-Length: {n}\r\n\r\n', 'ascii'))
-    packet.extend(payload)
-    return bytes(packet)
+def serialize(root: dict) -> bytes:
+    header, payload = codec.frame(root)
+    return header + payload
 
 
 def uri(path):
@@ -22,14 +20,26 @@ def clamp(n, min_val, max_val):
     return max(min_val, min(n, max_val))
 
 
+class DocumentSnapshot:
+    __slots__ = ('version', 'rope')
+
+    def __init__(self, version: int, rope: Rope):
+        self.version = version
+        self.rope = rope
+
+    @property
+    def content(self):
+        return self.rope.text()
+
+
 class FileContent:
-    def __init__(self, path: str):
+    def __init__(self, path: str, history_size: int = 16):
         self._path = os.path.abspath(path)
         self._version = 1
         self._uri = uri(self._path)
-        self._content: List[str] = []
         with open(self._path, 'r') as f:
-            self._content = [line.rstrip() for line in f.readlines()]
+            self._rope = Rope('\n'.join([line.rstrip() for line in f]))
+        self._history: Deque[DocumentSnapshot] = deque(maxlen=history_size)
 
     @property
     def uri(self):
@@ -39,43 +49,100 @@ class FileContent:
     def version(self):
         return self._version
 
+    @property
+    def modified(self):
+        # Changed since it was read, the file on disk no longer has this content
+        return self._version > 1
+
     @property
     def content(self):
-        return '\n'.join(self._content)
+        return self._rope.text()
+
+    @property
+    def rope(self):
+        return self._rope
+
+    @property
+    def line_count(self):
+        return self._rope.line_count
+
+    def snapshot(self) -> DocumentSnapshot:
+        return DocumentSnapshot(self._version, self._rope)
+
+    def get_snapshot(self, version: int) -> Optional[DocumentSnapshot]:
+        if version == self._version:
+            return self.snapshot()
+        for snapshot in self._history:
+            if snapshot.version == version:
+                return snapshot
+        return None
+
+    def _set_rope(self, rope: Rope):
+        self._history.append(self.snapshot())
+        self._rope = rope
+        self._version += 1
 
     def update_content_line(self, row: int, text: str):
-        if 0 <= row < len(self._content):
-            self._content[row] = text
-            self._version += 1
+        if 0 <= row < self._rope.line_count:
+            self._set_rope(self._rope.replace(self._rope.line_start(row), self._rope.line_end(row), text))
             return True
         return False
 
+    def replace_range(self, start_row: int, start_col: int, end_row: int, end_col: int, text: str):
+        self.replace_ranges([(start_row, start_col, end_row, end_col, text)])
+
+    def replace_ranges(self, edits: List[Tuple[int, int, int, int, str]]):
+        # Positions are LSP positions, columns count UTF-16 code units. The edits are applied in
+        # order, each to the text the ones before it produced, as one new version.
+        rope = self._rope
+        for start_row, start_col, end_row, end_col, text in edits:
+            start = rope.offset_at(start_row, start_col)
+            end = rope.offset_at(end_row, end_col)
+            rope = rope.replace(start, max(start, end), text)
+        self._set_rope(rope)
+
+    def insert(self, offset: int, text: str):
+        self._set_rope(self._rope.insert(offset, text))
+
+    def delete(self, start: int, end: int):
+        self._set_rope(self._rope.delete(start, end))
+
     def get_rows_text(self, start: int, end: int):
-        n = len(self._content)
-        if n == 0:
-            return []
+        n = self._rope.line_count
         start = clamp(start, 0, n - 1)
         end = clamp(end, 0, n - 1)
-        return self._content[start:(end + 1)]
+        return self._rope.substring(self._rope.line_start(start), self._rope.line_end(end)).split('\n')
 
     def update_content(self, value):
         content = ''
         if isinstance(value, str):
-            content = value.split('\n')
-        elif isinstance(value, list):
             content = value
+        elif isinstance(value, list):
+            content = '\n'.join(value)
         else:
             raise RuntimeError("Invalid content")
-        if content == self._content:
+        if len(content) == len(self._rope) and content == self.content:
             return False
-        self._content = content
-        self._version += 1
+        self._set_rope(Rope(content))
         return True
 
 
+# Requests a newer request of the same method for the same document makes obsolete
+default_superseded_methods = frozenset({'textDocument/completion', 'textDocument/signatureHelp',
+                                        'textDocument/semanticTokens/full',
+                                        'textDocument/semanticTokens/full/delta'})
+
 _files_lock = threading.Lock()
 _last_id = 0
-_files = {}
+_files: Dict[str, FileContent] = {}
+# Documents stay resident while a client has them open (pinned) or after they were modified.
+# Other documents are kept in least recently used order up to max_cached_bytes, and read
+# from disk again when they are needed after being evicted.
+max_cached_bytes = 64 << 20
+_pins: Dict[str, int] = {}
+_cached: 'OrderedDict[str, int]' = OrderedDict()
+_cached_bytes = 0
+_file_counters = {'hits': 0, 'loads': 0, 'evicted': 0, 'evicted_bytes': 0}
 
 
 def generate_id() -> str:
@@ -84,15 +151,100 @@ def generate_id() -> str:
     return str(_last_id)
 
 
-def get_file(path: str):
+def _cache(path: str, file: FileContent):
+    global _cached_bytes
+    size = len(file.rope)
+    _cached[path] = size
+    _cached_bytes += size
+    while _cached_bytes > max_cached_bytes and _cached:
+        evicted, size = _cached.popitem(last=False)
+        _cached_bytes -= size
+        if _files.get(evicted).modified:
+            # Modified while closed, its content exists nowhere else
+            continue
+        del _files[evicted]
+        _file_counters['evicted'] += 1
+        _file_counters['evicted_bytes'] += size
+
+
+def _uncache(path: str):
+    global _cached_bytes
+    size = _cached.pop(path, None)
+    if size is not None:
+        _cached_bytes -= size
+
+
+def _load(path: str, pin: bool) -> FileContent:
+    with _files_lock:
+        file = _files.get(path)
+        if file is not None:
+            _file_counters['hits'] += 1
+            if pin:
+                _pins[path] = _pins.get(path, 0) + 1
+                _uncache(path)
+            elif path in _cached:
+                _cached.move_to_end(path)
+            return file
+    # Read without holding the lock, a concurrent read of the same path loses the race
+    file = FileContent(path)
     with _files_lock:
         if path in _files:
-            return _files.get(path)
-        file = FileContent(path)
-        _files[path] = file
+            file = _files.get(path)
+        else:
+            _files[path] = file
+            _file_counters['loads'] += 1
+        if pin:
+            _pins[path] = _pins.get(path, 0) + 1
+            _uncache(path)
+        elif path not in _pins and path not in _cached and not file.modified:
+            _cache(path, file)
         return file
 
 
+def get_file(path: str) -> FileContent:
+    return _load(path, False)
+
+
+def pin_file(path: str) -> FileContent:
+    # Keeps the document resident until every pin_file is matched by unpin_file
+    return _load(path, True)
+
+
+def unpin_file(path: str):
+    with _files_lock:
+        count = _pins.get(path, 0) - 1
+        if count > 0:
+            _pins[path] = count
+            return
+        _pins.pop(path, None)
+        file = _files.get(path)
+        if file is not None and not file.modified:
+            _cache(path, file)
+
+
+def discard_file(path: str) -> bool:
+    # Forgets a document that is not open, including changes made to it
+    with _files_lock:
+        if path in _pins or path not in _files:
+            return False
+        _uncache(path)
+        del _files[path]
+        return True
+
+
+def file_stats() -> Dict[str, int]:
+    # Sizes count characters, which is the byte size of ASCII sources
+    with _files_lock:
+        return dict(_file_counters,
+                    documents=len(_files),
+                    pinned=len(_pins),
+                    cached=len(_cached),
+                    modified=sum(1 for file in _files.values() if file.modified),
+                    resident_bytes=sum(len(file.rope) for file in _files.values()),
+                    cached_bytes=_cached_bytes,
+                    max_cached_bytes=max_cached_bytes)
+
+
 class Message:
     def __init__(self, method: str):
         self.root = {'jsonrpc': '2.0', 'method': method}
@@ -123,6 +275,9 @@ class InitMessage(QueryMessage):
                 "definition": {
                     "dynamicRegistration": True,
                     "linkSupport": True
+                },
+                "publishDiagnostics": {
+                    "versionSupport": True
                 }
             }
         }
@@ -153,13 +308,16 @@ class DidCloseMessage(Message):
 
 
 class DidChangeMessage(Message):
-    def __init__(self, path: str, rows: List[int]):
+    def __init__(self, path: str, rows: List[int], changes: Optional[List[dict]] = None):
         super().__init__('textDocument/didChange')
         file: FileContent = get_file(path)
         self.params['textDocument'] = {
             'uri': file.uri,
             'version': file.version
         }
+        if changes is not None:
+            self.params['contentChanges'] = changes
+            return
         details = {}
         if len(rows) == 0:
             details['text'] = file.content
@@ -173,6 +331,26 @@ class DidChangeMessage(Message):
         self.params['contentChanges'] = [details]
 
 
+# Error code of the response handlers of cancelled and expired requests receive
+request_cancelled = -32800
+
+
+def cancelled_response(message_id: str, reason: str) -> dict:
+    return {'jsonrpc': '2.0', 'id': message_id, 'error': {'code': request_cancelled, 'message': reason}}
+
+
+class CancelMessage(Message):
+    def __init__(self, message_id: str):
+        super().__init__('$/cancelRequest')
+        self.params['id'] = message_id
+
+
+class PingMessage(QueryMessage):
+    # Servers answer $/ requests they don't know with an error, after handling the messages before it
+    def __init__(self):
+        super().__init__('$/ping')
+
+
 class PositionalMessage(QueryMessage):
     def __init__(self, method: str, path: str, row: int, col: int):
         super().__init__(method)
@@ -186,6 +364,12 @@ class CompletionMessage(PositionalMessage):
         super().__init__('textDocument/completion', path, row, col)
 
 
+class CompletionResolveMessage(QueryMessage):
+    def __init__(self, item: dict):
+        super().__init__('completionItem/resolve')
+        self.root['params'] = self.params = item
+
+
 class SignatureHelpMessage(PositionalMessage):
     def __init__(self, path: str, row: int, col: int):
         super().__init__('textDocument/signatureHelp', path, row, col)
@@ -196,6 +380,12 @@ class DefinitionMessage(PositionalMessage):
         super().__init__('textDocument/definition', path, row, col)
 
 
+class WorkspaceSymbolMessage(QueryMessage):
+    def __init__(self, query: str):
+        super().__init__('workspace/symbol')
+        self.params['query'] = query
+
+
 class ColoringMessage(QueryMessage):
     def __init__(self, path: str, prev_id: str):
         super().__init__(f'textDocument/semanticTokens/full{"/delta" if prev_id else ""}')
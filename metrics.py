@@ -0,0 +1,152 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional
+
+# Upper bounds of the histogram buckets in seconds, 100us doubling up to ~52s, plus an overflow bucket
+bucket_bounds = [0.0001 * (1 << i) for i in range(20)]
+
+
+class LatencyHistogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.counts[bisect_left(bucket_bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        # Upper bound of the bucket holding the percentile, never above the largest sample
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, n in zip(bucket_bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, float]:
+        return {'count': self.count,
+                'mean_ms': 1000.0 * self.total / self.count if self.count else 0.0,
+                'p50_ms': 1000.0 * self.percentile(0.5),
+                'p90_ms': 1000.0 * self.percentile(0.9),
+                'p99_ms': 1000.0 * self.percentile(0.99),
+                'max_ms': 1000.0 * self.max,
+                'buckets': list(self.counts)}
+
+
+class RequestTiming:
+    # time.monotonic() of each stage, None for stages not reached
+    __slots__ = ('message_id', 'method', 'enqueued', 'written', 'received', 'handled')
+
+    def __init__(self, message_id: str, method: str, enqueued: float):
+        self.message_id = message_id
+        self.method = method
+        self.enqueued = enqueued
+        self.written: Optional[float] = None
+        self.received: Optional[float] = None
+        self.handled: Optional[float] = None
+
+
+class ClientMetrics:
+    # Request stages are split into queue (enqueued to written), server (written to response),
+    # handler (callback run time) and total (enqueued to handler done), per method
+    stages = ('queue', 'server', 'handler', 'total')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, RequestTiming] = {}
+        self._histograms: Dict[str, Dict[str, LatencyHistogram]] = {}
+        self._exporters: List[Callable[[RequestTiming], None]] = []
+        self.started = time.monotonic()
+        self.counters = {'messages_in': 0, 'messages_out': 0, 'bytes_in': 0, 'bytes_out': 0, 'writes': 0,
+                         'requests': 0, 'responses': 0, 'dropped': 0}
+        self.callback_seconds = 0.0
+        self.notification_seconds = 0.0
+
+    def add_exporter(self, exporter: Callable[[RequestTiming], None]):
+        # Exporters receive every completed request on the I/O thread
+        with self._lock:
+            self._exporters.append(exporter)
+
+    def remove_exporter(self, exporter: Callable[[RequestTiming], None]):
+        with self._lock:
+            if exporter in self._exporters:
+                self._exporters.remove(exporter)
+
+    def request_enqueued(self, message_id: str, method: str):
+        timing = RequestTiming(message_id, method, time.monotonic())
+        with self._lock:
+            self._pending[message_id] = timing
+            self.counters['requests'] += 1
+
+    def request_dropped(self, message_id: str):
+        with self._lock:
+            if self._pending.pop(message_id, None) is not None:
+                self.counters['dropped'] += 1
+
+    def messages_written(self, message_ids: List[str], count: int, size: int):
+        now = time.monotonic()
+        with self._lock:
+            for message_id in message_ids:
+                timing = self._pending.get(message_id)
+                if timing is not None:
+                    timing.written = now
+            self.counters['messages_out'] += count
+            self.counters['bytes_out'] += size
+            self.counters['writes'] += 1
+
+    def message_received(self, size: int):
+        self.counters['messages_in'] += 1
+        self.counters['bytes_in'] += size
+
+    def response_received(self, message_id: str) -> Optional[RequestTiming]:
+        with self._lock:
+            timing = self._pending.pop(message_id, None)
+        if timing is not None:
+            timing.received = time.monotonic()
+        return timing
+
+    def handler_done(self, timing: RequestTiming):
+        timing.handled = time.monotonic()
+        handler_time = timing.handled - timing.received
+        with self._lock:
+            self.counters['responses'] += 1
+            self.callback_seconds += handler_time
+            histograms = self._histograms.get(timing.method)
+            if histograms is None:
+                histograms = self._histograms[timing.method] = {stage: LatencyHistogram() for stage in self.stages}
+            written = timing.written if timing.written is not None else timing.enqueued
+            histograms.get('queue').add(written - timing.enqueued)
+            histograms.get('server').add(timing.received - written)
+            histograms.get('handler').add(handler_time)
+            histograms.get('total').add(timing.handled - timing.enqueued)
+            exporters = list(self._exporters)
+        for exporter in exporters:
+            exporter(timing)
+
+    def notification_handled(self, seconds: float):
+        self.notification_seconds += seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            return {'uptime': elapsed,
+                    'counters': dict(self.counters),
+                    'pending': len(self._pending),
+                    'messages_in_per_s': self.counters['messages_in'] / elapsed,
+                    'messages_out_per_s': self.counters['messages_out'] / elapsed,
+                    'callback_seconds': self.callback_seconds,
+                    'notification_seconds': self.notification_seconds,
+                    'methods': {method: {stage: h.as_dict() for stage, h in histograms.items()}
+                                for method, histograms in self._histograms.items()}}
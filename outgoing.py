@@ -0,0 +1,273 @@
+import os
+import select
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from .message import Message
+from .metrics import LatencyHistogram
+
+# Linux IOV_MAX, larger batches are split into several writev calls
+max_iovecs = 1024
+
+
+class SendCounters:
+    def __init__(self):
+        self.queued = 0
+        self.written = 0
+        self.coalesced = 0
+        self.superseded = 0
+        self.writes = 0
+        self.bytes = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+def document_uri(msg: Message) -> Optional[str]:
+    doc = msg.params.get('textDocument')
+    return doc.get('uri') if doc else None
+
+
+def _merge_changes(target: Message, msg: Message, counters: SendCounters):
+    changes = target.params.get('contentChanges') + msg.params.get('contentChanges')
+    last_full = 0
+    for index, change in enumerate(changes):
+        if 'range' not in change:
+            last_full = index
+    counters.superseded += last_full
+    target.params['contentChanges'] = changes[last_full:]
+    target.params['textDocument'] = msg.params.get('textDocument')
+
+
+def coalesce(messages: List[Message], counters: SendCounters) -> List[Message]:
+    # Folds each didChange into the previous didChange of the same document unless a
+    # message referring to that document (or to no document at all) lies in between
+    batch: List[Message] = []
+    open_changes: Dict[str, Message] = {}
+    for msg in messages:
+        method = msg.root.get('method')
+        uri = document_uri(msg)
+        if method == 'textDocument/didChange' and uri in open_changes:
+            _merge_changes(open_changes.get(uri), msg, counters)
+            counters.coalesced += 1
+            continue
+        if uri is None:
+            open_changes.clear()
+        else:
+            open_changes.pop(uri, None)
+        batch.append(msg)
+        if method == 'textDocument/didChange':
+            open_changes[uri] = msg
+    return batch
+
+
+# Priority classes, lower is sent first
+priority_interactive = 0
+priority_sync = 1
+priority_background = 2
+priority_names = ('interactive', 'sync', 'background')
+
+interactive_methods = frozenset({'$/cancelRequest', 'textDocument/completion', 'completionItem/resolve',
+                                 'textDocument/signatureHelp', 'textDocument/hover', 'textDocument/definition',
+                                 'textDocument/declaration', 'textDocument/typeDefinition',
+                                 'textDocument/implementation', 'textDocument/documentHighlight'})
+background_methods = frozenset({'workspace/symbol', 'textDocument/references', 'textDocument/documentSymbol',
+                                'textDocument/semanticTokens/full', 'textDocument/semanticTokens/full/delta',
+                                'textDocument/semanticTokens/range', 'textDocument/foldingRange',
+                                'textDocument/inlayHint', 'textDocument/codeLens', 'textDocument/documentLink'})
+
+
+def is_barrier(msg: Message, uri: Optional[str]) -> bool:
+    # Notifications of no document (initialized, configuration changes, exit) hold back every later
+    # message, messages of higher classes promote them together with everything queued before them
+    return uri is None and 'id' not in msg.root and msg.root.get('method') != '$/cancelRequest'
+
+
+def message_priority(msg: Message) -> int:
+    # Document sync and everything not listed keeps the FIFO order of the sync class
+    method = msg.root.get('method')
+    if method in interactive_methods:
+        return priority_interactive
+    if method in background_methods:
+        return priority_background
+    return priority_sync
+
+
+class OutgoingScheduler:
+    # Outgoing messages by priority class. A message never overtakes an earlier message of the same
+    # document, nor a barrier (see is_barrier): queued messages of that document, and everything up
+    # to the last barrier, in lower classes are promoted ahead of it.
+    # put() blocks while max_pending messages are queued, unless block is false.
+    def __init__(self, max_pending: int = 4096):
+        self.max_pending = max_pending
+        # Entries are [enqueue time, message, uri, barrier], message is None once discarded.
+        # Discarded entries stay queued and counted in _uri_counts until they are taken.
+        self._queues: List[Deque[list]] = [deque() for _ in priority_names]
+        self._uri_counts: List[Dict[str, int]] = [{} for _ in priority_names]
+        self._barriers = [0 for _ in priority_names]
+        self._ids: Dict[str, list] = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self.waits = [LatencyHistogram() for _ in priority_names]
+        self.counters = {'queued': 0, 'promoted': 0, 'discarded': 0, 'blocked': 0}
+
+    def __len__(self):
+        return self._pending
+
+    def _remove_uri(self, priority: int, uri: str):
+        counts = self._uri_counts[priority]
+        counts[uri] -= 1
+        if not counts[uri]:
+            del counts[uri]
+
+    def _promote(self, uri: Optional[str], priority: int):
+        promoted = []
+        for lower in range(priority + 1, len(self._queues)):
+            barriers = self._barriers[lower]
+            if not barriers and (uri is None or uri not in self._uri_counts[lower]):
+                continue
+            queue = self._queues[lower]
+            last = -1
+            if barriers:
+                last = max(index for index, entry in enumerate(queue) if entry[3])
+            keep = deque()
+            for index, entry in enumerate(queue):
+                if index <= last or (uri is not None and entry[2] == uri):
+                    promoted.append(entry)
+                    if entry[2] is not None:
+                        self._remove_uri(lower, entry[2])
+                    if entry[3]:
+                        self._barriers[lower] -= 1
+                else:
+                    keep.append(entry)
+            self._queues[lower] = keep
+        # Entries of different classes were queued in enqueue time order
+        promoted.sort(key=lambda e: e[0])
+        self._queues[priority].extend(promoted)
+        counts = self._uri_counts[priority]
+        for entry in promoted:
+            if entry[2] is not None:
+                counts[entry[2]] = counts.get(entry[2], 0) + 1
+            if entry[3]:
+                self._barriers[priority] += 1
+        self.counters['promoted'] += len(promoted)
+
+    def put(self, msg: Message, priority: Optional[int] = None, block: bool = True) -> bool:
+        if priority is None:
+            priority = message_priority(msg)
+        uri = document_uri(msg)
+        with self._condition:
+            if block and self._pending >= self.max_pending and not self._closed:
+                self.counters['blocked'] += 1
+                while self._pending >= self.max_pending and not self._closed:
+                    self._condition.wait()
+            if self._closed:
+                return False
+            self._promote(uri, priority)
+            if uri is not None:
+                self._uri_counts[priority][uri] = self._uri_counts[priority].get(uri, 0) + 1
+            barrier = is_barrier(msg, uri)
+            if barrier:
+                self._barriers[priority] += 1
+            entry = [time.monotonic(), msg, uri, barrier]
+            self._queues[priority].append(entry)
+            message_id = msg.root.get('id')
+            if message_id is not None:
+                self._ids[message_id] = entry
+            self._pending += 1
+            self.counters['queued'] += 1
+            self._condition.notify_all()
+        return True
+
+    def wait_writable(self, timeout: Optional[float] = None) -> bool:
+        # Waits until put() would not block
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending < self.max_pending or self._closed, timeout)
+
+    def discard(self, message_id: str) -> bool:
+        # Drops a request that was not written yet
+        with self._condition:
+            entry = self._ids.pop(message_id, None)
+            if entry is None or entry[1] is None:
+                return False
+            entry[1] = None
+            self._pending -= 1
+            self.counters['discarded'] += 1
+            self._condition.notify_all()
+            return True
+
+    def take(self, max_count: int = 256, timeout: Optional[float] = None) -> List[Message]:
+        # Waits for messages, then returns up to max_count of them in sending order
+        batch = []
+        with self._condition:
+            while not self._pending and not self._closed:
+                if not self._condition.wait(timeout):
+                    return batch
+            now = time.monotonic()
+            for priority, queue in enumerate(self._queues):
+                while queue and len(batch) < max_count:
+                    enqueued, msg, uri, barrier = queue.popleft()
+                    if uri is not None:
+                        self._remove_uri(priority, uri)
+                    if barrier:
+                        self._barriers[priority] -= 1
+                    if msg is None:
+                        continue
+                    message_id = msg.root.get('id')
+                    if message_id is not None:
+                        self._ids.pop(message_id, None)
+                    self.waits[priority].add(now - enqueued)
+                    batch.append(msg)
+            self._pending -= len(batch)
+            self._condition.notify_all()
+        return batch
+
+    def close(self, drain: bool = False):
+        # No more messages are queued and blocked producers return. Pending messages are dropped,
+        # or with drain still taken by the writer, which returns once they are gone.
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            if drain:
+                return
+            for queue in self._queues:
+                queue.clear()
+            for counts in self._uri_counts:
+                counts.clear()
+            self._barriers = [0 for _ in priority_names]
+            self._ids.clear()
+            self._pending = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def get_stats(self) -> Dict[str, dict]:
+        with self._condition:
+            stats = {name: dict(self.waits[priority].as_dict(), pending=sum(1 for e in self._queues[priority]
+                                                                           if e[1] is not None))
+                     for priority, name in enumerate(priority_names)}
+            stats['counters'] = dict(self.counters)
+            return stats
+
+
+def write_all(fd: int, buffers: List[bytes]) -> int:
+    total = 0
+    pending = [memoryview(b) for b in buffers]
+    index = 0
+    while index < len(pending):
+        try:
+            n = os.writev(fd, pending[index:index + max_iovecs])
+        except BlockingIOError:
+            # A socket shares its non-blocking mode with the reading side
+            select.select([], [fd], [])
+            continue
+        total += n
+        while index < len(pending) and n >= len(pending[index]):
+            n -= len(pending[index])
+            index += 1
+        if n:
+            pending[index] = pending[index][n:]
+    return total
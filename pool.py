@@ -0,0 +1,170 @@
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+from .client import LSPClient, RequestHandle, copy_compile_commands
+from .message import QueryMessage, WorkspaceSymbolMessage
+
+
+def merge_results(responses: List[dict]) -> dict:
+    # Concatenates list results and completion-style {'items': [...]} results of several servers.
+    # Errors are left out, the first one is the response's error when no server had a result.
+    merged = None
+    errors = []
+    for response in responses:
+        if 'error' in response:
+            errors.append(response.get('error'))
+            continue
+        result = response.get('result')
+        if result is None:
+            continue
+        if isinstance(result, list):
+            merged = (merged or []) + result
+        elif isinstance(result, dict) and 'items' in result:
+            if merged is None:
+                merged = {'isIncomplete': False, 'items': []}
+            merged['isIncomplete'] = merged.get('isIncomplete') or result.get('isIncomplete', False)
+            merged['items'] = merged.get('items') + result.get('items')
+        elif merged is None:
+            merged = result
+    msg = {'jsonrpc': '2.0', 'id': None, 'result': merged}
+    if merged is None and errors:
+        msg['error'] = errors[0]
+    return msg
+
+
+class LSPServerPool:
+    # Runs several servers over the same root folder. Every document belongs to one server, chosen
+    # by a stable hash of the file itself, or of the sub-project it is in: the nearest folder below
+    # the root with a compile database of its own. The root folder's database covers every file and
+    # groups nothing, the pool copies compile_commands_path there.
+    def __init__(self, root_folder, size: int = 0, compile_commands_path: str = '', enable_logging=False,
+                 server_command: Optional[List[str]] = None, route_by_compile_database=True):
+        if size <= 0:
+            size = os.cpu_count() or 1
+        if compile_commands_path:
+            copy_compile_commands(compile_commands_path, root_folder)
+        self._root_folder = os.path.abspath(root_folder)
+        self._route_by_compile_database = route_by_compile_database
+        self._owners: Dict[str, int] = {}
+        self._database_folders: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        # Servers start in parallel. Log files have fixed names, only the first server can log
+        self._clients: List[LSPClient] = [LSPClient(root_folder, '', enable_logging and i == 0, server_command,
+                                                    wait=False) for i in range(size)]
+        try:
+            for client in self._clients:
+                client.wait_ready()
+        except RuntimeError:
+            for client in self._clients:
+                client.abort()
+            raise
+
+    @property
+    def clients(self) -> List[LSPClient]:
+        return self._clients
+
+    def _database_folder(self, folder: str) -> str:
+        visited = []
+        result = ''
+        while folder.startswith(self._root_folder + os.sep):
+            if folder in self._database_folders:
+                result = self._database_folders.get(folder)
+                break
+            visited.append(folder)
+            if os.path.exists(os.path.join(folder, 'compile_commands.json')):
+                result = folder
+                break
+            folder = os.path.dirname(folder)
+        for f in visited:
+            self._database_folders[f] = result
+        return result
+
+    def route_key(self, path: str) -> str:
+        path = os.path.abspath(path)
+        if self._route_by_compile_database:
+            # Files outside sub-projects are spread individually
+            return self._database_folder(os.path.dirname(path)) or path
+        return path
+
+    def server_index(self, path: str) -> int:
+        with self._lock:
+            index = self._owners.get(path)
+            if index is None:
+                index = zlib.crc32(self.route_key(path).encode('utf-8')) % len(self._clients)
+                self._owners[path] = index
+            return index
+
+    def client_for(self, path: str) -> LSPClient:
+        return self._clients[self.server_index(path)]
+
+    def set_diagnostic_callback(self, callback: callable):
+        for client in self._clients:
+            client.set_diagnostic_callback(callback)
+
+    def is_open_file(self, path):
+        return self.client_for(path).is_open_file(path)
+
+    def open_source_file(self, path):
+        return self.client_for(path).open_source_file(path)
+
+    def close_source_file(self, path):
+        self.client_for(path).close_source_file(path)
+
+    def modify_source_line(self, path: str, row: int, text: str):
+        self.client_for(path).modify_source_line(path, row, text)
+
+    def modify_source_ranges(self, path: str, edits: List[Tuple[int, int, int, int, str]]):
+        self.client_for(path).modify_source_ranges(path, edits)
+
+    def modify_source_file(self, path: str, content: str):
+        self.client_for(path).modify_source_file(path, content)
+
+    def request_completion(self, path: str, row: int, col: int, handler: callable,
+                           timeout: Optional[float] = None) -> RequestHandle:
+        return self.client_for(path).request_completion(path, row, col, handler, timeout)
+
+    def request_definition(self, path: str, row: int, col: int, handler: callable,
+                           timeout: Optional[float] = None) -> RequestHandle:
+        return self.client_for(path).request_definition(path, row, col, handler, timeout)
+
+    def request_coloring(self, path: str, prev_id: str, handler: callable,
+                         timeout: Optional[float] = None) -> RequestHandle:
+        return self.client_for(path).request_coloring(path, prev_id, handler, timeout)
+
+    def request_semantic_tokens(self, path: str, handler: callable, timeout: Optional[float] = None) -> RequestHandle:
+        return self.client_for(path).request_semantic_tokens(path, handler, timeout)
+
+    def get_coloring_legend(self) -> Tuple[List[str], List[str]]:
+        return self._clients[0].get_coloring_legend()
+
+    def fan_out(self, factory: Callable[[], QueryMessage], handler: callable,
+                merge: Callable[[List[dict]], dict] = merge_results, timeout: Optional[float] = None):
+        # Sends a fresh message from factory to every server, handler gets the merged responses.
+        # Expired and cancelled requests are answered with an error response and count as answers,
+        # so handler runs once every server answered or gave up, with the results there are.
+        responses: List[dict] = []
+        lock = threading.Lock()
+
+        def collect(msg):
+            with lock:
+                responses.append(msg)
+                done = len(responses) == len(self._clients)
+            if done:
+                handler(merge(responses))
+
+        return [client.send_request(factory(), collect, timeout) for client in self._clients]
+
+    def request_workspace_symbols(self, query: str, handler: callable, timeout: Optional[float] = None):
+        return self.fan_out(lambda: WorkspaceSymbolMessage(query), handler, timeout=timeout)
+
+    def get_stats(self) -> List[Dict[str, int]]:
+        return [{'open_files': client.open_file_count(),
+                 'queue_depth': client.queue_depth(),
+                 'pending_requests': len(client.transactions)}
+                for client in self._clients]
+
+    def shutdown(self):
+        with ThreadPoolExecutor(len(self._clients)) as executor:
+            list(executor.map(lambda client: client.shutdown(), self._clients))
@@ -0,0 +1,165 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+from .message import PositionalMessage
+
+# Positional requests whose answers only depend on the document and the documents they point into.
+# References and implementations can change with an edit of any file, they are not cached.
+default_cached_methods = frozenset({'textDocument/definition', 'textDocument/declaration',
+                                    'textDocument/typeDefinition', 'textDocument/hover',
+                                    'textDocument/documentHighlight', 'textDocument/signatureHelp'})
+# Edits of these documents can change answers in every other document
+default_dependency_suffixes = ('.h', '.hh', '.hpp', '.hxx', '.inc', '.inl', '.ipp', '.tcc')
+
+# (method, uri, document version, line, character)
+QueryKey = Tuple[str, str, int, int, int]
+
+
+def query_key(msg: PositionalMessage, version: int) -> QueryKey:
+    position = msg.params.get('position')
+    return (msg.root.get('method'), msg.params.get('textDocument').get('uri'), version,
+            position.get('line'), position.get('character'))
+
+
+def result_uris(result) -> Set[str]:
+    # Documents a Location, a LocationLink or a list of them points into
+    uris = set()
+    for location in result if isinstance(result, list) else [result]:
+        if isinstance(location, dict):
+            uri = location.get('uri') or location.get('targetUri')
+            if uri:
+                uris.add(uri)
+    return uris
+
+
+class QueryEntry:
+    __slots__ = ('response', 'stored', 'uris')
+
+    def __init__(self, response, stored: float, uris: Set[str]):
+        self.response = response
+        self.stored = stored
+        self.uris = uris
+
+
+class QueryPending:
+    __slots__ = ('message_id', 'waiters', 'sequence')
+
+    def __init__(self, message_id: str, waiter, sequence: int):
+        self.message_id = message_id
+        self.waiters = [waiter]
+        self.sequence = sequence
+
+
+class QueryCache:
+    # Responses of positional requests by QueryKey, least recently used out after max_entries and
+    # expired after ttl seconds. Entries go when their document changes, when a document their
+    # result points into changes, and all of them when a dependency (a header) changes.
+    # Identical requests in flight share one server request, their waiters are handed back
+    # to the client by complete() or abandon().
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 60.0,
+                 methods=default_cached_methods, dependency_suffixes=default_dependency_suffixes):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.methods = methods
+        self.dependency_suffixes = dependency_suffixes
+        self._entries: 'OrderedDict[QueryKey, QueryEntry]' = OrderedDict()
+        self._by_uri: Dict[str, Set[QueryKey]] = {}
+        self._pending: Dict[QueryKey, QueryPending] = {}
+        self._pending_ids: Dict[str, QueryKey] = {}
+        # Counts document changes, responses to requests sent before a change are not stored
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'joined': 0, 'stored': 0, 'invalidated': 0, 'expired': 0,
+                         'evicted': 0}
+
+    def _remove(self, key: QueryKey) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for uri in entry.uris:
+            keys = self._by_uri.get(uri)
+            keys.discard(key)
+            if not keys:
+                del self._by_uri[uri]
+        return True
+
+    def lookup(self, key: QueryKey):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry.stored > self.ttl:
+                self._remove(key)
+                self.counters['expired'] += 1
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry.response
+
+    def join_or_begin(self, key: QueryKey, message_id: str, waiter) -> Optional[str]:
+        # Adds waiter to the identical request in flight and returns its id. When there is none the
+        # request message_id becomes the one in flight, the caller sends it, and None is returned.
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.waiters.append(waiter)
+                self.counters['joined'] += 1
+                return pending.message_id
+            self._pending[key] = QueryPending(message_id, waiter, self._sequence)
+            self._pending_ids[message_id] = key
+            return None
+
+    def complete(self, key: QueryKey, response) -> list:
+        # Stores the response unless it is an error or a document changed meanwhile, returns the waiters
+        with self._lock:
+            pending = self._pending.pop(key, None)
+            if pending is None:
+                return []
+            del self._pending_ids[pending.message_id]
+            if pending.sequence == self._sequence and response.get('error') is None:
+                uris = result_uris(response.get('result'))
+                uris.add(key[1])
+                self._remove(key)
+                self._entries[key] = QueryEntry(response, time.monotonic(), uris)
+                for uri in uris:
+                    self._by_uri.setdefault(uri, set()).add(key)
+                self.counters['stored'] += 1
+                while len(self._entries) > self.max_entries:
+                    self._remove(next(iter(self._entries)))
+                    self.counters['evicted'] += 1
+            return pending.waiters
+
+    def abandon(self, message_id: str) -> list:
+        # The request was cancelled or expired, returns its waiters
+        with self._lock:
+            key = self._pending_ids.pop(message_id, None)
+            if key is None:
+                return []
+            return self._pending.pop(key).waiters
+
+    def document_changed(self, uri: str):
+        with self._lock:
+            self._sequence += 1
+            if uri.endswith(self.dependency_suffixes):
+                keys = list(self._entries)
+            else:
+                keys = list(self._by_uri.get(uri, ()))
+            for key in keys:
+                self._remove(key)
+            self.counters['invalidated'] += len(keys)
+
+    def invalidate(self, uri: Optional[str] = None):
+        # Entries of the document, or all entries
+        with self._lock:
+            keys = [key for key in self._entries if uri is None or key[1] == uri]
+            for key in keys:
+                self._remove(key)
+            self.counters['invalidated'] += len(keys)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return dict(self.counters, entries=len(self._entries), pending=len(self._pending),
+                        hit_rate=self.counters['hits'] / lookups if lookups else 0.0)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from fakeserver import read_message, write_message
+from logreader import LogReader
+
+
+def params_key(method: str, params) -> bytes:
+    # Digest of the canonical params, recorded didOpen texts are not kept in memory
+    canonical = json.dumps(params, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.blake2b(method.encode('utf-8') + b'\0' + canonical, digest_size=16).digest()
+
+
+class Exchange:
+    # A recorded client message with the server messages it caused, as log entry indices
+    # and delays in nanoseconds from the client message
+    __slots__ = ('response', 'response_delay', 'followups', 'used')
+
+    def __init__(self):
+        self.response: Optional[int] = None
+        self.response_delay = 0
+        self.followups: List[Tuple[int, int]] = []
+        self.used = False
+
+
+def take(queue: Optional[Deque[Exchange]], reuse: bool) -> Optional[Exchange]:
+    # Oldest unused exchange, or the last one again when reuse is set
+    if not queue:
+        return None
+    while len(queue) > 1 and queue[0].used:
+        queue.popleft()
+    exchange = queue[0]
+    if exchange.used and not reuse:
+        return None
+    exchange.used = True
+    return exchange
+
+
+class Recording:
+    def __init__(self, reader: LogReader):
+        self.reader = reader
+        self.by_params: Dict[bytes, Deque[Exchange]] = {}
+        self.by_method: Dict[str, Deque[Exchange]] = {}
+        pending: Dict[int, Tuple[Exchange, int]] = {}
+        last: Optional[Tuple[Exchange, int]] = None
+        for entry in reader:
+            timestamp = entry.timestamp or 0
+            if entry.direction == 1:
+                if entry.method is None:
+                    # Client responses to server requests need no replay
+                    continue
+                exchange = Exchange()
+                params = entry.json().get('params')
+                self.by_params.setdefault(params_key(entry.method, params), deque()).append(exchange)
+                self.by_method.setdefault(entry.method, deque()).append(exchange)
+                if entry.is_request:
+                    # Non numeric ids are indexed as negative hashes, only notifications have no id
+                    pending[entry.message_id] = (exchange, timestamp)
+                last = (exchange, timestamp)
+            elif entry.is_response:
+                request = pending.pop(entry.message_id, None)
+                if request is not None:
+                    request[0].response = entry.index
+                    request[0].response_delay = timestamp - request[1]
+            elif last is not None:
+                last[0].followups.append((timestamp - last[1], entry.index))
+
+    def lookup(self, method: str, params) -> Optional[Exchange]:
+        # The next recording with the same params, the last one again once they are used up
+        key = params_key(method, params)
+        return take(self.by_params.get(key), False) or take(self.by_params.get(key), True)
+
+    def lookup_method(self, method: str) -> Optional[Exchange]:
+        # The next recording of the method whatever its params, its answer may be wrong for the request
+        return take(self.by_method.get(method), False) or take(self.by_method.get(method), True)
+
+    def message(self, index: int) -> dict:
+        return self.reader[index].json()
+
+
+class ReplayServer:
+    # Answers requests with the recorded responses. Recorded delays are divided by speed,
+    # 1 replays the original timing and 0 sends everything as soon as possible. Messages are matched
+    # by method and params, with match_method a message without a recording of its params gets the
+    # next recording of its method, counted as method_matched.
+    def __init__(self, recording: Recording, speed: float, out, match_method: bool = False):
+        self.recording = recording
+        self.speed = speed
+        self.out = out
+        self.match_method = match_method
+        self._schedule: List[Tuple[float, int, dict]] = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self.counters = {'matched': 0, 'method_matched': 0, 'unmatched': 0, 'sent': 0}
+        self._thread = threading.Thread(target=self._writer_thread, daemon=True)
+        self._thread.start()
+
+    def _send_later(self, received: float, delay_ns: int, msg: dict):
+        due = received + delay_ns / self.speed / 1e9 if self.speed > 0 else received
+        with self._condition:
+            heapq.heappush(self._schedule, (due, self._sequence, msg))
+            self._sequence += 1
+            self._condition.notify()
+
+    def _writer_thread(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._schedule:
+                        timeout = self._schedule[0][0] - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    elif self._closed:
+                        return
+                    else:
+                        timeout = None
+                    self._condition.wait(timeout)
+                _, _, msg = heapq.heappop(self._schedule)
+            write_message(self.out, msg)
+            self.counters['sent'] += 1
+
+    def handle(self, msg: dict) -> bool:
+        received = time.monotonic()
+        method = msg.get('method')
+        if method is None:
+            return True
+        if method == 'exit':
+            return False
+        exchange = self.recording.lookup(method, msg.get('params'))
+        if exchange is not None:
+            self.counters['matched'] += 1
+        elif self.match_method:
+            exchange = self.recording.lookup_method(method)
+            if exchange is not None:
+                self.counters['method_matched'] += 1
+        if exchange is None:
+            self.counters['unmatched'] += 1
+            if 'id' in msg:
+                response = {'jsonrpc': '2.0', 'id': msg.get('id'), 'result': None}
+                if method != 'shutdown':
+                    response = {'jsonrpc': '2.0', 'id': msg.get('id'),
+                                'error': {'code': -32601, 'message': f'No recorded response for {method}'}}
+                self._send_later(received, 0, response)
+            return True
+        if 'id' in msg and exchange.response is not None:
+            response = self.recording.message(exchange.response)
+            response['id'] = msg.get('id')
+            self._send_later(received, exchange.response_delay, response)
+        for delay, index in exchange.followups:
+            self._send_later(received, delay, self.recording.message(index))
+        return True
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='LSP server replaying a recorded rpc_session.bin')
+    parser.add_argument('log', help='Session log written by BinaryLog')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='1 keeps the recorded timing, 10 replays 10 times faster, 0 answers immediately')
+    parser.add_argument('--match-method', action='store_true',
+                        help='Answer messages whose params were not recorded with a recording of the same method')
+    args = parser.parse_args()
+    reader = LogReader(args.log)
+    server = ReplayServer(Recording(reader), args.speed, sys.stdout.buffer, args.match_method)
+    stream = os.fdopen(sys.stdin.fileno(), 'rb', buffering=65536)
+    while True:
+        msg = read_message(stream)
+        if msg is None or not server.handle(msg):
+            break
+    server.close()
+    reader.close()
+    print(f'replay: {server.counters}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
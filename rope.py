@@ -0,0 +1,208 @@
+from typing import List, Optional, Tuple
+
+LEAF_SIZE = 1024
+
+
+def utf16_length(text: str) -> int:
+    if text.isascii():
+        return len(text)
+    return len(text) + sum(1 for c in text if ord(c) > 0xFFFF)
+
+
+def utf16_to_index(text: str, units: int) -> int:
+    # Character index within text that is `units` UTF-16 code units from its start
+    if text.isascii():
+        return min(units, len(text))
+    pos = 0
+    for index, c in enumerate(text):
+        if pos >= units:
+            return index
+        pos += 2 if ord(c) > 0xFFFF else 1
+    return len(text)
+
+
+class _Node:
+    __slots__ = ('left', 'right', 'text', 'length', 'newlines', 'utf16', 'height')
+
+    def __init__(self, left, right, text: Optional[str]):
+        self.left = left
+        self.right = right
+        self.text = text
+        if text is not None:
+            self.length = len(text)
+            self.newlines = text.count('\n')
+            self.utf16 = utf16_length(text)
+            self.height = 1
+        else:
+            self.length = left.length + right.length
+            self.newlines = left.newlines + right.newlines
+            self.utf16 = left.utf16 + right.utf16
+            self.height = 1 + max(left.height, right.height)
+
+
+def _leaf(text: str) -> Optional[_Node]:
+    return _Node(None, None, text) if text else None
+
+
+def _branch(left: _Node, right: _Node) -> _Node:
+    return _Node(left, right, None)
+
+
+def _balance(a: _Node, b: _Node) -> _Node:
+    if a.height > b.height + 1:
+        if a.left.height >= a.right.height:
+            return _branch(a.left, _branch(a.right, b))
+        return _branch(_branch(a.left, a.right.left), _branch(a.right.right, b))
+    if b.height > a.height + 1:
+        if b.right.height >= b.left.height:
+            return _branch(_branch(a, b.left), b.right)
+        return _branch(_branch(a, b.left.left), _branch(b.left.right, b.right))
+    return _branch(a, b)
+
+
+def _join(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.text is not None and right.text is not None and left.length + right.length <= LEAF_SIZE:
+        return _leaf(left.text + right.text)
+    if left.height > right.height + 1:
+        return _balance(left.left, _join(left.right, right))
+    if right.height > left.height + 1:
+        return _balance(_join(left, right.left), right.right)
+    return _branch(left, right)
+
+
+def _split(node: Optional[_Node], index: int) -> Tuple[Optional[_Node], Optional[_Node]]:
+    if node is None or index <= 0:
+        return None, node
+    if index >= node.length:
+        return node, None
+    if node.text is not None:
+        return _leaf(node.text[:index]), _leaf(node.text[index:])
+    if index < node.left.length:
+        a, b = _split(node.left, index)
+        return a, _join(b, node.right)
+    if index == node.left.length:
+        return node.left, node.right
+    a, b = _split(node.right, index - node.left.length)
+    return _join(node.left, a), b
+
+
+def _build(text: str) -> Optional[_Node]:
+    nodes = [_leaf(text[i:i + LEAF_SIZE]) for i in range(0, len(text), LEAF_SIZE)]
+    if not nodes:
+        return None
+    while len(nodes) > 1:
+        paired = [_branch(nodes[i], nodes[i + 1]) for i in range(0, len(nodes) - 1, 2)]
+        if len(nodes) % 2:
+            paired[-1] = _join(paired[-1], nodes[-1])
+        nodes = paired
+    return nodes[0]
+
+
+class Rope:
+    # Immutable, height balanced rope. Edits return new ropes sharing unchanged
+    # subtrees, so keeping an old version around costs O(log n) nodes per edit.
+    __slots__ = ('_root',)
+
+    def __init__(self, text: str = '', root: Optional[_Node] = None):
+        self._root = root if root is not None or not text else _build(text)
+
+    def __len__(self):
+        return self._root.length if self._root else 0
+
+    @property
+    def line_count(self):
+        return (self._root.newlines if self._root else 0) + 1
+
+    @property
+    def utf16_length(self):
+        return self._root.utf16 if self._root else 0
+
+    def insert(self, offset: int, text: str) -> 'Rope':
+        return self.replace(offset, offset, text)
+
+    def delete(self, start: int, end: int) -> 'Rope':
+        return self.replace(start, end, '')
+
+    def replace(self, start: int, end: int, text: str) -> 'Rope':
+        left, rest = _split(self._root, start)
+        _, right = _split(rest, end - start)
+        return Rope(root=_join(_join(left, _build(text)), right))
+
+    def chunks(self, start: int = 0, end: Optional[int] = None) -> List[str]:
+        if end is None:
+            end = len(self)
+        res = []
+        stack = [(self._root, 0)] if self._root else []
+        while stack:
+            node, offset = stack.pop()
+            if offset >= end or offset + node.length <= start:
+                continue
+            if node.text is not None:
+                res.append(node.text[max(0, start - offset):end - offset])
+            else:
+                stack.append((node.right, offset + node.left.length))
+                stack.append((node.left, offset))
+        return res
+
+    def substring(self, start: int, end: int) -> str:
+        return ''.join(self.chunks(start, end))
+
+    def text(self) -> str:
+        return ''.join(self.chunks())
+
+    def line_start(self, row: int) -> int:
+        # Offset of the first character of row, rows past the end map to len(self)
+        if row <= 0 or self._root is None:
+            return 0
+        if row > self._root.newlines:
+            return len(self)
+        node = self._root
+        offset = 0
+        while node.text is None:
+            if row <= node.left.newlines:
+                node = node.left
+            else:
+                row -= node.left.newlines
+                offset += node.left.length
+                node = node.right
+        index = -1
+        for _ in range(row):
+            index = node.text.index('\n', index + 1)
+        return offset + index + 1
+
+    def line_end(self, row: int) -> int:
+        # Offset of the newline terminating row, or len(self) for the last row
+        if self._root is None or row >= self._root.newlines:
+            return len(self)
+        return self.line_start(row + 1) - 1
+
+    def line(self, row: int) -> str:
+        return self.substring(self.line_start(row), self.line_end(row))
+
+    def row_of(self, offset: int) -> int:
+        node = self._root
+        row = 0
+        while node is not None and node.text is None:
+            if offset < node.left.length:
+                node = node.left
+            else:
+                offset -= node.left.length
+                row += node.left.newlines
+                node = node.right
+        if node is not None:
+            row += node.text.count('\n', 0, offset)
+        return row
+
+    def offset_at(self, row: int, character: int) -> int:
+        # LSP position (UTF-16 character) to offset
+        start = self.line_start(row)
+        return start + utf16_to_index(self.substring(start, self.line_end(row)), character)
+
+    def position_at(self, offset: int) -> Tuple[int, int]:
+        # Offset to LSP position (row, UTF-16 character)
+        row = self.row_of(offset)
+        return row, utf16_length(self.substring(self.line_start(row), offset))
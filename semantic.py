@@ -0,0 +1,165 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _absolute_starts(delta_lines, delta_starts) -> array:
+    starts = array('q', [0]) * len(delta_lines)
+    start = 0
+    for i, (delta_line, delta_start) in enumerate(zip(delta_lines, delta_starts)):
+        start = delta_start if delta_line else start + delta_start
+        starts[i] = start
+    return starts
+
+
+class DecodedTokens:
+    # Absolute token positions as parallel arrays, numpy arrays when numpy is installed.
+    # Without numpy, starts are only computed for the whole document when first asked for.
+    __slots__ = ('lines', '_starts', '_data', 'lengths', 'types', 'modifiers')
+
+    def __init__(self, lines, starts, lengths, types, modifiers, data: Optional[array] = None):
+        self.lines = lines
+        self._starts = starts
+        self._data = data
+        self.lengths = lengths
+        self.types = types
+        self.modifiers = modifiers
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def starts(self):
+        if self._starts is None:
+            self._starts = _absolute_starts(self._data[0::5], self._data[1::5])
+        return self._starts
+
+    def row_range(self, first_row: int, last_row: int) -> Tuple[int, int]:
+        # Token index range [begin, end) covering rows first_row..last_row
+        if np is not None and isinstance(self.lines, np.ndarray):
+            return (int(np.searchsorted(self.lines, first_row, 'left')),
+                    int(np.searchsorted(self.lines, last_row, 'right')))
+        return bisect_left(self.lines, first_row), bisect_right(self.lines, last_row)
+
+    def tokens(self, begin: int, end: int) -> List[Tuple[int, int, int, int, int]]:
+        if self._starts is not None:
+            starts = self._starts[begin:end].tolist()
+        else:
+            # Token begin starts a row (see row_range), so its start is absolute
+            starts = _absolute_starts([1] + self._data[5 * begin + 5:5 * end:5].tolist(),
+                                      self._data[5 * begin + 1:5 * end:5]).tolist()
+        return list(zip(self.lines[begin:end].tolist(), starts,
+                        *(a[begin:end].tolist() for a in (self.lengths, self.types, self.modifiers))))
+
+
+def _decode_numpy(data: array) -> DecodedTokens:
+    raw = np.frombuffer(data, dtype=np.uint32).reshape(-1, 5).astype(np.int64)
+    delta_lines = raw[:, 0]
+    delta_starts = raw[:, 1]
+    lines = np.cumsum(delta_lines)
+    # Starts are relative to the previous token only within a line, restart the running sum on new lines
+    running = np.cumsum(delta_starts)
+    line_begin = np.where(delta_lines != 0, np.arange(len(raw)), 0)
+    line_begin = np.maximum.accumulate(line_begin)
+    starts = running - (running[line_begin] - delta_starts[line_begin])
+    return DecodedTokens(lines, starts, raw[:, 2].copy(), raw[:, 3].copy(), raw[:, 4].copy())
+
+
+def _decode_python(data: array) -> DecodedTokens:
+    lines = array('q', accumulate(data[0::5]))
+    return DecodedTokens(lines, None, data[2::5], data[3::5], data[4::5], data)
+
+
+def decode(data: array) -> DecodedTokens:
+    if np is not None:
+        return _decode_numpy(data)
+    return _decode_python(data)
+
+
+class DocumentTokens:
+    def __init__(self, uri: str):
+        self.uri = uri
+        self.result_id: Optional[str] = None
+        self.data = array('I')
+        self._decoded: Optional[DecodedTokens] = None
+
+    def __len__(self):
+        return len(self.data) // 5
+
+    def set_data(self, result_id: Optional[str], data: List[int]):
+        self.result_id = result_id
+        self.data = array('I', data)
+        self._decoded = None
+
+    def apply_edits(self, result_id: Optional[str], edits: List[dict]):
+        # Edit offsets refer to the previous array, applying from the back keeps them valid
+        for edit in sorted(edits, key=lambda e: e.get('start'), reverse=True):
+            start = edit.get('start')
+            self.data[start:start + edit.get('deleteCount')] = array('I', edit.get('data', []))
+        self.result_id = result_id
+        self._decoded = None
+
+    def decoded(self) -> DecodedTokens:
+        if self._decoded is None:
+            self._decoded = decode(self.data)
+        return self._decoded
+
+    def tokens_in_rows(self, first_row: int, last_row: int) -> List[Tuple[int, int, int, int, int]]:
+        # (line, start, length, type, modifier bitmask) for every token on rows first_row..last_row
+        decoded = self.decoded()
+        begin, end = decoded.row_range(first_row, last_row)
+        return decoded.tokens(begin, end)
+
+
+class SemanticTokenStore:
+    def __init__(self):
+        self._documents: Dict[str, DocumentTokens] = {}
+        self._lock = threading.Lock()
+        self.token_types: List[str] = []
+        self.token_modifiers: List[str] = []
+
+    def set_legend(self, token_types: List[str], token_modifiers: List[str]):
+        self.token_types = token_types
+        self.token_modifiers = token_modifiers
+
+    def get(self, uri: str) -> Optional[DocumentTokens]:
+        with self._lock:
+            return self._documents.get(uri)
+
+    def previous_result_id(self, uri: str) -> str:
+        document = self.get(uri)
+        return document.result_id if document is not None and document.result_id else ''
+
+    def apply_response(self, uri: str, response: dict) -> Optional[DocumentTokens]:
+        # Applies a semanticTokens/full or full/delta response, None if the delta can't be applied
+        result = response.get('result')
+        if not result:
+            return None
+        with self._lock:
+            document = self._documents.get(uri)
+            if 'data' in result:
+                if document is None:
+                    document = self._documents[uri] = DocumentTokens(uri)
+                document.set_data(result.get('resultId'), result.get('data'))
+            elif document is not None and 'edits' in result:
+                document.apply_edits(result.get('resultId'), result.get('edits'))
+            else:
+                return None
+            return document
+
+    def remove(self, uri: str):
+        with self._lock:
+            self._documents.pop(uri, None)
+
+    def type_name(self, token_type: int) -> str:
+        return self.token_types[token_type] if 0 <= token_type < len(self.token_types) else ''
+
+    def modifier_names(self, bitmask: int) -> List[str]:
+        return [name for bit, name in enumerate(self.token_modifiers) if bitmask & (1 << bit)]
@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from .client import LSPClient, copy_compile_commands
+
+
+def compile_commands_stamp(root_folder: str) -> Optional[Tuple[int, int]]:
+    # (size, mtime) of the root folder's compile database, None when there is none
+    try:
+        stat = os.stat(os.path.join(root_folder, 'compile_commands.json'))
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class StandbyPool:
+    # Keeps servers started and initialized ahead of time, so acquire() returns a client at once.
+    # At most max_idle standbys are kept over all root folders, the oldest are shut down first.
+    def __init__(self, max_idle: int = 2, server_command: Optional[List[str]] = None, replenish: bool = True,
+                 init_timeout: Optional[float] = 30.0):
+        self.max_idle = max_idle
+        self.replenish = replenish
+        self._server_command = server_command
+        self._init_timeout = init_timeout
+        # Idle standbys in start order
+        self._standbys: Deque[LSPClient] = deque()
+        # The compile database each standby's server was started with
+        self._stamps: Dict[LSPClient, Optional[Tuple[int, int]]] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.counters = {'started': 0, 'acquired': 0, 'cold': 0, 'evicted': 0, 'failed': 0, 'stale': 0}
+
+    def _new_client(self, root_folder: str) -> LSPClient:
+        return LSPClient(root_folder, server_command=self._server_command, wait=False,
+                         init_timeout=self._init_timeout)
+
+    def prepare(self, root_folder: str, count: int = 1):
+        # Starts count standbys for root_folder, without waiting for them to initialize
+        root_folder = os.path.abspath(root_folder)
+        for _ in range(count):
+            stamp = compile_commands_stamp(root_folder)
+            client = self._new_client(root_folder)
+            stopped = []
+            with self._lock:
+                if self._closed:
+                    stopped.append(client)
+                else:
+                    self._standbys.append(client)
+                    self._stamps[client] = stamp
+                    self.counters['started'] += 1
+                    while len(self._standbys) > self.max_idle:
+                        evicted = self._standbys.popleft()
+                        del self._stamps[evicted]
+                        stopped.append(evicted)
+                        self.counters['evicted'] += 1
+            client.startup.add_done_callback(lambda f, c=client: self._started(c))
+            for c in stopped:
+                c.shutdown()
+
+    def _started(self, client: LSPClient):
+        if client.startup.exception() is None:
+            return
+        # Drop standbys that failed to initialize
+        with self._lock:
+            if client not in self._standbys:
+                return
+            self._standbys.remove(client)
+            del self._stamps[client]
+            self.counters['failed'] += 1
+        threading.Thread(target=client.abort, daemon=True).start()
+
+    def acquire(self, root_folder: str, compile_commands_path: str = '', wait: bool = True) -> LSPClient:
+        # A standby of root_folder when there is one, preferring initialized ones, else a new client.
+        # The server reads the compile database while it starts, standbys started before the database
+        # was copied or changed are not used.
+        root_folder = os.path.abspath(root_folder)
+        if compile_commands_path:
+            copy_compile_commands(compile_commands_path, root_folder)
+        stamp = compile_commands_stamp(root_folder)
+        with self._lock:
+            candidates = [c for c in self._standbys if c.root_folder == root_folder]
+            stale = [c for c in candidates if self._stamps[c] != stamp]
+            for c in stale:
+                self._standbys.remove(c)
+                del self._stamps[c]
+            self.counters['stale'] += len(stale)
+            candidates = [c for c in candidates if c not in stale]
+            client = next((c for c in candidates if c.initialized), candidates[0] if candidates else None)
+            if client is not None:
+                self._standbys.remove(client)
+                del self._stamps[client]
+                self.counters['acquired'] += 1
+            else:
+                self.counters['cold'] += 1
+        for c in stale:
+            threading.Thread(target=c.shutdown, daemon=True).start()
+        if client is None:
+            client = self._new_client(root_folder)
+        if self.replenish:
+            threading.Thread(target=self.prepare, args=(root_folder,), daemon=True).start()
+        if wait:
+            client.wait_ready()
+        return client
+
+    def idle(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        with self._lock:
+            for client in self._standbys:
+                counts[client.root_folder] = counts.get(client.root_folder, 0) + 1
+        return counts
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters, idle=len(self._standbys))
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            clients = list(self._standbys)
+            self._standbys.clear()
+            self._stamps.clear()
+        for client in clients:
+            client.shutdown()
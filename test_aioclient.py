@@ -0,0 +1,53 @@
+import asyncio
+import sys
+
+import pytest
+
+from .aioclient import AsyncLSPClient
+from .benchmark import fake_server_command, test_folder, test_source
+
+
+def test_document_api():
+    async def run():
+        lsp = AsyncLSPClient(test_folder, server_command=fake_server_command('--items', 5))
+        await lsp.initialize(5)
+        try:
+            lsp.open_source_file(test_source)
+            assert lsp.is_open_file(test_source) and lsp.open_file_count() == 1
+            lsp.modify_source_line(test_source, 3, '    item_')
+            response = await lsp.request_completion(test_source, 3, 9)
+            assert len(response.get('result').get('items')) == 5
+            lsp.close_source_file(test_source)
+            assert not lsp.is_open_file(test_source)
+        finally:
+            await lsp.shutdown()
+
+    asyncio.run(run())
+
+
+def test_failed_initialize_stops_server():
+    async def run():
+        lsp = AsyncLSPClient(test_folder, server_command=[sys.executable, '-c', 'import time; time.sleep(30)'])
+        with pytest.raises(RuntimeError):
+            await lsp.initialize(0.2)
+        assert lsp._process is None and not lsp._tasks
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(run()) == []
+
+
+class SmallQueueClient(AsyncLSPClient):
+    max_notifications = 4
+
+
+def test_notifications_bounded():
+    async def run():
+        lsp = SmallQueueClient(test_folder)
+        for i in range(10):
+            lsp.process_incoming({'jsonrpc': '2.0', 'method': 'window/logMessage', 'params': {'message': str(i)}})
+        assert lsp._notifications.qsize() == 4 and lsp.dropped_notifications == 6
+        lsp.process_incoming({'jsonrpc': '2.0', 'method': 'window/logMessage', 'params': {'message': 'last'}})
+        lsp._queue_notification(None)
+        return [msg.get('params').get('message') async for msg in lsp.notifications()]
+
+    assert asyncio.run(run()) == ['8', '9', 'last']
@@ -0,0 +1,55 @@
+import threading
+
+from .benchmark import DocumentTextMessage, call, fake_server_command, test_folder, test_source
+from .client import LSPClient
+from .message import CompletionMessage, request_cancelled
+
+
+def test_raising_handler_keeps_client_running():
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--items', 5))
+    try:
+        lsp.open_source_file(test_source)
+        done = threading.Event()
+
+        def handler(msg):
+            done.set()
+            raise KeyError('result')
+
+        lsp.send_request(CompletionMessage(test_source, 3, 4), handler)
+        assert done.wait(5)
+        assert call(lsp, DocumentTextMessage(test_source)).get('result') is not None
+        assert lsp.request_counters['handler_errors'] == 1
+    finally:
+        lsp.shutdown()
+
+
+def test_superseded_request_answered_with_error():
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--items', 5, '--delay', 0.05))
+    try:
+        lsp.open_source_file(test_source)
+        responses = []
+        done = threading.Event()
+        lsp.request_completion(test_source, 3, 4, responses.append)
+        lsp.request_completion(test_source, 3, 4, lambda msg: done.set())
+        assert done.wait(5)
+        assert responses[0].get('error').get('code') == request_cancelled
+        assert lsp.request_counters['superseded'] == 1
+    finally:
+        lsp.shutdown()
+
+
+def test_timeouts_are_opt_in():
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--items', 5, '--delay', 0.2))
+    try:
+        assert lsp.request_timeout is None
+        lsp.open_source_file(test_source)
+        responses = []
+        done = threading.Event()
+        lsp.send_request(CompletionMessage(test_source, 3, 4), lambda msg: done.set(), timeout=0.05)
+        lsp.send_request(DocumentTextMessage(test_source), responses.append)
+        assert done.wait(5)
+        assert lsp.request_counters['expired'] == 1
+        call(lsp, DocumentTextMessage(test_source))
+        assert responses[0].get('result') is not None
+    finally:
+        lsp.shutdown()
@@ -0,0 +1,93 @@
+import threading
+
+from .benchmark import fake_server_command, test_folder
+from .client import LSPClient
+from .completion import CompletionCache
+from .message import cancelled_response, get_file
+
+
+def completion_response(*labels) -> dict:
+    items = [{'label': label, 'filterText': label, 'sortText': f'{i:08d}'} for i, label in enumerate(labels)]
+    return {'jsonrpc': '2.0', 'id': '1', 'result': {'isIncomplete': False, 'items': items}}
+
+
+def source_file(tmp_path, text: str):
+    path = tmp_path / 'source.cpp'
+    path.write_text(text)
+    return get_file(str(path))
+
+
+def labels(response: dict):
+    return [item.get('label') for item in response.get('result').get('items')]
+
+
+def test_prefix_filtering(tmp_path):
+    cache = CompletionCache()
+    file = source_file(tmp_path, 'int main()\n{\n    it\n}\n')
+    cache.store(cache.begin(file, 2, 6), completion_response('item_2', 'iterator', 'value', 'item_1'))
+    file.update_content_line(2, '    item_')
+    assert labels(cache.lookup(file, 2, 9)) == ['item_2', 'item_1']
+    assert cache.get_stats() == {'hits': 1, 'misses': 0, 'sessions': 1}
+
+
+def test_other_word_misses(tmp_path):
+    cache = CompletionCache()
+    file = source_file(tmp_path, 'int main()\n{\n    it\n}\n')
+    cache.store(cache.begin(file, 2, 6), completion_response('item'))
+    file.update_content_line(2, '    va')
+    assert cache.lookup(file, 2, 6) is None
+    assert cache.get_stats()['sessions'] == 0
+
+
+def test_superseded_response_keeps_newer_session(tmp_path):
+    cache = CompletionCache()
+    file = source_file(tmp_path, 'int main()\n{\n    it\n}\n')
+    first = cache.begin(file, 2, 6)
+    second = cache.begin(file, 2, 6)
+    # The first request is cancelled after the second one began
+    cache.store(first, cancelled_response('1', 'Request superseded'))
+    cache.store(second, completion_response('item'))
+    assert labels(cache.lookup(file, 2, 6)) == ['item']
+
+
+def test_incomplete_response_not_cached(tmp_path):
+    cache = CompletionCache()
+    file = source_file(tmp_path, 'int main()\n{\n    it\n}\n')
+    response = completion_response('item')
+    response['result']['isIncomplete'] = True
+    cache.store(cache.begin(file, 2, 6), response)
+    assert cache.lookup(file, 2, 6) is None
+
+
+def test_back_to_back_completions(tmp_path):
+    path = tmp_path / 'source.cpp'
+    path.write_text('int main()\n{\n    \n}\n')
+    lsp = LSPClient(test_folder, server_command=fake_server_command('--items', 20, '--delay', 0.05))
+    try:
+        cache = CompletionCache()
+        lsp.set_completion_cache(cache)
+        lsp.open_source_file(str(path))
+        lsp.modify_source_line(str(path), 2, '    i')
+        lsp.request_completion(str(path), 2, 5, lambda msg: None)
+        done = threading.Event()
+        lsp.request_completion(str(path), 2, 5, lambda msg: done.set())
+        assert done.wait(5)
+        lsp.modify_source_line(str(path), 2, '    item_1')
+        responses = []
+        lsp.request_completion(str(path), 2, 10, responses.append)
+        assert labels(responses[0])[0] == 'item_1'
+        assert cache.get_stats()['hits'] == 1
+    finally:
+        lsp.shutdown()
+
+
+def test_edits_extended_over_typed_text(tmp_path):
+    cache = CompletionCache()
+    file = source_file(tmp_path, 'int main()\n{\n    it\n}\n')
+    response = completion_response('item')
+    edit_range = {'start': {'line': 2, 'character': 4}, 'end': {'line': 2, 'character': 6}}
+    response['result']['items'][0]['textEdit'] = {'newText': 'item', 'range': edit_range}
+    cache.store(cache.begin(file, 2, 6), response)
+    file.update_content_line(2, '    ite')
+    item = cache.lookup(file, 2, 7).get('result').get('items')[0]
+    assert item.get('textEdit').get('range') == {'start': {'line': 2, 'character': 4}, 'end': {'line': 2, 'character': 7}}
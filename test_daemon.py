@@ -0,0 +1,27 @@
+import os
+import shutil
+import tempfile
+
+from .benchmark import DocumentTextMessage, call, start_daemon, test_folder, test_source
+from .client import LSPClient
+from .message import get_file
+
+
+def test_daemon_started_from_environment(monkeypatch):
+    # The documented startup: the daemon and its clients find the socket in $LSPCLIENT_DAEMON
+    folder = tempfile.mkdtemp()
+    socket_path = os.path.join(folder, 'daemon.sock')
+    monkeypatch.setenv('LSPCLIENT_DAEMON', socket_path)
+    daemon = start_daemon(socket_path)
+    try:
+        lsp = LSPClient(test_folder, init_timeout=5)
+        try:
+            lsp.open_source_file(test_source)
+            response = call(lsp, DocumentTextMessage(test_source))
+            assert response.get('result') == get_file(test_source).content
+        finally:
+            lsp.shutdown()
+    finally:
+        daemon.terminate()
+        daemon.wait(10)
+        shutil.rmtree(folder)
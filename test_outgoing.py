@@ -0,0 +1,101 @@
+from .message import CancelMessage, InitializedMessage, Message, QueryMessage
+from .outgoing import OutgoingScheduler, SendCounters, coalesce
+
+
+def document_message(method: str, uri: str, request: bool = False) -> Message:
+    msg = QueryMessage(method) if request else Message(method)
+    msg.params['textDocument'] = {'uri': uri}
+    return msg
+
+
+def did_change(uri: str, *texts) -> Message:
+    msg = document_message('textDocument/didChange', uri)
+    msg.params['contentChanges'] = [{'text': text} for text in texts]
+    return msg
+
+
+def methods(batch):
+    return [(msg.root.get('method'), msg.params.get('textDocument', {}).get('uri')) for msg in batch]
+
+
+def test_priority_classes():
+    scheduler = OutgoingScheduler()
+    scheduler.put(document_message('textDocument/documentSymbol', 'file:///a.cpp', True))
+    scheduler.put(did_change('file:///b.cpp', 'x'))
+    scheduler.put(document_message('textDocument/completion', 'file:///c.cpp', True))
+    assert methods(scheduler.take()) == [('textDocument/completion', 'file:///c.cpp'),
+                                         ('textDocument/didChange', 'file:///b.cpp'),
+                                         ('textDocument/documentSymbol', 'file:///a.cpp')]
+
+
+def test_same_document_keeps_order():
+    scheduler = OutgoingScheduler()
+    scheduler.put(document_message('textDocument/documentSymbol', 'file:///b.cpp', True))
+    scheduler.put(did_change('file:///a.cpp', 'x'))
+    scheduler.put(document_message('textDocument/completion', 'file:///a.cpp', True))
+    assert methods(scheduler.take()) == [('textDocument/didChange', 'file:///a.cpp'),
+                                         ('textDocument/completion', 'file:///a.cpp'),
+                                         ('textDocument/documentSymbol', 'file:///b.cpp')]
+    assert scheduler.counters['promoted'] == 1
+
+
+def test_barrier_not_overtaken():
+    scheduler = OutgoingScheduler()
+    scheduler.put(did_change('file:///a.cpp', 'x'))
+    scheduler.put(InitializedMessage())
+    scheduler.put(document_message('textDocument/documentSymbol', 'file:///b.cpp', True))
+    scheduler.put(document_message('textDocument/completion', 'file:///c.cpp', True))
+    assert methods(scheduler.take()) == [('textDocument/didChange', 'file:///a.cpp'), ('initialized', None),
+                                         ('textDocument/completion', 'file:///c.cpp'),
+                                         ('textDocument/documentSymbol', 'file:///b.cpp')]
+
+
+def test_cancel_is_not_a_barrier():
+    scheduler = OutgoingScheduler()
+    scheduler.put(document_message('textDocument/documentSymbol', 'file:///b.cpp', True))
+    scheduler.put(CancelMessage('1'))
+    assert methods(scheduler.take()) == [('$/cancelRequest', None), ('textDocument/documentSymbol', 'file:///b.cpp')]
+
+
+def test_discard():
+    scheduler = OutgoingScheduler()
+    request = document_message('textDocument/completion', 'file:///a.cpp', True)
+    scheduler.put(request)
+    scheduler.put(did_change('file:///a.cpp', 'x'))
+    assert scheduler.discard(request.message_id)
+    assert not scheduler.discard(request.message_id)
+    assert len(scheduler) == 1
+    assert methods(scheduler.take()) == [('textDocument/didChange', 'file:///a.cpp')]
+    assert len(scheduler) == 0
+
+
+def test_close():
+    scheduler = OutgoingScheduler()
+    scheduler.put(did_change('file:///a.cpp', 'x'))
+    scheduler.close(drain=True)
+    assert not scheduler.put(did_change('file:///a.cpp', 'y'))
+    assert methods(scheduler.take()) == [('textDocument/didChange', 'file:///a.cpp')]
+    assert scheduler.take(timeout=0) == []
+    dropped = OutgoingScheduler()
+    dropped.put(did_change('file:///a.cpp', 'x'))
+    dropped.close()
+    assert len(dropped) == 0 and dropped.take() == []
+
+
+def test_full_blocks_unless_not_blocking():
+    scheduler = OutgoingScheduler(max_pending=1)
+    assert scheduler.put(did_change('file:///a.cpp', 'x'))
+    assert not scheduler.wait_writable(0)
+    scheduler.take()
+    assert scheduler.wait_writable(0)
+
+
+def test_coalesce_changes_of_one_document():
+    counters = SendCounters()
+    batch = coalesce([did_change('file:///a.cpp', 'x'), did_change('file:///a.cpp', 'y'),
+                      did_change('file:///b.cpp', 'z'), InitializedMessage(), did_change('file:///a.cpp', 'w')],
+                     counters)
+    assert methods(batch) == [('textDocument/didChange', 'file:///a.cpp'), ('textDocument/didChange', 'file:///b.cpp'),
+                              ('initialized', None), ('textDocument/didChange', 'file:///a.cpp')]
+    assert batch[0].params.get('contentChanges') == [{'text': 'y'}]
+    assert counters.coalesced == 1 and counters.superseded == 1
@@ -0,0 +1,53 @@
+import pytest
+
+from .benchmark import fake_server_command
+from .pool import LSPServerPool, merge_results
+
+
+@pytest.fixture
+def project(tmp_path):
+    # A root folder with its own compile database and 200 sources in 4 folders
+    (tmp_path / 'compile_commands.json').write_text('[]')
+    paths = []
+    for folder in ('core', 'gui', 'net', 'util'):
+        (tmp_path / folder).mkdir()
+        for i in range(50):
+            path = tmp_path / folder / f'source_{i}.cpp'
+            path.write_text('int main() { return 0; }\n')
+            paths.append(str(path))
+    return tmp_path, paths
+
+
+def test_files_spread_over_servers(project):
+    root, paths = project
+    pool = LSPServerPool(str(root), 4, server_command=fake_server_command())
+    try:
+        owners = [pool.server_index(path) for path in paths]
+        assert set(owners) == {0, 1, 2, 3}
+        assert min(owners.count(i) for i in range(4)) >= 20
+        assert [pool.server_index(path) for path in paths] == owners
+    finally:
+        pool.shutdown()
+
+
+def test_sub_project_stays_on_one_server(project):
+    root, paths = project
+    (root / 'net' / 'compile_commands.json').write_text('[]')
+    pool = LSPServerPool(str(root), 4, server_command=fake_server_command())
+    try:
+        net = {pool.server_index(path) for path in paths if '/net/' in path}
+        others = {pool.server_index(path) for path in paths if '/net/' not in path}
+        assert len(net) == 1
+        assert len(others) > 1
+    finally:
+        pool.shutdown()
+
+
+def test_merge_results():
+    responses = [{'id': 1, 'result': [1, 2]}, {'id': 2, 'error': {'code': -32800, 'message': 'Request timed out'}},
+                 {'id': 3, 'result': [3]}, {'id': 4, 'result': None}]
+    assert merge_results(responses).get('result') == [1, 2, 3]
+    completions = [{'result': {'isIncomplete': False, 'items': [1]}}, {'result': {'isIncomplete': True, 'items': [2]}}]
+    assert merge_results(completions).get('result') == {'isIncomplete': True, 'items': [1, 2]}
+    failed = merge_results([{'error': {'code': 1, 'message': 'a'}}, {'error': {'code': 2, 'message': 'b'}}])
+    assert failed.get('result') is None and failed.get('error').get('code') == 1
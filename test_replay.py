@@ -0,0 +1,57 @@
+import pytest
+
+from .benchmark import call, fake_server_command, replay_server_command, test_folder, test_source
+from .client import LSPClient
+from .message import PositionalMessage
+
+
+def definition(lsp: LSPClient, row: int, col: int) -> dict:
+    return call(lsp, PositionalMessage('textDocument/definition', test_source, row, col))
+
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    # A session with a definition request at 3:4, logged to rpc_session.bin
+    monkeypatch.chdir(tmp_path)
+    lsp = LSPClient(test_folder, enable_logging=True, server_command=fake_server_command())
+    try:
+        lsp.open_source_file(test_source)
+        recorded = definition(lsp, 3, 4)
+        lsp.close_source_file(test_source)
+    finally:
+        lsp.shutdown()
+    return str(tmp_path / 'rpc_session.bin'), recorded.get('result')
+
+
+def replay(log_path: str, *args) -> LSPClient:
+    lsp = LSPClient(test_folder, server_command=replay_server_command(log_path, '--speed', 0, *args))
+    lsp.open_source_file(test_source)
+    return lsp
+
+
+def test_recorded_request_replayed(recording):
+    log_path, result = recording
+    lsp = replay(log_path)
+    try:
+        assert definition(lsp, 3, 4).get('result') == result
+    finally:
+        lsp.shutdown()
+
+
+def test_unrecorded_params_not_answered(recording):
+    log_path, result = recording
+    lsp = replay(log_path)
+    try:
+        response = definition(lsp, 5, 1)
+        assert response.get('result') is None and response.get('error') is not None
+    finally:
+        lsp.shutdown()
+
+
+def test_method_match_is_opt_in(recording):
+    log_path, result = recording
+    lsp = replay(log_path, '--match-method')
+    try:
+        assert definition(lsp, 5, 1).get('result') == result
+    finally:
+        lsp.shutdown()
@@ -0,0 +1,74 @@
+import random
+
+from .rope import LEAF_SIZE, Rope, utf16_length, utf16_to_index
+
+
+def random_text(rng: random.Random, size: int) -> str:
+    return ''.join(rng.choice('ab \né\U0001F600') for _ in range(size))
+
+
+def test_edits_match_string_edits():
+    rng = random.Random(7)
+    text = random_text(rng, 5 * LEAF_SIZE)
+    rope = Rope(text)
+    for _ in range(300):
+        start = rng.randint(0, len(text))
+        end = rng.randint(start, min(len(text), start + 200))
+        inserted = random_text(rng, rng.randint(0, 300))
+        rope = rope.replace(start, end, inserted)
+        text = text[:start] + inserted + text[end:]
+    assert rope.text() == text
+    assert len(rope) == len(text)
+    assert rope.line_count == text.count('\n') + 1
+    assert rope.utf16_length == utf16_length(text)
+
+
+def test_insert_and_delete():
+    rope = Rope('hello world')
+    assert rope.insert(5, ',').text() == 'hello, world'
+    assert rope.delete(0, 6).text() == 'world'
+    assert Rope().insert(0, 'x').text() == 'x'
+    assert rope.delete(0, len(rope)).text() == ''
+
+
+def test_edits_keep_old_versions():
+    old = Rope('a' * (3 * LEAF_SIZE))
+    new = old.replace(LEAF_SIZE, LEAF_SIZE + 10, 'b')
+    assert old.text() == 'a' * (3 * LEAF_SIZE)
+    assert new.text() == 'a' * LEAF_SIZE + 'b' + 'a' * (2 * LEAF_SIZE - 10)
+
+
+def test_line_access():
+    rng = random.Random(11)
+    text = random_text(rng, 4 * LEAF_SIZE)
+    rope = Rope(text)
+    lines = text.split('\n')
+    offset = 0
+    for row, line in enumerate(lines):
+        assert rope.line_start(row) == offset
+        assert rope.line_end(row) == offset + len(line)
+        assert rope.line(row) == line
+        assert rope.row_of(offset) == row
+        offset += len(line) + 1
+    assert rope.line_start(len(lines) + 5) == len(text)
+    assert rope.line_end(len(lines) + 5) == len(text)
+
+
+def test_positions_count_utf16_units():
+    rope = Rope('int a;\n\U0001F600x = 1;\n')
+    assert rope.offset_at(1, 2) == rope.line_start(1) + 1
+    assert rope.position_at(rope.line_start(1) + 1) == (1, 2)
+    assert rope.offset_at(1, 100) == rope.line_end(1)
+    rng = random.Random(3)
+    text = random_text(rng, 2 * LEAF_SIZE)
+    rope = Rope(text)
+    for offset in range(0, len(text), 17):
+        row, character = rope.position_at(offset)
+        assert rope.offset_at(row, character) == offset
+
+
+def test_utf16_helpers():
+    assert utf16_length('abc') == 3
+    assert utf16_length('a\U0001F600') == 3
+    assert utf16_to_index('a\U0001F600b', 3) == 2
+    assert utf16_to_index('abc', 10) == 3
@@ -0,0 +1,68 @@
+import random
+
+from . import textdiff
+from .benchmark import DocumentTextMessage, call, fake_server_command, test_folder
+from .client import LSPClient
+from .fakeserver import apply_changes
+from .message import get_file
+from .textdiff import content_changes
+
+
+def lines_text(count: int) -> str:
+    return '\n'.join(f'int function_{i}(int value) {{ return value * {i}; }}' for i in range(count))
+
+
+def test_changes_apply_to_new_text():
+    rng = random.Random(5)
+    words = ['int a;', '', 'x\U0001F600y', '}', 'return 0;']
+    for _ in range(2000):
+        lines = [rng.choice(words) for _ in range(rng.randint(0, 10))]
+        new_lines = list(lines)
+        for _ in range(rng.randint(1, 3)):
+            row = rng.randint(0, len(new_lines))
+            if rng.random() < 0.5:
+                new_lines.insert(row, rng.choice(words))
+            elif row < len(new_lines):
+                new_lines[row] += rng.choice(words)
+        old, new = '\n'.join(lines), '\n'.join(new_lines)
+        changes = content_changes(old, new)
+        if changes is not None:
+            assert apply_changes(old, changes) == new
+
+
+def test_edit_in_large_file_sends_one_line():
+    old = lines_text(20000)
+    lines = old.split('\n')
+    lines[10000] += 'x'
+    changes = content_changes(old, '\n'.join(lines))
+    assert len(changes) == 1 and changes[0].get('text') == 'x'
+    assert changes[0].get('range').get('start').get('line') == 10000
+
+
+def test_last_line_changes():
+    assert apply_changes('a\nb', content_changes('a\nb', 'a\nb\nc')) == 'a\nb\nc'
+    assert apply_changes('a\nb\nc', content_changes('a\nb\nc', 'a')) == 'a'
+    assert content_changes('a', 'b\nc') is None
+
+
+def test_spread_changes_fall_back_to_full_sync():
+    old = lines_text(20000)
+    lines = old.split('\n')
+    lines[0] += 'x'
+    lines[-1] += 'x'
+    assert content_changes(old, '\n'.join(lines)) is None
+    assert content_changes('a\nb', 'a\nb') == []
+    assert textdiff.max_span_size < len(old)
+
+
+def test_known_ranges_sent_as_they_are(tmp_path):
+    path = tmp_path / 'source.cpp'
+    path.write_text('int main()\n{\n    return value;\n}\n')
+    lsp = LSPClient(test_folder, server_command=fake_server_command())
+    try:
+        lsp.open_source_file(str(path))
+        lsp.modify_source_ranges(str(path), [(2, 11, 2, 16, 'v'), (1, 1, 1, 1, ' // body')])
+        assert get_file(str(path)).content == 'int main()\n{ // body\n    return v;\n}'
+        assert call(lsp, DocumentTextMessage(str(path))).get('result') == get_file(str(path)).content
+    finally:
+        lsp.shutdown()
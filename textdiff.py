@@ -0,0 +1,190 @@
+from bisect import bisect_left
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+from .rope import utf16_length
+
+# Stretches without lines unique to both sides are diffed line by line (quadratic) up to this many
+# lines, larger ones become a single replaced block
+max_diff_lines = 2000
+max_changes = 64
+# Fall back to full sync once the ranges carry this fraction of the new text
+max_change_ratio = 0.5
+# Changes spread over more characters than this are sent as a full sync without diffing them,
+# splitting and diffing that much text costs more than sending it
+max_span_size = 256 << 10
+
+
+def _position(line: int, character: int):
+    return {'line': line, 'character': character}
+
+
+def _line_change(old_line: str, new_line: str, row: int) -> dict:
+    n = min(len(old_line), len(new_line))
+    prefix = 0
+    while prefix < n and old_line[prefix] == new_line[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < n - prefix and old_line[-1 - suffix] == new_line[-1 - suffix]:
+        suffix += 1
+    start = utf16_length(old_line[:prefix])
+    return {'range': {'start': _position(row, start),
+                      'end': _position(row, start + utf16_length(old_line[prefix:len(old_line) - suffix]))},
+            'text': new_line[prefix:len(new_line) - suffix]}
+
+
+def _block_change(old: List[str], new: List[str], i1: int, i2: int, j1: int, j2: int, row: int,
+                  last: bool) -> Optional[dict]:
+    # old and new are the lines from row on, last tells whether old[-1] is the last line of the document
+    if i2 < len(old) or not last:
+        return {'range': {'start': _position(row + i1, 0), 'end': _position(row + i2, 0)},
+                'text': ''.join(line + '\n' for line in new[j1:j2])}
+    if i1 == 0:
+        return None
+    # The last line has no terminator, anchor the change at the end of the previous line
+    return {'range': {'start': _position(row + i1 - 1, utf16_length(old[i1 - 1])),
+                      'end': _position(row + len(old) - 1, utf16_length(old[-1]))},
+            'text': ''.join('\n' + line for line in new[j1:j2])}
+
+
+def _unique_anchors(old: List[str], new: List[str], i1: int, i2: int, j1: int, j2: int) -> List[Tuple[int, int]]:
+    # Longest increasing run of lines that occur once on both sides, as (old row, new row)
+    old_rows: Dict[str, int] = {}
+    for i in range(i1, i2):
+        old_rows[old[i]] = -1 if old[i] in old_rows else i
+    new_rows: Dict[str, int] = {}
+    for j in range(j1, j2):
+        new_rows[new[j]] = -1 if new[j] in new_rows else j
+    pairs = [(old_rows.get(line, -1), j) for line, j in new_rows.items() if j >= 0 and old_rows.get(line, -1) >= 0]
+    pairs.sort(key=lambda p: p[1])
+    # Patience sorting on the old rows
+    tails: List[int] = []
+    tail_pairs: List[int] = []
+    previous: List[int] = []
+    for index, (i, _) in enumerate(pairs):
+        k = bisect_left(tails, i)
+        previous.append(tail_pairs[k - 1] if k else -1)
+        if k == len(tails):
+            tails.append(i)
+            tail_pairs.append(index)
+        else:
+            tails[k] = i
+            tail_pairs[k] = index
+    anchors = []
+    index = tail_pairs[-1] if tail_pairs else -1
+    while index >= 0:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _diff(old: List[str], new: List[str], i1: int, i2: int, j1: int, j2: int, opcodes: list):
+    # Patience diff: lines unique to both sides anchor the match, the stretches between them are
+    # diffed the same way. Appends the opcodes other than 'equal', in order.
+    while i1 < i2 and j1 < j2 and old[i1] == new[j1]:
+        i1 += 1
+        j1 += 1
+    while i1 < i2 and j1 < j2 and old[i2 - 1] == new[j2 - 1]:
+        i2 -= 1
+        j2 -= 1
+    if i1 == i2 or j1 == j2:
+        if i1 < i2 or j1 < j2:
+            opcodes.append(('delete' if j1 == j2 else 'insert', i1, i2, j1, j2))
+        return
+    anchors = _unique_anchors(old, new, i1, i2, j1, j2)
+    if anchors:
+        for i, j in anchors:
+            _diff(old, new, i1, i, j1, j, opcodes)
+            i1, j1 = i + 1, j + 1
+        _diff(old, new, i1, i2, j1, j2, opcodes)
+    elif (i2 - i1) + (j2 - j1) <= max_diff_lines:
+        for tag, a1, a2, b1, b2 in SequenceMatcher(None, old[i1:i2], new[j1:j2], autojunk=False).get_opcodes():
+            if tag != 'equal':
+                opcodes.append((tag, a1 + i1, a2 + i1, b1 + j1, b2 + j1))
+    else:
+        opcodes.append(('replace', i1, i2, j1, j2))
+
+
+def _common_prefix(a: str, b: str) -> int:
+    # Bisect with slice compares, the characters are compared in C instead of one by one
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a: str, b: str, limit: int) -> int:
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _opcodes(old: List[str], new: List[str]):
+    if len(old) == len(new):
+        # Same line count usually means edits within lines, a positional compare avoids the full diff
+        rows = [i for i, (a, b) in enumerate(zip(old, new)) if a != b]
+        if len(rows) <= max_changes:
+            return [('replace', i, i + 1, i, i + 1) for i in rows]
+    opcodes = []
+    _diff(old, new, 0, len(old), 0, len(new), opcodes)
+    return opcodes
+
+
+def content_changes(old_text: str, new_text: str) -> Optional[List[dict]]:
+    # Minimal line based contentChanges turning old_text into new_text, ordered
+    # bottom up so every range is valid against the original document.
+    # Returns None when a full sync is cheaper.
+    prefix = _common_prefix(old_text, new_text)
+    if prefix == len(old_text) == len(new_text):
+        return []
+    suffix = _common_suffix(old_text, new_text, min(len(old_text), len(new_text)) - prefix)
+    # Only the lines around the changed text are split and diffed, starting one line early so
+    # a change of the last line can be anchored at the end of the line before it
+    start = old_text.rfind('\n', 0, prefix) + 1
+    if start > 0:
+        start = old_text.rfind('\n', 0, start - 1) + 1
+    old_end = old_text.find('\n', len(old_text) - suffix)
+    if old_end < 0:
+        old_end = len(old_text)
+    new_end = old_end + len(new_text) - len(old_text)
+    if max(old_end, new_end) - start > max_span_size:
+        return None
+    row = old_text.count('\n', 0, start)
+    last = old_end == len(old_text)
+    old = old_text[start:old_end].split('\n')
+    new = new_text[start:new_end].split('\n')
+    first = 0
+    n = min(len(old), len(new))
+    while first < n and old[first] == new[first]:
+        first += 1
+    end = 0
+    while end < n - first and old[-1 - end] == new[-1 - end]:
+        end += 1
+    old_end = len(old) - end
+    new_end = len(new) - end
+    changes = []
+    size = 0
+    for tag, i1, i2, j1, j2 in reversed(_opcodes(old[first:old_end], new[first:new_end])):
+        if tag == 'equal':
+            continue
+        i1, i2, j1, j2 = i1 + first, i2 + first, j1 + first, j2 + first
+        if i2 - i1 == 1 and j2 - j1 == 1:
+            change = _line_change(old[i1], new[j1], row + i1)
+        else:
+            change = _block_change(old, new, i1, i2, j1, j2, row, last)
+        if change is None:
+            return None
+        changes.append(change)
+        size += len(change.get('text'))
+        if len(changes) > max_changes or size > max_change_ratio * len(new_text):
+            return None
+    return changes